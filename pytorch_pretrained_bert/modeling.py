@@ -27,6 +27,7 @@ import os
 import copy
 import json
 import math, time
+import hashlib
 import logging
 import tarfile
 import tempfile
@@ -34,6 +35,8 @@ import shutil
 import numpy as np
 import pickle
 
+from collections import OrderedDict
+
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss
@@ -74,6 +77,140 @@ def swish(x):
 ACT2FN = {"gelu": gelu, "relu": torch.nn.functional.relu, "swish": swish}
 
 
+def is_span_attention_mask(attention_mask):
+    """ Compact self-attention masks are int32 (st0, end0, st1, end1, causal_st, causal_end) boundaries per sample,
+        dense masks are long """
+    return attention_mask is not None and attention_mask.dtype == torch.int32 and attention_mask.size(-1) == 6
+
+
+def expand_span_attention_mask(spans, seq_len, num_rows=None):
+    """ Dense (N, seq_len, seq_len) 0/1 mask of compact span boundaries (..., 6), built in one broadcast on their device.
+        Every row attends to the columns in [st0, end0) and [st1, end1); inside the [causal_st, causal_end) block
+        rows attend to the columns of the block up to their own position only. num_rows keeps the first rows only """
+    spans = spans.reshape(-1, 6).long().unsqueeze(-1).unsqueeze(-1) # N x 6 x 1 x 1
+    pos = torch.arange(seq_len, device=spans.device)
+    row, col = pos[:num_rows].view(-1, 1), pos.view(1, -1)
+    st0, end0, st1, end1, causal_st, causal_end = spans.unbind(1)
+    in_spans = ((col >= st0) & (col < end0)) | ((col >= st1) & (col < end1))
+    in_block = (row >= causal_st) & (row < causal_end) & (col >= causal_st) & (col < causal_end)
+    return torch.where(in_block, (col <= row).expand_as(in_block), in_spans.expand_as(in_block)).long()
+
+
+def vis_projection_hash(model):
+    """ sha1 of the vis_embed / vis_pe_embed weights of model """
+    h = hashlib.sha1()
+    for name, p in sorted(list(model.vis_embed.state_dict(prefix='vis_embed.').items()) + list(model.vis_pe_embed.state_dict(prefix='vis_pe_embed.').items())):
+        h.update(name.encode())
+        h.update(p.detach().float().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+class VisEmbeddingCache(object):
+    """ Inference-time LRU cache of the vis_embed / vis_pe_embed outputs of image contexts, keyed by a key of the context
+        (e.g. its image_id) given by the caller. Entries are only valid for the projection weights (vis_projection_hash) and
+        the feature settings (config) they were computed with; they can be persisted to cache_file and loaded back """
+    def __init__(self, max_entries=4096, cache_file=None, config=''):
+        self.max_entries = max_entries
+        self.cache_file = cache_file
+        self.config = config
+        self.checkpoint = None
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+        if cache_file is not None and os.path.exists(cache_file):
+            saved = torch.load(cache_file, map_location='cpu')
+            if saved['config'] == config:
+                self.checkpoint = saved['checkpoint']
+                self.entries.update(list(saved['entries'].items())[-max_entries:])
+            else:
+                print("VisEmbeddingCache: {} was written with config {}, not {}, start empty".format(cache_file, saved['config'], config))
+
+    def bind(self, model):
+        """ Attach to model, once its weights are loaded. Entries of other projection weights are dropped """
+        checkpoint = vis_projection_hash(model)
+        if checkpoint != self.checkpoint and len(self.entries) > 0:
+            print("VisEmbeddingCache: drop {} entries of other vis_embed / vis_pe_embed weights".format(len(self.entries)))
+            self.entries.clear()
+        self.checkpoint = checkpoint
+        model.vis_embed_cache = self
+        return self
+
+    def get(self, key, num_regions, device):
+        """ (vis_feats, vis_pe) of key if they have num_regions regions, else None """
+        entry = self.entries.get(key)
+        if entry is None or entry[0].size(0) != num_regions:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if entry[0].device != torch.device(device):
+            entry = (entry[0].to(device), entry[1].to(device))
+            self.entries[key] = entry
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, vis_feats, vis_pe):
+        # copies, slices would keep the whole batch output alive
+        self.entries[key] = (vis_feats.detach().clone(), vis_pe.detach().clone())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        entries = OrderedDict((k, (v.cpu(), p.cpu())) for k, (v, p) in self.entries.items())
+        torch.save({'checkpoint': self.checkpoint, 'config': self.config, 'entries': entries}, self.cache_file + '.tmp')
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "VisEmbeddingCache({} entries, {} hits, {} misses)".format(len(self.entries), self.hits, self.misses)
+
+
+def embed_vis_features(model, vis_feats, vis_pe, vis_lens=None, vis_keys=None):
+    """ model.vis_embed / model.vis_pe_embed of the image contexts: rows of (..., regions, dim) zero-padded features, or
+        vis_lens regions each of packed (sum(vis_lens), dim) features. In eval mode, with a model.vis_embed_cache and
+        vis_keys holding one key per context (None: not cached), the contexts found in the cache skip the MLPs """
+    dtype = model.vis_embed[0].weight.dtype
+    cache = getattr(model, 'vis_embed_cache', None)
+    if cache is None or vis_keys is None or model.training:
+        return model.vis_embed(vis_feats.to(dtype)), model.vis_pe_embed(vis_pe.to(dtype))
+    if vis_lens is not None:
+        lens = vis_lens.tolist()
+        feats, pes = vis_feats.split(lens), vis_pe.split(lens)
+    else:
+        feats, pes = vis_feats.view(-1, *vis_feats.shape[-2:]), vis_pe.view(-1, *vis_pe.shape[-2:])
+        lens = [feats.size(1)] * feats.size(0)
+    assert len(vis_keys) == len(lens), "embed_vis_features: {} vis_keys for {} image contexts".format(len(vis_keys), len(lens))
+    out = [None if k is None else cache.get(k, n, vis_feats.device) for k, n in zip(vis_keys, lens)]
+    # an image that repeats within the batch is projected once
+    first_miss = {}
+    for i, (k, o) in enumerate(zip(vis_keys, out)):
+        if o is None and k is not None:
+            first_miss.setdefault((k, lens[i]), i)
+    miss = [i for i, o in enumerate(out) if o is None and (vis_keys[i] is None or first_miss[(vis_keys[i], lens[i])] == i)]
+    if len(miss) > 0:
+        if vis_lens is not None:
+            miss_vis = model.vis_embed(torch.cat([feats[i] for i in miss]).to(dtype)).split([lens[i] for i in miss])
+            miss_pe = model.vis_pe_embed(torch.cat([pes[i] for i in miss]).to(dtype)).split([lens[i] for i in miss])
+        else:
+            miss_index = torch.tensor(miss, dtype=torch.long, device=vis_feats.device)
+            miss_vis = model.vis_embed(feats[miss_index].to(dtype)).unbind(0)
+            miss_pe = model.vis_pe_embed(pes[miss_index].to(dtype)).unbind(0)
+        for i, v, p in zip(miss, miss_vis, miss_pe):
+            out[i] = (v, p)
+            if vis_keys[i] is not None:
+                cache.put(vis_keys[i], v, p)
+        for i, k in enumerate(vis_keys):
+            if out[i] is None:
+                out[i] = out[first_miss[(k, lens[i])]]
+    if vis_lens is not None:
+        return torch.cat([v for v, _ in out]), torch.cat([p for _, p in out])
+    shape = vis_feats.shape[:-1] + (-1,)
+    return torch.stack([v for v, _ in out]).view(shape), torch.stack([p for _, p in out]).view(shape)
+
+
 class BertConfig(object):
     """Configuration class to store the configuration of a `BertModel`.
     """
@@ -93,7 +230,8 @@ class BertConfig(object):
                  initializer_range=0.02,
                  task_idx=None,
                  fp32_embedding=False,
-                 label_smoothing=None):
+                 label_smoothing=None,
+                 attention_backend='matmul'):
         """Constructs BertConfig.
 
         Args:
@@ -117,6 +255,8 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            attention_backend: "matmul" computes the self-attention with separate matmul / softmax ops,
+                "sdpa" with torch.nn.functional.scaled_dot_product_attention (torch>=2.0).
         """
         if isinstance(vocab_size_or_config_json_file, str):
             with open(vocab_size_or_config_json_file, "r", encoding='utf-8') as reader:
@@ -139,6 +279,7 @@ class BertConfig(object):
             self.task_idx = task_idx
             self.fp32_embedding = fp32_embedding
             self.label_smoothing = label_smoothing
+            self.attention_backend = attention_backend
         else:
             raise ValueError("First argument must be either a vocabulary size (int)"
                              "or the path to a pretrained model config file (str)")
@@ -216,7 +357,7 @@ class BertEmbeddings(nn.Module):
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         #print("Inside embedding: hiddensize = ", config.hidden_size)
 
-    def forward(self, vis_feats, vis_pe, input_ids, token_type_ids=None, context=None, cxt_modality_label=None, position_ids=None, max_len_img_cxt=200, prev_is_None=True):
+    def forward(self, vis_feats, vis_pe, input_ids, token_type_ids=None, context=None, cxt_modality_label=None, position_ids=None, max_len_img_cxt=200, prev_is_None=True, vis_lens=None):
         seq_length = input_ids.size(1)
         if position_ids is None:
             position_ids = torch.arange(
@@ -230,8 +371,16 @@ class BertEmbeddings(nn.Module):
 
         if context in ["img", "both"] and prev_is_None and vis_feats.size()[-1] > 1: 
             ## TODO: fit the img feature chunk into words_embeddings with specified indices.
-            words_embeddings[cxt_modality_label, 1:1+max_len_img_cxt] = vis_feats
-            position_embeddings[cxt_modality_label, 1:1+max_len_img_cxt] = vis_pe
+            if vis_lens is None:
+                words_embeddings[cxt_modality_label, 1:1+max_len_img_cxt] = vis_feats
+                position_embeddings[cxt_modality_label, 1:1+max_len_img_cxt] = vis_pe
+            else:
+                # packed regions (sum(vis_lens), hidden_size): region j of the i-th image context goes to position 1+j of sequence cxt_modality_label[i]
+                # positions past vis_lens[i] keep their token embeddings, the attention mask never looks at them
+                seq_idx = torch.as_tensor(cxt_modality_label, dtype=torch.long, device=vis_lens.device).repeat_interleave(vis_lens)
+                region_pos = torch.arange(seq_idx.size(0), device=vis_lens.device) - (torch.cumsum(vis_lens, 0) - vis_lens).repeat_interleave(vis_lens) + 1
+                words_embeddings[seq_idx, region_pos] = vis_feats
+                position_embeddings[seq_idx, region_pos] = vis_pe
             #words_embeddings = torch.cat((words_embeddings[:, :1], vis_feats, words_embeddings[:, max_len_img_cxt+1:]), dim=1)
             assert max_len_img_cxt == 200, 'only support region attn!'
             #position_embeddings = torch.cat((position_embeddings[:, :1], vis_pe, position_embeddings[:, max_len_img_cxt+1:]), dim=1) # hacky...
@@ -262,6 +411,11 @@ class BertSelfAttention(nn.Module):
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        # config files written before attention_backend existed
+        self.attention_backend = getattr(config, 'attention_backend', 'matmul')
+        assert self.attention_backend in ('matmul', 'sdpa'), "unknown attention_backend {}".format(self.attention_backend)
+        if self.attention_backend == 'sdpa':
+            assert hasattr(F, 'scaled_dot_product_attention'), "attention_backend sdpa needs torch>=2.0"
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[
@@ -284,6 +438,14 @@ class BertSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        if self.attention_backend == 'sdpa':
+            # same scaling, additive mask and dropout on the attention probabilities in one fused op (the dropout masks
+            # come from a different random stream), the scores and probabilities are not materialized per head
+            context_layer = F.scaled_dot_product_attention(query_layer, key_layer, value_layer,
+                attn_mask=attention_mask.to(query_layer.dtype), dropout_p=self.dropout.p if self.training else 0.)
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            return context_layer.view(*(context_layer.size()[:-2] + (self.all_head_size,)))
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(
             query_layer, key_layer.transpose(-1, -2))
@@ -645,6 +807,9 @@ class PreTrainedBertModel(nn.Module):
         # label smoothing
         if ('label_smoothing' in kwargs) and kwargs['label_smoothing']:
             config.label_smoothing = kwargs['label_smoothing']
+        # self-attention implementation
+        if ('attention_backend' in kwargs) and kwargs['attention_backend']:
+            config.attention_backend = kwargs['attention_backend']
         if 'drop_prob' in kwargs:
             print('setting the new dropout rate!', kwargs['drop_prob'])
             config.attention_probs_dropout_prob = kwargs['drop_prob']
@@ -653,7 +818,7 @@ class PreTrainedBertModel(nn.Module):
         logger.info("Model config {}".format(config))
 
         # clean the arguments in kwargs
-        for arg_clean in ('config_path', 'type_vocab_size', 'relax_projection', 'task_idx', 'max_position_embeddings', 'fp32_embedding', 'label_smoothing', 'drop_prob'):
+        for arg_clean in ('config_path', 'type_vocab_size', 'relax_projection', 'task_idx', 'max_position_embeddings', 'fp32_embedding', 'label_smoothing', 'drop_prob', 'attention_backend'):
             if arg_clean in kwargs:
                 del kwargs[arg_clean]
 
@@ -822,6 +987,8 @@ class BertModel(PreTrainedBertModel):
     def get_extended_attention_mask(self, input_ids, token_type_ids, attention_mask):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
+        elif is_span_attention_mask(attention_mask):
+            attention_mask = expand_span_attention_mask(attention_mask, input_ids.size(-1))
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -848,13 +1015,13 @@ class BertModel(PreTrainedBertModel):
         return extended_attention_mask
 
 
-    def forward(self, vis_feats, vis_pe, input_ids, token_type_ids=None, attention_mask=None, context=None, cxt_modality_label=None, output_all_encoded_layers=True, max_len_img_cxt=200):
+    def forward(self, vis_feats, vis_pe, input_ids, token_type_ids=None, attention_mask=None, context=None, cxt_modality_label=None, output_all_encoded_layers=True, max_len_img_cxt=200, vis_lens=None):
             
         extended_attention_mask = self.get_extended_attention_mask(
             input_ids, token_type_ids, attention_mask)
 
         # hack to load vis feats
-        embedding_output = self.embeddings(vis_feats, vis_pe, input_ids, token_type_ids, context=context, cxt_modality_label=cxt_modality_label, max_len_img_cxt=max_len_img_cxt)
+        embedding_output = self.embeddings(vis_feats, vis_pe, input_ids, token_type_ids, context=context, cxt_modality_label=cxt_modality_label, max_len_img_cxt=max_len_img_cxt, vis_lens=vis_lens)
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
                                       output_all_encoded_layers=output_all_encoded_layers)
@@ -870,7 +1037,7 @@ class BertModelIncr(BertModel):
         super(BertModelIncr, self).__init__(config)
 
     def forward(self, vis_feats, vis_pe, input_ids, token_type_ids, position_ids, attention_mask, context=None, cxt_modality_label=None, 
-                prev_embedding=None, prev_encoded_layers=None, output_all_encoded_layers=True, max_len_img_cxt=200):
+                prev_embedding=None, prev_encoded_layers=None, output_all_encoded_layers=True, max_len_img_cxt=200, vis_lens=None):
         
         extended_attention_mask = self.get_extended_attention_mask(
             input_ids, token_type_ids, attention_mask)
@@ -878,7 +1045,7 @@ class BertModelIncr(BertModel):
         prev_is_None = prev_embedding is None
         #print(prev_is_None)
         embedding_output = self.embeddings(
-            vis_feats, vis_pe, input_ids, token_type_ids, position_ids=position_ids, context=context, cxt_modality_label=cxt_modality_label, max_len_img_cxt=max_len_img_cxt, prev_is_None=prev_is_None)
+            vis_feats, vis_pe, input_ids, token_type_ids, position_ids=position_ids, context=context, cxt_modality_label=cxt_modality_label, max_len_img_cxt=max_len_img_cxt, prev_is_None=prev_is_None, vis_lens=vis_lens)
         
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
@@ -1001,7 +1168,7 @@ class BertPreTrainingPairRel(nn.Module):
 class BertForWebqa(PreTrainedBertModel):
     """refer to BertForPreTraining"""
 
-    def __init__(self, config, num_labels=2, max_len_img_cxt=200, use_vinvl=False):
+    def __init__(self, config, num_labels=2, max_len_img_cxt=200, use_vinvl=False, filter_scoring='cross_encoder', late_interaction_dim=128):
         super(BertForWebqa, self).__init__(config)
         self.bert = BertModel(config)
         self.cls = BertPreTrainingHeads(
@@ -1046,38 +1213,91 @@ class BertForWebqa(PreTrainedBertModel):
         self.context_classifier = nn.Linear(config.hidden_size, 2) # each choice gets a single logit
         #self.context_crit = nn.BCEWithLogitsLoss()
 
-
-    def forward(self, vis_feats=None, vis_pe=None, input_ids=None, token_type_ids=None, attention_mask=None, masked_lm_labels=None, do_filter_task=None, filter_label=None, logit_mask=None, context=None, cxt_modality_label=None, next_sentence_label=None, masked_pos=None, masked_weights=None, task_idx=None, drop_worst_ratio=0.2, filter_infr_th=None, tokenizer=None):
+        # filter task: 'cross_encoder' classifies the [CLS] of every [CLS] context [SEP] Q+A [SEP] choice,
+        # 'late_interaction' matches the tokens of a question row encoded once per sample with the tokens of every choice encoded without Q
+        assert filter_scoring in ['cross_encoder', 'late_interaction'], "BertForWebqa: unknown filter_scoring {}".format(filter_scoring)
+        self.filter_scoring = filter_scoring
+        if filter_scoring == 'late_interaction':
+            # only in late_interaction models, cross_encoder checkpoints keep their keys
+            self.late_interaction_proj = nn.Linear(config.hidden_size, late_interaction_dim)
+            self.late_interaction_classifier = nn.Linear(1, 2) # mean MaxSim similarity --> the 2 logits of the choice
+        self.vis_embed_cache = None # VisEmbeddingCache.bind
+
+    def late_interaction_embed(self, sequence_output, attention_mask):
+        """ L2-normalized token embeddings of encoded rows, zeroed outside the tokens [CLS] attends to, and the 0/1 mask of these tokens """
+        seq_len = sequence_output.size(1)
+        if is_span_attention_mask(attention_mask):
+            token_mask = expand_span_attention_mask(attention_mask, seq_len, num_rows=1)[:, 0]
+        else:
+            token_mask = attention_mask.view(-1, seq_len, seq_len)[:, 0]
+        token_emb = F.normalize(self.late_interaction_proj(sequence_output), dim=-1)
+        return token_emb * token_mask.unsqueeze(-1).type_as(token_emb), token_mask
+
+    def late_interaction_score(self, question_emb, question_mask, choice_emb, choice_mask, question_index=None):
+        """ Filter logits (NC x 2) of late_interaction_embed outputs: each question token takes its most similar choice token (MaxSim),
+            the mean over the question tokens is mapped to the 2 logits. question_index picks the question row of every choice """
+        # questions are much shorter than the choices, drop their padding first
+        q_len = int((question_mask.sum(0) > 0).nonzero().max()) + 1
+        question_emb, question_mask = question_emb[:, :q_len], question_mask[:, :q_len]
+        if question_index is not None:
+            question_emb, question_mask = question_emb[question_index], question_mask[question_index]
+        sim = torch.bmm(question_emb, choice_emb.transpose(1, 2)) # NC x q_len x choice_len
+        sim = sim.masked_fill(choice_mask.unsqueeze(1) == 0, -1e4)
+        question_mask = question_mask.type_as(sim)
+        score = (sim.max(dim=-1)[0] * question_mask).sum(dim=-1) / question_mask.sum(dim=-1).clamp(min=1)
+        return self.late_interaction_classifier(score.unsqueeze(-1))
+
+
+    def forward(self, vis_feats=None, vis_pe=None, input_ids=None, token_type_ids=None, attention_mask=None, masked_lm_labels=None, do_filter_task=None, filter_label=None, logit_mask=None, context=None, cxt_modality_label=None, next_sentence_label=None, masked_pos=None, masked_weights=None, task_idx=None, drop_worst_ratio=0.2, filter_infr_th=None, tokenizer=None, vis_lens=None, choice_embeddings=None, return_choice_embeddings=False, return_question_embeddings=False, vis_keys=None):
+        # vis_keys: one key per image context (e.g. image_id) to look their vis_embed / vis_pe_embed outputs up in self.vis_embed_cache, see embed_vis_features
+        # late_interaction filter scoring only:
+        # choice_embeddings: (emb, mask) of the choices in row order, e.g. looked up in a vlp.candidate_index.CandidateIndex. Only the questions are encoded
+        # return_choice_embeddings / return_question_embeddings: return the late_interaction_embed outputs of the choice / question rows instead of scoring them
         
         ## TODO: track the change of context_is_img --> context, pass cxt_modality_label to BertEmbedding
-        if context[0] in ['img', 'both'] and vis_feats.size()[-1] > 1: 
-            vis_feats = self.vis_embed(vis_feats) # image region features (NC1+NC2+ ... +NC_B, 100, hidden_size), NC = num_choices
-            vis_pe = self.vis_pe_embed(vis_pe) # image region positional encodings (NC1+NC2+ ... +NC_B, 100, hidden_size), NC = num_choices
+        questions_only = choice_embeddings is not None or return_question_embeddings
+        if context[0] in ['img', 'both'] and vis_feats.size()[-1] > 1 and not questions_only: 
+            if vis_lens is not None:
+                # packed regions, the collate function may have stacked them when all samples have the same number
+                vis_feats, vis_pe, vis_lens = vis_feats.reshape(-1, vis_feats.size(-1)), vis_pe.reshape(-1, vis_pe.size(-1)), vis_lens.view(-1)
+            # features may be shipped in half precision, embed_vis_features upcasts them to the embedding weights
+            # image region features / positional encodings (NC1+NC2+ ... +NC_B, 100, hidden_size), NC = num_choices
+            vis_feats, vis_pe = embed_vis_features(self, vis_feats, vis_pe, vis_lens, vis_keys)
             # They are flattened in collate function
 
         
         if do_filter_task[0]:
             # input_ids.size() = (B, num_choices, max_len)
-            num_choices = input_ids.size(1)
-            B = input_ids.size(0)
             assert filter_label is not None and cxt_modality_label is not None
-            input_ids = input_ids.view(B*num_choices, -1)
-            token_type_ids = token_type_ids.view(B*num_choices, -1)
-            attention_mask = attention_mask.view(B*num_choices, -1, attention_mask.size(-1))
+            # late_interaction: the first row of every sample is its question, followed by the choices
+            late_interaction = self.filter_scoring == 'late_interaction'
+            if logit_mask.dtype == torch.long:
+                # ragged_filter_choices: logit_mask holds the number of choices of each sample and there are no placeholders,
+                # input_ids.size() = (NC1+NC2+ ... +NC_B, max_len) unless all samples have the same number of choices
+                choice_counts = logit_mask.view(-1)
+                B = choice_counts.size(0)
+                row_counts = choice_counts + 1 if late_interaction else choice_counts
+                choice_offsets = [0] + torch.cumsum(row_counts, dim=0)[:-1].tolist()
+            else:
+                choice_counts = None
+                num_choices = input_ids.size(1) - 1 if late_interaction else input_ids.size(1)
+                B = input_ids.size(0)
+                choice_offsets = [b*input_ids.size(1) for b in range(B)]
+            input_ids = input_ids.view(-1, input_ids.size(-1))
+            token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1))
+            attention_mask = attention_mask.view(input_ids.size(0), -1, attention_mask.size(-1))
 
             # If different batches have different number of imgs, then vis_feats, vis_pe will be flattened (by torch.cat) in collate function
             # Otherwise, reshape them here:
-            if context[0] in ['img', 'both'] and vis_feats.size()[-1] > 1:
+            if context[0] in ['img', 'both'] and vis_feats.size()[-1] > 1 and vis_lens is None and not questions_only:
                 vis_seq_len, vis_dim = vis_feats.size()[-2:]
                 vis_feats = vis_feats.view(-1, vis_seq_len, vis_dim)
                 vis_pe = vis_pe.view(-1, vis_seq_len, vis_dim)
 
             proc_cxt_modality_label = []
-            offset = 0
-            for l in cxt_modality_label:
+            for l, offset in zip(cxt_modality_label, choice_offsets):
                 for idx in l:
-                    proc_cxt_modality_label.append(idx + offset*num_choices)
-                offset += 1
+                    proc_cxt_modality_label.append(idx + offset)
             cxt_modality_label = proc_cxt_modality_label
 
 
@@ -1117,6 +1337,29 @@ class BertForWebqa(PreTrainedBertModel):
                     f1 = 2*pr*re / (pr+re+1e-5)
                     th_dict[th] = [torch.sum(pr).item(), torch.sum(re).item(), torch.sum(f1).item()]
                 return th_dict, pred.detach().cpu()
+
+            def sum_per_sample(x, choice_counts):
+                # x: NC1+NC2+ ... +NC_B --> B
+                sample_idx = torch.repeat_interleave(torch.arange(choice_counts.size(0), device=x.device), choice_counts)
+                return x.new_zeros(choice_counts.size(0)).index_add_(0, sample_idx, x)
+            def ragged_cross_entropy_with_logits_loss(prediction, target, choice_counts):
+                # prediction, target: (NC1+NC2+ ... +NC_B) x 2
+                m = F.log_softmax(prediction, dim=-1) * target
+                loss = sum_per_sample((-m).sum(dim=-1), choice_counts)/(choice_counts.type_as(m)+1e-8)
+                return torch.mean(loss)
+            def ragged_filter_metric(prediction, target, choice_counts, th_list):
+                # same as filter_metric, pred is split into one tensor of num_choices scores per sample
+                pred = F.softmax(prediction, dim=-1)[:, 0]
+                label = target[:, 0]
+                th_dict = {}
+                for th in th_list:
+                    cur_pred = (pred>th).float()
+                    overlap = sum_per_sample(cur_pred * label, choice_counts)
+                    pr = overlap / (sum_per_sample(cur_pred, choice_counts) + 1e-5)
+                    re = overlap / (sum_per_sample(label, choice_counts) + 1e-5)
+                    f1 = 2*pr*re / (pr+re+1e-5)
+                    th_dict[th] = [torch.sum(pr).item(), torch.sum(re).item(), torch.sum(f1).item()]
+                return th_dict, list(pred.detach().cpu().split(choice_counts.tolist()))
             
             #print("vis_pe.size() = ", vis_pe.size())
             #print("vis_feats.size() = ", vis_feats.size())
@@ -1124,13 +1367,47 @@ class BertForWebqa(PreTrainedBertModel):
             #print("cxt_modality_label.size() = ", np.array(cxt_modality_label).size) 
             if context in ['img', 'both']: assert cxt_modality_label.size() == vis_feats.size() == vis_pe.size()
             #time.sleep(2)
-            sequence_output, pooled_output = self.bert(vis_feats, vis_pe, input_ids, token_type_ids,\
-                                            attention_mask, context[0], cxt_modality_label, output_all_encoded_layers=False, max_len_img_cxt=self.max_len_img_cxt)
-            # calculate classification loss for filter function
-            # vqa2_embed = pooled_output
-            cls_embed = sequence_output[:, 0] #*sequence_output[:, self.max_len_a+1] 
-            # Don't do multiplication for not cuz cxt_meta wasn't padded to fixed length during preprocessing
-            cls_pred = self.context_classifier(cls_embed) # B*num_choices x 2
+            if late_interaction:
+                question_rows = set(choice_offsets)
+                choice_rows = torch.tensor([r for r in range(input_ids.size(0)) if r not in question_rows], device=input_ids.device)
+                question_index = torch.repeat_interleave(torch.arange(B, device=input_ids.device),
+                                                         choice_counts if choice_counts is not None else torch.full((B,), num_choices, dtype=torch.long, device=input_ids.device))
+                question_rows = torch.tensor(choice_offsets, device=input_ids.device)
+            if late_interaction and questions_only:
+                # the choices are encoded already, encode the question rows cut to the longest question
+                q_ids, q_types, q_mask = input_ids[question_rows], token_type_ids[question_rows], attention_mask[question_rows]
+                q_len = int((q_ids != 0).sum(0).nonzero().max()) + 1
+                q_ids, q_types = q_ids[:, :q_len], q_types[:, :q_len]
+                if not is_span_attention_mask(q_mask):
+                    q_mask = q_mask[:, :q_len, :q_len]
+                sequence_output, pooled_output = self.bert(None, None, q_ids, q_types,\
+                                                q_mask, 'txt', [], output_all_encoded_layers=False, max_len_img_cxt=self.max_len_img_cxt)
+                question_emb, question_mask = self.late_interaction_embed(sequence_output, q_mask)
+                if return_question_embeddings:
+                    return question_emb, question_mask
+                choice_emb, choice_mask = choice_embeddings
+                cls_pred = self.late_interaction_score(question_emb, question_mask, choice_emb.type_as(question_emb), choice_mask, question_index) # B*num_choices x 2
+            else:
+                sequence_output, pooled_output = self.bert(vis_feats, vis_pe, input_ids, token_type_ids,\
+                                                attention_mask, context[0], cxt_modality_label, output_all_encoded_layers=False, max_len_img_cxt=self.max_len_img_cxt, vis_lens=vis_lens)
+                # calculate classification loss for filter function
+                if late_interaction:
+                    token_emb, token_mask = self.late_interaction_embed(sequence_output, attention_mask)
+                    if return_choice_embeddings:
+                        return token_emb[choice_rows], token_mask[choice_rows]
+                    cls_pred = self.late_interaction_score(token_emb[question_rows], token_mask[question_rows],
+                                                           token_emb[choice_rows], token_mask[choice_rows], question_index) # B*num_choices x 2
+                else:
+                    # vqa2_embed = pooled_output
+                    cls_embed = sequence_output[:, 0] #*sequence_output[:, self.max_len_a+1] 
+                    # Don't do multiplication for not cuz cxt_meta wasn't padded to fixed length during preprocessing
+                    cls_pred = self.context_classifier(cls_embed) # B*num_choices x 2
+            if choice_counts is not None:
+                filter_label = filter_label.view(-1, 2)
+                if filter_infr_th is not None:
+                    return ragged_filter_metric(cls_pred, filter_label, choice_counts, filter_infr_th)
+                cls_loss = ragged_cross_entropy_with_logits_loss(cls_pred, filter_label, choice_counts)
+                return cls_loss.new(1).fill_(0), cls_loss
             cls_pred = cls_pred.view(-1, num_choices, 2)
             # cls_labels: B
             if filter_infr_th is not None:
@@ -1147,7 +1424,7 @@ class BertForWebqa(PreTrainedBertModel):
             #print("\ncxt_modality_label.size() = ", len(cxt_modality_label.size()))
             if isinstance(cxt_modality_label, list): cxt_modality_label = torch.squeeze(torch.LongTensor(cxt_modality_label), 1)
             sequence_output, pooled_output = self.bert(vis_feats, vis_pe, input_ids, token_type_ids,\
-                                            attention_mask, context[0], cxt_modality_label, output_all_encoded_layers=False, max_len_img_cxt=self.max_len_img_cxt)
+                                            attention_mask, context[0], cxt_modality_label, output_all_encoded_layers=False, max_len_img_cxt=self.max_len_img_cxt, vis_lens=vis_lens)
 
             def gather_seq_out_by_pos(seq, pos):
                 return torch.gather(seq, 1, pos.unsqueeze(2).expand(-1, -1, seq.size(-1)))
@@ -1247,19 +1524,27 @@ class BertForWebqaDecoder(PreTrainedBertModel):
             self.vis_pe_embed = nn.Sequential(nn.Linear(6+1601, config.hidden_size),
                                         nn.ReLU(),
                                         nn.Dropout(config.hidden_dropout_prob))
+        self.vis_embed_cache = None # VisEmbeddingCache.bind
     
 
 
-    def forward(self, vis_feats, vis_pe, input_ids, token_type_ids, position_ids, attention_mask, context=None, cxt_modality_label=None, task_idx=None, sample_mode='greedy', tokenizer=None):
+    def forward(self, vis_feats, vis_pe, input_ids, token_type_ids, position_ids, attention_mask, context=None, cxt_modality_label=None, task_idx=None, sample_mode='greedy', tokenizer=None, vis_lens=None, vis_keys=None):
         if context[0] in ['img', 'both'] and vis_feats.size()[-1] > 1: 
-            vis_feats = self.vis_embed(vis_feats) # image region features (NC1+NC2+ ... +NC_B, 100, hidden_size), NC = num_choices
-            vis_pe = self.vis_pe_embed(vis_pe) # image region positional encodings (NC1+NC2+ ... +NC_B, 100, hidden_size), NC = num_choices
+            if vis_lens is not None:
+                vis_feats, vis_pe, vis_lens = vis_feats.reshape(-1, vis_feats.size(-1)), vis_pe.reshape(-1, vis_pe.size(-1)), vis_lens.view(-1)
+            # features may be shipped in half precision, embed_vis_features upcasts them to the embedding weights
+            # image region features / positional encodings (NC1+NC2+ ... +NC_B, 100, hidden_size), NC = num_choices
+            vis_feats, vis_pe = embed_vis_features(self, vis_feats, vis_pe, vis_lens, vis_keys)
             # They are flattened in collate function
         
         if isinstance(cxt_modality_label, list): cxt_modality_label = torch.squeeze(torch.LongTensor(cxt_modality_label), 1)
 
+        if is_span_attention_mask(attention_mask):
+            # the decoding steps slice rows and columns out of the full max_len x max_len mask
+            attention_mask = expand_span_attention_mask(attention_mask, token_type_ids.size(1))
+
         if self.search_beam_size > 1:
-            return self.beam_search(vis_feats, vis_pe, input_ids, token_type_ids, position_ids, attention_mask, context, cxt_modality_label, task_idx)
+            return self.beam_search(vis_feats, vis_pe, input_ids, token_type_ids, position_ids, attention_mask, context, cxt_modality_label, task_idx, vis_lens=vis_lens)
         input_shape = list(input_ids.size())
         batch_size = input_shape[0]
         input_length = input_shape[1]
@@ -1286,7 +1571,7 @@ class BertForWebqaDecoder(PreTrainedBertModel):
             new_embedding, new_encoded_layers, _ = \
                 self.bert(vis_feats, vis_pe, x_input_ids, curr_token_type_ids, curr_position_ids, curr_attention_mask, 
                 context[0], cxt_modality_label, prev_embedding=prev_embedding, prev_encoded_layers=prev_encoded_layers, 
-                output_all_encoded_layers=True, max_len_img_cxt=self.max_len_img_cxt)
+                output_all_encoded_layers=True, max_len_img_cxt=self.max_len_img_cxt, vis_lens=vis_lens)
 
             last_hidden = new_encoded_layers[-1][:, -1:, :]
             prediction_scores, _ = self.cls(
@@ -1333,7 +1618,7 @@ class BertForWebqaDecoder(PreTrainedBertModel):
         #return torch.cat(output_ids, dim=1), torch.cat(output_probs, dim=1)
 
 
-    def beam_search(self, vis_feats, vis_pe, input_ids, token_type_ids, position_ids, attention_mask, context, cxt_modality_label, task_idx=None):
+    def beam_search(self, vis_feats, vis_pe, input_ids, token_type_ids, position_ids, attention_mask, context, cxt_modality_label, task_idx=None, vis_lens=None):
 
         input_shape = list(input_ids.size()) # batch_size x (max_len_a+2)
         batch_size = input_shape[0]
@@ -1369,7 +1654,7 @@ class BertForWebqaDecoder(PreTrainedBertModel):
             new_embedding, new_encoded_layers, _ = \
                 self.bert(vis_feats, vis_pe, x_input_ids, curr_token_type_ids, curr_position_ids, curr_attention_mask, 
                 context[0], cxt_modality_label, prev_embedding=prev_embedding, prev_encoded_layers=prev_encoded_layers, 
-                output_all_encoded_layers=True, max_len_img_cxt=self.max_len_img_cxt)
+                output_all_encoded_layers=True, max_len_img_cxt=self.max_len_img_cxt, vis_lens=vis_lens)
             # compared with BertModel, BertModelIncr returns an additional embedding_output from forward()
             # new_encoded_layers == sequence_output
 
@@ -2077,3 +2362,65 @@ class BertForQuestionAnswering(PreTrainedBertModel):
             return total_loss
         else:
             return start_logits, end_logits
+
+
+if __name__ == "__main__":
+    # parity test of the sdpa self-attention, exits with 1 when it is further than the tolerance of the dtype from a float32
+    # matmul reference: full encoding, self-attention over history_states and incremental encoding (BertEncoder prev_embedding).
+    # In half precision the matmul path itself is off on fully masked rows (-10000 + score rounds to steps of 8), so the
+    # reference is float32 and the error of the matmul path is only printed
+    # python -m pytorch_pretrained_bert.modeling [--device cuda] [--dtype float16]
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=['float32', 'float16', 'bfloat16'])
+    parser.add_argument("--seq_len", type=int, default=448)
+    parser.add_argument("--atol", type=float, default=None, help="default: 1e-5 for float32, 2e-2 for float16 and 1e-1 for bfloat16 (rounding of 4 layers in half precision)")
+    args = parser.parse_args()
+    atol = args.atol if args.atol is not None else {'float32': 1e-5, 'float16': 2e-2, 'bfloat16': 1e-1}[args.dtype]
+
+    torch.manual_seed(0)
+    dtype = getattr(torch, args.dtype)
+    encoders = {}
+    for backend in ('matmul', 'sdpa'):
+        config = BertConfig(30522, hidden_size=256, num_hidden_layers=4, num_attention_heads=4, intermediate_size=1024, attention_backend=backend)
+        encoders[backend] = BertEncoder(config).to(args.device).eval()
+    encoders['sdpa'].load_state_dict(encoders['matmul'].state_dict())
+    encoders['reference'] = encoders['matmul']
+    encoders['matmul'] = copy.deepcopy(encoders['reference']).to(dtype)
+    encoders['sdpa'].to(dtype)
+
+    B, L, st, n_new = 4, args.seq_len, args.seq_len * 3 // 4, 8
+    spans = torch.tensor([[0, 101, 201, st - 10 * b, st - 10 * b, L] for b in range(B)], dtype=torch.int32)
+    mask = expand_span_attention_mask(spans, L)
+    # fully masked rows: the last query of every sample and the whole of the last sample
+    mask[:, -1] = 0
+    mask[-1] = 0
+    extended_mask = (1.0 - mask.unsqueeze(1).to(args.device, torch.float32)) * -10000.0
+    hidden_states = torch.randn(B, L, 256, device=args.device)
+
+    def run(encoder, x, m):
+        x, m = x.to(next(encoder.parameters()).dtype), m.to(next(encoder.parameters()).dtype)
+        full = encoder(x, m, output_all_encoded_layers=True)
+        # n_new queries attending to st positions of history_states and to themselves
+        history = encoder.layer[0].attention.self(x[:, st:st+n_new], m[:, :, st:st+n_new, :st+n_new], history_states=x[:, :st])
+        # one decoding step on top of the first st positions
+        incr = encoder(x[:, st:st+1], m[:, :, st:st+1, :st+1], prev_embedding=x[:, :st],
+                       prev_encoded_layers=[o[:, :st] for o in full], output_all_encoded_layers=False)[-1]
+        return {'full': full, 'history_states': [history], 'incremental': [incr]}
+
+    with torch.no_grad():
+        outputs = {backend: run(encoder, hidden_states, extended_mask) for backend, encoder in encoders.items()}
+    failed = False
+    for name in ('full', 'history_states', 'incremental'):
+        diff = {}
+        for backend in ('matmul', 'sdpa'):
+            pairs = list(zip(outputs[backend][name], outputs['reference'][name]))
+            finite = all(torch.isfinite(a).all().item() for a, _ in pairs)
+            diff[backend] = max((a.float() - b).abs().max().item() for a, b in pairs) if finite else float('nan')
+        ok = diff['sdpa'] <= atol
+        failed = failed or not ok
+        print("{}: max abs diff to float32 matmul, sdpa {:.2e}, matmul {:.2e} (atol {:.0e}){}".format(
+            name, diff['sdpa'], diff['matmul'], atol, '' if ok else ' FAILED'))
+    sys.exit(1 if failed else 0)
@@ -25,6 +25,7 @@ from __future__ import print_function
 import collections
 import unicodedata
 import os
+import re
 import logging
 
 from .file_utils import cached_path
@@ -51,6 +52,14 @@ PRETRAINED_VOCAB_POSITIONAL_EMBEDDINGS_SIZE_MAP = {
 }
 VOCAB_NAME = 'vocab.txt'
 
+# ASCII fast path of BasicTokenizer: control characters are dropped, \t \n \r become spaces
+_ASCII_CLEAN_TABLE = dict([(cp, None) for cp in list(range(32)) + [127]] + [(ord(c), ' ') for c in '\t\n\r'])
+# the ASCII ranges _is_punctuation treats as punctuation, one token per punctuation char
+_ASCII_PUNC_SPLIT = re.compile(r'[!-/:-@\[-`{-~]|[^!-/:-@\[-`{-~]+')
+_NON_ASCII = re.compile(r'[^\x00-\x7f]')
+# key of the WordPiece trie nodes that end a vocab token
+_TRIE_END = None
+
 
 def load_vocab(vocab_file):
     """Loads a vocabulary file into a dictionary."""
@@ -87,7 +96,7 @@ def whitespace_tokenize(text):
 class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
-    def __init__(self, vocab_file, do_lower_case=True, max_len=None, never_split=("[UNK]", "[SEP]", "[X_SEP]", "[PAD]", "[CLS]", "[MASK]")):
+    def __init__(self, vocab_file, do_lower_case=True, max_len=None, never_split=("[UNK]", "[SEP]", "[X_SEP]", "[PAD]", "[CLS]", "[MASK]"), fast=True):
         if not os.path.isfile(vocab_file):
             raise ValueError(
                 "Can't find a vocabulary file at path '{}'. To load the vocabulary from a Google pretrained "
@@ -97,8 +106,8 @@ class BertTokenizer(object):
         self.ids_to_tokens = collections.OrderedDict(
             [(ids, tok) for tok, ids in self.vocab.items()])
         self.basic_tokenizer = BasicTokenizer(
-            do_lower_case=do_lower_case, never_split=never_split)
-        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+            do_lower_case=do_lower_case, never_split=never_split, fast=fast)
+        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab, fast=fast)
         self.max_len = max_len if max_len is not None else int(1e12)
 
     def tokenize(self, text):
@@ -110,14 +119,15 @@ class BertTokenizer(object):
 
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
-        ids = []
         #print(len(tokens))
         #if len(tokens)<200: print(tokens)
-        for token in tokens:
-            if token not in self.vocab:
-                print("\nproblematic tokens = ", tokens)
-                raise ValueError("token not in self.vocab ", token)
-            ids.append(self.vocab[token])
+        try:
+            ids = [self.vocab[token] for token in tokens]
+        except KeyError:
+            for token in tokens:
+                if token not in self.vocab:
+                    print("\nproblematic tokens = ", tokens)
+                    raise ValueError("token not in self.vocab ", token)
         if len(ids) > self.max_len:
             raise ValueError(
                 "Token indices sequence length is longer than the specified maximum "
@@ -181,17 +191,22 @@ class WhitespaceTokenizer(object):
 class BasicTokenizer(object):
     """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
-    def __init__(self, do_lower_case=True, never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]")):
+    def __init__(self, do_lower_case=True, never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"), fast=True):
         """Constructs a BasicTokenizer.
 
         Args:
           do_lower_case: Whether to lower case the input.
+          fast: Tokenize pure ASCII text with str.translate / a regex instead of
+            looking up every character in unicodedata. Same output.
         """
         self.do_lower_case = do_lower_case
         self.never_split = never_split
+        self.fast = fast
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
+        if self.fast and _NON_ASCII.search(text) is None:
+            return self._tokenize_ascii(text)
         text = self._clean_text(text)
         # This was added on November 1st, 2018 for the multilingual and Chinese
         # models. This is also applied to the English models now, but it doesn't
@@ -211,6 +226,18 @@ class BasicTokenizer(object):
         output_tokens = whitespace_tokenize(" ".join(split_tokens))
         return output_tokens
 
+    def _tokenize_ascii(self, text):
+        """tokenize() for ASCII text, which has no CJK characters and no accents to strip."""
+        output_tokens = []
+        for token in text.translate(_ASCII_CLEAN_TABLE).split():
+            if self.do_lower_case and token not in self.never_split:
+                token = token.lower()
+            if token in self.never_split:
+                output_tokens.append(token)
+            else:
+                output_tokens.extend(_ASCII_PUNC_SPLIT.findall(token))
+        return output_tokens
+
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
         text = unicodedata.normalize("NFD", text)
@@ -296,10 +323,59 @@ class BasicTokenizer(object):
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
-    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100, fast=True, max_cached_words=100000):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        # fast: longest match by walking a prefix trie of the vocab, and the pieces of
+        # up to max_cached_words words memoized (the cache is emptied when it is full)
+        self.fast = fast
+        self.max_cached_words = max_cached_words
+        self._tries = None
+        self._cache = {}
+
+    def __getstate__(self):
+        # the tries and the cache are rebuilt on demand, keep them out of the pickles sent to workers
+        state = self.__dict__.copy()
+        state['_tries'] = None
+        state['_cache'] = {}
+        return state
+
+    def _build_tries(self):
+        """Prefix tries of the vocab for the first piece of a word and for the "##" pieces."""
+        word_start, word_piece = {}, {}
+        for token in self.vocab:
+            for trie, key in ((word_start, token), (word_piece, token[2:] if token.startswith("##") else None)):
+                if key is None:
+                    continue
+                node = trie
+                for char in key:
+                    node = node.setdefault(char, {})
+                node[_TRIE_END] = token
+        self._tries = (word_start, word_piece)
+
+    def _tokenize_word(self, token):
+        """Greedy longest-match-first pieces of a single word, looked up in the tries."""
+        if len(token) > self.max_input_chars_per_word:
+            return [self.unk_token]
+        trie, word_piece = self._tries
+        sub_tokens = []
+        start = 0
+        while start < len(token):
+            node = trie
+            cur_substr = None
+            for end in range(start, len(token)):
+                node = node.get(token[end])
+                if node is None:
+                    break
+                if _TRIE_END in node:
+                    cur_substr, cur_end = node[_TRIE_END], end + 1
+            if cur_substr is None:
+                return [self.unk_token]
+            sub_tokens.append(cur_substr)
+            start = cur_end
+            trie = word_piece
+        return sub_tokens
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -319,6 +395,19 @@ class WordpieceTokenizer(object):
           A list of wordpiece tokens.
         """
 
+        if self.fast:
+            if self._tries is None:
+                self._build_tries()
+            output_tokens = []
+            for token in whitespace_tokenize(text):
+                sub_tokens = self._cache.get(token)
+                if sub_tokens is None:
+                    if len(self._cache) >= self.max_cached_words:
+                        self._cache.clear()
+                    sub_tokens = self._cache[token] = tuple(self._tokenize_word(token))
+                output_tokens.extend(sub_tokens)
+            return output_tokens
+
         output_tokens = []
         for token in whitespace_tokenize(text):
             chars = list(token)
@@ -393,3 +482,42 @@ def _is_punctuation(char):
     if cat.startswith("P"):
         return True
     return False
+
+
+def _json_strings(x):
+    if isinstance(x, str):
+        yield x
+    elif isinstance(x, dict):
+        for v in x.values():
+            yield from _json_strings(v)
+    elif isinstance(x, list):
+        for v in x:
+            yield from _json_strings(v)
+
+
+if __name__ == "__main__":
+    # parity check of the fast tokenizer against the reference implementation:
+    # python -m pytorch_pretrained_bert.tokenization --vocab_file <vocab.txt> --texts <WebQA_data.json or text files>
+    import argparse
+    import json
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_file", type=str, required=True)
+    parser.add_argument("--texts", type=str, nargs='+', required=True, help="json files (every string in them) or text files (one text per line)")
+    parser.add_argument("--no_lower_case", action='store_true')
+    args = parser.parse_args()
+
+    texts = []
+    for path in args.texts:
+        with open(path, "r", encoding="utf-8") as f:
+            texts.extend(_json_strings(json.load(f)) if path.endswith(".json") else f.read().splitlines())
+    timings, outputs = {}, {}
+    for fast in (False, True):
+        tokenizer = BertTokenizer(args.vocab_file, do_lower_case=not args.no_lower_case, fast=fast)
+        t0 = time.time()
+        outputs[fast] = [tokenizer.tokenize(t) for t in texts]
+        timings[fast] = time.time() - t0
+    mismatches = [i for i in range(len(texts)) if outputs[False][i] != outputs[True][i]]
+    for i in mismatches[:10]:
+        print("mismatch: {!r}\n  reference {}\n  fast      {}".format(texts[i], outputs[False][i], outputs[True][i]))
+    print("{} texts, {} mismatches, reference {:.2f}s, fast {:.2f}s".format(len(texts), len(mismatches), timings[False], timings[True]))
@@ -1,9 +1,17 @@
-import math
+import math, mmap
 import json, os, base64
 import os.path as op
 import numpy as np
 import torch
 
+def build_lineidx_npy(lineidx_file):
+    """ One-time conversion of a text .lineidx into the .lineidx.npy int64 array that TSVFile memory-maps """
+    lineidx = np.fromfile(lineidx_file, dtype=np.int64, sep='\n')
+    np.save(lineidx_file + '.npy', lineidx)
+    print("wrote {} offsets to {}.npy".format(len(lineidx), lineidx_file))
+    return lineidx_file + '.npy'
+
+
 class TSVFile(object):
     def __init__(self, tsv_file):
         self.tsv_file = tsv_file
@@ -19,6 +27,14 @@ class TSVFile(object):
         if self._fp:
             self._fp.close()
 
+    def __getstate__(self):
+        # DataLoader workers open the tsv and map the line index themselves
+        state = self.__dict__.copy()
+        state['_fp'] = None
+        state['_lineidx'] = None
+        state['pid'] = None
+        return state
+
     def __str__(self):
         return "TSVFile(tsv_file='{}')".format(self.tsv_file)
 
@@ -38,15 +54,15 @@ class TSVFile(object):
             #logging.info('{}-{}'.format(self.tsv_file, idx))
             print("\nseek error, lineidx file = {}, with {} lines, idx = {}".format(self.tsv_file, len(self._lineidx), idx))
             raise
-        self._fp.seek(pos)
+        self._fp.seek(int(pos))
         return [s.strip() for s in self._fp.readline().split('\t')]
 
     def seek_first_column(self, idx):
         self._ensure_tsv_opened()
         self._ensure_lineidx_loaded()
         pos = self._lineidx[idx]
-        self._fp.seek(pos)
-        row = fp.readline().strip().split('\t')
+        self._fp.seek(int(pos))
+        row = self._fp.readline().strip().split('\t')
         return int(row[0])
 
     def get_imgid(self, idx):
@@ -60,9 +76,12 @@ class TSVFile(object):
 
     def _ensure_lineidx_loaded(self):
         if self._lineidx is None:
-            print('loading lineidx: {}'.format(self.lineidx))
-            with open(self.lineidx, 'r') as fp:
-                self._lineidx = [int(i.strip()) for i in fp.readlines()]
+            if op.isfile(self.lineidx + '.npy'):
+                # memory-mapped, the pages are shared by all workers reading this tsv
+                self._lineidx = np.load(self.lineidx + '.npy', mmap_mode='r')
+            else:
+                print('loading lineidx: {} (run build_lineidx_npy once to memory-map it instead)'.format(self.lineidx))
+                self._lineidx = np.fromfile(self.lineidx, dtype=np.int64, sep='\n')
                 print("\nlineidx file {} is open, find {} lines".format(self.tsv_file, len(self._lineidx)))
 
     def _ensure_tsv_opened(self):
@@ -72,6 +91,7 @@ class TSVFile(object):
 
         if self.pid != os.getpid():
             print('re-open {} because the process id changed'.format(self.tsv_file))
+            self._fp.close()
             self._fp = open(self.tsv_file, 'r')
             self.pid = os.getpid()
 
@@ -109,3 +129,112 @@ class ImgDataTsv(object):
         assert not row[0] == 'None' "Trying to access a non-existing image_id={} from file {}".format(idx, self.img_file)
         pred = json.loads(row[-1])['objects']
         return pred
+
+
+class ImgDataBin(object):
+    """ Drop-in replacement of ImgDataTsv over the base64-free layout written by convert_tsv_to_bin:
+        <prefix>.feat.bin    (num_regions, 2048 + num_cls) fc1_features | cls_features, float16 or float32
+        <prefix>.box.bin     (num_regions, 5) rect | conf, float32
+        <prefix>.offsets.npy (num_rows, 3) int64 first region, number of regions (-1 if the row is None), image id
+        Unlike ImgDataTsv, the features are returned in the stored dtype.
+    """
+    def __init__(self, img_file):
+        self.img_file = img_file
+        self.prefix = img_file[:-len('.feat.bin')] if img_file.endswith('.feat.bin') else img_file
+        with open(self.prefix + '.meta.json', 'r') as f:
+            self.meta = json.load(f)
+        self._feat = None
+        self._box = None
+        self._offsets = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_feat'] = None
+        state['_box'] = None
+        state['_offsets'] = None
+        state['pid'] = None
+        return state
+
+    def __len__(self):
+        self._ensure_opened()
+        return len(self._offsets)
+
+    def __getitem__(self, idx):
+        self._ensure_opened()
+        start, n, _ = self._offsets[idx]
+        assert n >= 0, "Trying to access a non-existing image_id={} from file {}".format(idx, self.img_file)
+        feat = torch.from_numpy(self._feat[start:start+n])
+        box = torch.from_numpy(self._box[start:start+n])
+        fc1_dim = self.meta['fc1_dim']
+        # features stay in the stored dtype, the processor casts them to its feature_dtype
+        return box[:, :4], box[:, 4], feat[:, :fc1_dim], feat[:, fc1_dim:]
+
+    def get_imgid(self, idx):
+        self._ensure_opened()
+        return int(self._offsets[idx][2])
+
+    def _ensure_opened(self):
+        if self.pid != os.getpid():
+            self._feat = self._map(self.prefix + '.feat.bin', self.meta['dtype'], self.meta['fc1_dim'] + self.meta['cls_dim'])
+            self._box = self._map(self.prefix + '.box.bin', 'float32', 5)
+            self._offsets = np.load(self.prefix + '.offsets.npy', mmap_mode='r')
+            self.pid = os.getpid()
+
+    @staticmethod
+    def _map(path, dtype, dim):
+        if os.path.getsize(path) == 0:
+            # mmap can't map an empty file, e.g. a shard without regions
+            return np.empty((0, dim), dtype=np.dtype(dtype))
+        with open(path, 'rb') as fp:
+            # copy-on-write: np.frombuffer gives writable arrays that torch.from_numpy accepts without copying
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+        return np.frombuffer(buf, dtype=np.dtype(dtype)).reshape(-1, dim)
+
+
+def open_img_data(img_file):
+    """ ImgDataTsv for .tsv files, ImgDataBin for files converted by convert_tsv_to_bin """
+    if img_file.endswith('.tsv'):
+        return ImgDataTsv(img_file)
+    return ImgDataBin(img_file)
+
+
+def convert_tsv_to_bin(tsv_file, output_prefix, dtype='float16'):
+    img_data = ImgDataTsv(tsv_file)
+    offsets = np.zeros((len(img_data), 3), dtype=np.int64)
+    num_regions = 0
+    fc1_dim = cls_dim = None
+    with open(output_prefix + '.feat.bin', 'wb') as feat_fp, open(output_prefix + '.box.bin', 'wb') as box_fp:
+        for idx in range(len(img_data)):
+            row = img_data.img_tsv.seek(idx)
+            if row[0] == 'None':
+                offsets[idx] = (num_regions, -1, -1)
+                continue
+            pred_boxes, scores, fc1_features, cls_features = img_data[idx]
+            fc1_dim, cls_dim = fc1_features.size(-1), cls_features.size(-1)
+            feat = torch.cat((fc1_features, cls_features), dim=-1).numpy().astype(dtype)
+            box = torch.cat((pred_boxes.view(-1, 4), scores.view(-1, 1)), dim=-1).numpy().astype(np.float32)
+            feat_fp.write(feat.tobytes())
+            box_fp.write(box.tobytes())
+            offsets[idx] = (num_regions, len(feat), int(row[0]))
+            num_regions += len(feat)
+            if (idx+1) % 10000 == 0:
+                print("{}: {}/{} images".format(tsv_file, idx+1, len(img_data)))
+    np.save(output_prefix + '.offsets.npy', offsets)
+    with open(output_prefix + '.meta.json', 'w') as f:
+        json.dump({'dtype': np.dtype(dtype).name, 'fc1_dim': fc1_dim, 'cls_dim': cls_dim, 'num_regions': num_regions}, f)
+    print("converted {} images / {} regions from {} to {}.feat.bin".format(len(img_data), num_regions, tsv_file, output_prefix))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert a VinVL tsv into the binary layout read by ImgDataBin")
+    parser.add_argument('--tsv', type=str, required=True)
+    parser.add_argument('--output_prefix', type=str, default=None, help="defaults to the tsv path without .tsv")
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'])
+    parser.add_argument('--build_lineidx', action='store_true', help="only write <name>.lineidx.npy next to the tsv's .lineidx")
+    args = parser.parse_args()
+    if args.build_lineidx:
+        build_lineidx_npy(args.tsv.replace('.tsv', '.lineidx'))
+    else:
+        convert_tsv_to_bin(args.tsv, args.output_prefix or args.tsv.replace('.tsv', ''), args.dtype)
@@ -0,0 +1,156 @@
+"""Approximate inner-product search for the open-pool retrieval of the filter choices.
+
+IVFIndex is an inverted-file index in numpy. k-means splits the vectors into
+nlist lists, and a query only scores the vectors of its nprobe nearest lists.
+With faiss installed, backend 'faiss' builds the equivalent faiss.IndexIVFFlat.
+Backend 'exact' scores every vector.
+
+Check how many of the exact top-k neighbours the index finds, using a sample of
+the choice embeddings of a candidate index as the queries:
+    python -m vlp.ann_index --candidate_index_dir <index_dir> --nprobe 8 --k 10
+"""
+
+import argparse
+import numpy as np
+
+
+def _nearest_centroids(x, centroids, n=1, batch_size=65536):
+    """ (len(x), n) ids of the n nearest centroids (L2) of every row of x """
+    half_sq_norms = 0.5 * (centroids ** 2).sum(1)
+    out = np.empty((len(x), n), dtype=np.int64)
+    for st in range(0, len(x), batch_size):
+        d = half_sq_norms[None] - x[st:st+batch_size] @ centroids.T
+        if n == 1:
+            out[st:st+batch_size, 0] = d.argmin(1)
+        else:
+            part = np.argpartition(d, n-1, axis=1)[:, :n]
+            out[st:st+batch_size] = np.take_along_axis(part, np.take_along_axis(d, part, 1).argsort(1), 1)
+    return out
+
+
+def kmeans(x, k, niter=10, seed=0, max_points_per_centroid=256):
+    """ k centroids of the rows of x, trained on a sample of at most k * max_points_per_centroid rows """
+    rng = np.random.RandomState(seed)
+    if len(x) > k * max_points_per_centroid:
+        x = x[rng.choice(len(x), k * max_points_per_centroid, replace=False)]
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(niter):
+        assign = _nearest_centroids(x, centroids)[:, 0]
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed the empty lists with random points
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()))]
+    return centroids
+
+
+class ExactIndex(object):
+    def __init__(self, vectors):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k):
+        """ (scores, ids) of the k largest inner products of every query, best first """
+        return _top_k(np.asarray(queries, dtype=np.float32) @ self.vectors.T, np.arange(len(self.vectors))[None], k)
+
+
+class IVFIndex(object):
+    def __init__(self, vectors, nlist=None, nprobe=8, niter=10, seed=0):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if nlist is None:
+            nlist = int(4 * np.sqrt(len(vectors)))
+        self.nlist = max(1, min(nlist, len(vectors)))
+        self.nprobe = min(nprobe, self.nlist)
+        self.centroids = kmeans(vectors, self.nlist, niter=niter, seed=seed)
+        assign = _nearest_centroids(vectors, self.centroids)[:, 0]
+        # vectors sorted by list, list l holds rows offsets[l]:offsets[l+1]
+        self.ids = np.argsort(assign, kind='stable')
+        self.vectors = vectors[self.ids]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=self.nlist))])
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k):
+        """ (scores, ids) of the k largest inner products of every query among the vectors of its nprobe nearest lists,
+            best first. Missing neighbours have id -1 and score -inf """
+        queries = np.asarray(queries, dtype=np.float32)
+        probes = _nearest_centroids(queries, self.centroids, self.nprobe)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, (q, lists) in enumerate(zip(queries, probes)):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l+1]) for l in lists])
+            if len(rows) == 0:
+                continue
+            s, r = _top_k((self.vectors[rows] @ q)[None], rows[None], k)
+            scores[i, :s.shape[1]], ids[i, :s.shape[1]] = s[0], self.ids[r[0]]
+        return scores, ids
+
+
+class FaissIVFIndex(object):
+    def __init__(self, vectors, nlist=None, nprobe=8):
+        try:
+            import faiss
+        except ImportError:
+            raise ImportError("ann_index: backend faiss needs faiss installed (pip install faiss-cpu)")
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if nlist is None:
+            nlist = int(4 * np.sqrt(len(vectors)))
+        nlist = max(1, min(nlist, len(vectors)))
+        self.quantizer = faiss.IndexFlatL2(vectors.shape[1])
+        self.index = faiss.IndexIVFFlat(self.quantizer, vectors.shape[1], nlist, faiss.METRIC_INNER_PRODUCT)
+        self.index.train(vectors)
+        self.index.add(vectors)
+        self.index.nprobe = min(nprobe, nlist)
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def search(self, queries, k):
+        return self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+
+
+def _top_k(scores, ids, k):
+    """ Best first (scores, ids) of the k largest scores of every row, ids broadcast against scores """
+    ids = np.broadcast_to(ids, scores.shape)
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k-1, axis=1)[:, :k]
+    part = np.take_along_axis(part, np.argsort(-np.take_along_axis(scores, part, 1), axis=1), 1)
+    return np.take_along_axis(scores, part, 1), np.take_along_axis(ids, part, 1)
+
+
+def build_ann_index(vectors, backend='numpy', nlist=None, nprobe=8):
+    if backend == 'exact':
+        return ExactIndex(vectors)
+    if backend == 'faiss':
+        return FaissIVFIndex(vectors, nlist=nlist, nprobe=nprobe)
+    assert backend == 'numpy', "ann_index: unknown backend {}".format(backend)
+    return IVFIndex(vectors, nlist=nlist, nprobe=nprobe)
+
+
+def main():
+    from vlp.candidate_index import CandidateIndex
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--candidate_index_dir', type=str, required=True)
+    parser.add_argument('--backend', type=str, default='numpy', choices=['numpy', 'faiss'])
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--num_queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    candidate_index = CandidateIndex(args.candidate_index_dir)
+    vectors = candidate_index.pooled_embeddings(list(candidate_index.entries))
+    queries = vectors[np.random.RandomState(0).choice(len(vectors), min(args.num_queries, len(vectors)), replace=False)]
+    _, exact_ids = ExactIndex(vectors).search(queries, args.k)
+    _, ann_ids = build_ann_index(vectors, args.backend, nlist=args.nlist, nprobe=args.nprobe).search(queries, args.k)
+    recall = np.mean([len(set(a) & set(e)) / float(len(e)) for a, e in zip(ann_ids.tolist(), exact_ids.tolist())])
+    print("{} choices, {} queries: {} nprobe={} finds {:.4f} of the exact top {}".format(len(vectors), len(queries), args.backend, args.nprobe, recall, args.k))
+
+
+if __name__ == "__main__":
+    main()
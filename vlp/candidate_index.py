@@ -0,0 +1,321 @@
+"""On-disk index of the late-interaction embeddings of the filter choices.
+
+Snippets (by snippet_id) and images (by image_id) show up as choices of many
+questions. A model trained with --filter_scoring late_interaction encodes the
+choices without the question, so every distinct choice only needs to be encoded
+once. An index directory contains
+
+    meta.json          embedding dim, storage dtype, number of choices and tokens
+    index.json         {choice key: [row, n_tokens]}, keys are str(snippet_id) / str(image_id)
+    embeddings.bin     row-major (n_tokens, dim) token embeddings of all choices
+
+Build it with the fine-tuned model, in inference mode of the run scripts
+    python run_webqa.py ... --filter_scoring late_interaction --recover_step <step> --build_candidate_index <index_dir>
+then score the questions against it (one question-only pass per sample)
+    python run_webqa.py ... --filter_scoring late_interaction --recover_step <step> --candidate_index_dir <index_dir>
+and rerank the top-k choices of every question with a cross-encoder checkpoint
+    python run_webqa.py ... --recover_step <step> --rerank_choices_json <output json of the previous step> --rerank_top_k 5
+
+With --open_pool_top_n the choices of a question are not its own fixed lists but are retrieved
+from all the distinct choices of the dataset: an ANN search (vlp.ann_index) of the mean question
+token embedding among the mean token embeddings of the choices, followed by exact late-interaction
+scores of the --ann_candidates best matches. The output json can be reranked the same way.
+"""
+
+import os
+import copy
+import json
+import numpy as np
+import torch
+
+from vlp.feature_store import image_id_from_path, STORAGE_DTYPES, to_storage, from_storage
+from vlp.ann_index import build_ann_index
+
+
+def image_key(img):
+    """ x101fpn instances hold <image_id>.pkl paths, VinVL instances hold the image_id """
+    return str(image_id_from_path(img)) if isinstance(img, str) else str(img)
+
+
+def instance_choices(instance):
+    """ [(key, 'txt', fact dict) or (key, 'img', (img, cxt))] for all choices of a filter instance """
+    gold, distractors, gold_cxt_list, distractor_cxt_list = instance[:4]
+    context = instance[7]
+    if context == 'txt':
+        return [(str(f['snippet_id']), 'txt', f) for f in list(gold) + list(distractors)]
+    if context == 'img':
+        imgs = list(zip(list(gold) + list(distractors), list(gold_cxt_list) + list(distractor_cxt_list)))
+        return [(image_key(img), 'img', (img, cxt)) for img, cxt in imgs]
+    assert context == 'both', "candidate_index: not a filter instance, context = {}".format(context)
+    return [(str(f['snippet_id']), 'txt', f) for f in list(gold) + list(distractors)] + \
+        [(image_key(img), 'img', (img, cxt)) for img, cxt in list(gold_cxt_list) + list(distractor_cxt_list)]
+
+
+def choice_keys(ori_choices):
+    """ Keys of the choices of one sample in the order of its choice rows (VinVL img samples wrap them in one more list) """
+    if len(ori_choices) == 1 and isinstance(ori_choices[0], (list, tuple)):
+        ori_choices = ori_choices[0]
+    return [str(c) for c in ori_choices]
+
+
+def batch_choice_keys(ori_choices, num_choices=None):
+    """ Keys of all choice rows of a batch. Samples padded with placeholder copies of their last choice
+        (num_choices rows each) repeat their last key """
+    if isinstance(ori_choices, torch.Tensor): # collated VinVL image ids
+        ori_choices = ori_choices.tolist()
+    keys = []
+    for c in ori_choices:
+        c = choice_keys(c)
+        if num_choices is not None:
+            c = c + c[-1:] * (num_choices - len(c))
+        keys.extend(c)
+    return keys
+
+
+class CandidateDataset(torch.utils.data.Dataset):
+    """ The distinct choices of one modality ('txt' / 'img') of the instances of a filter dataset, as filter instances
+        of up to num_choices choices with an empty question. skip_keys are left out (e.g. already in the index).
+        Long choices are always cut from the tail, so a choice gets the same embedding whichever run encodes it """
+    def __init__(self, dataset, num_choices, modality, skip_keys=()):
+        super().__init__()
+        self.processor = copy.copy(dataset.processor)
+        self.processor.always_truncate_tail = True
+        self.device = getattr(dataset, 'device', None)
+        self.num_choices = num_choices
+        seen = set(skip_keys)
+        choices = []
+        for instance in dataset.instance_list:
+            for key, m, c in instance_choices(instance):
+                if m == modality and key not in seen:
+                    seen.add(key)
+                    choices.append(c)
+        self.instance_list = []
+        for st in range(0, len(choices), num_choices):
+            if modality == 'txt':
+                self.instance_list.append((choices[st:st+num_choices], [], [], [], [], [], True, 'txt', len(self.instance_list)))
+            else:
+                imgs = choices[st:st+num_choices]
+                self.instance_list.append(([i for i, _ in imgs], [], [c for _, c in imgs], [], [], [], True, 'img', len(self.instance_list)))
+        print("CandidateDataset: {} {} choices in {} instances".format(len(choices), modality, len(self.instance_list)))
+
+    def __len__(self):
+        return len(self.instance_list)
+
+    def __getitem__(self, idx):
+        return self.processor(self.instance_list[idx], self.num_choices, self.device)
+
+
+class CandidateIndexWriter(object):
+    def __init__(self, index_dir, dtype='float16'):
+        assert dtype in STORAGE_DTYPES, "CandidateIndexWriter: unsupported dtype {}, choose from {}".format(dtype, list(STORAGE_DTYPES))
+        self.index_dir = index_dir
+        self.dtype = dtype
+        self.dim = None
+        self.entries = {}
+        self.row = 0
+        os.makedirs(index_dir, exist_ok=True)
+        self._fp = open(os.path.join(index_dir, 'embeddings.bin'), 'wb')
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, key, emb):
+        """ emb: (n_tokens, dim) embeddings of the tokens of one choice """
+        if key in self.entries:
+            return
+        if self.dim is None:
+            self.dim = int(emb.size(-1))
+        assert emb.dim() == 2 and emb.size(-1) == self.dim, "CandidateIndexWriter: {} has shape {}, expected (n, {})".format(key, tuple(emb.shape), self.dim)
+        self._fp.write(np.ascontiguousarray(to_storage(emb, self.dtype)).tobytes())
+        self.entries[key] = [self.row, int(emb.size(0))]
+        self.row += int(emb.size(0))
+
+    def close(self, checkpoint=None):
+        self._fp.close()
+        with open(os.path.join(self.index_dir, 'index.json'), 'w') as f:
+            json.dump(self.entries, f)
+        with open(os.path.join(self.index_dir, 'meta.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'dtype': self.dtype, 'num_candidates': len(self.entries), 'num_tokens': self.row, 'checkpoint': checkpoint}, f, indent=2)
+        print("CandidateIndexWriter: wrote {} choices, {} tokens to {}".format(len(self.entries), self.row, self.index_dir))
+
+
+class CandidateIndex(object):
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        meta_file = os.path.join(index_dir, 'meta.json')
+        assert os.path.exists(meta_file), "CandidateIndex: meta.json doesn't exist! {}".format(meta_file)
+        with open(meta_file, 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, 'index.json'), 'r') as f:
+            self.entries = json.load(f)
+        self.dim, self.dtype = self.meta['dim'], self.meta['dtype']
+        # copy-on-write mapping: torch.from_numpy needs a writable buffer, writes never reach the file
+        self._embeddings = np.memmap(os.path.join(index_dir, 'embeddings.bin'), dtype=STORAGE_DTYPES[self.dtype][0], mode='c').reshape(-1, self.dim)
+
+    def __str__(self):
+        return "CandidateIndex(index_dir='{}')".format(self.index_dir)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """ (n_tokens, dim) embeddings of one choice, in the stored dtype """
+        if key not in self.entries:
+            raise KeyError("CandidateIndex: choice {} is not in {}, rebuild it with --build_candidate_index".format(key, self.index_dir))
+        row, n = self.entries[key]
+        return from_storage(self._embeddings[row:row+n], self.dtype)
+
+    def lookup(self, keys, device=None):
+        """ Zero padded (len(keys), max n_tokens, dim) embeddings of the keys and their 0/1 token mask, (0, 1, dim) for no keys """
+        embs = [self.get(k) for k in keys]
+        emb = torch.zeros(len(embs), max([len(e) for e in embs] or [1]), self.dim, dtype=STORAGE_DTYPES[self.dtype][1])
+        mask = torch.zeros(emb.shape[:2], dtype=torch.long)
+        for i, e in enumerate(embs):
+            emb[i, :len(e)] = e
+            mask[i, :len(e)] = 1
+        return emb.to(device), mask.to(device)
+
+    def pooled_embeddings(self, keys):
+        """ (len(keys), dim) float32 mean token embedding of every key """
+        return np.stack([self.get(k).float().mean(0).numpy() for k in keys])
+
+
+class OpenPoolRetriever(object):
+    """ First stage retrieval among the choices of candidate_index that are in keys: ANN search of the mean question token
+        embedding among the mean choice token embeddings (their inner product is the mean similarity of all token pairs,
+        a lower bound of the MaxSim score), then exact late-interaction scores of the num_candidates best matches """
+    def __init__(self, candidate_index, keys, backend='numpy', nlist=None, nprobe=8):
+        self.candidate_index = candidate_index
+        self.keys = [k for k in keys if k in candidate_index]
+        missing = len(set(keys)) - len(set(self.keys))
+        if missing > 0:
+            print("OpenPoolRetriever: {} choices are not in {}, they can't be retrieved".format(missing, candidate_index))
+        self.ann = build_ann_index(candidate_index.pooled_embeddings(self.keys), backend, nlist=nlist, nprobe=nprobe)
+
+    def retrieve(self, model, question_emb, question_mask, num_candidates, top_n):
+        """ [[(key, score), ...]] of the top_n choices of every question, best first """
+        question_mask = question_mask.type_as(question_emb)
+        pooled = (question_emb * question_mask.unsqueeze(-1)).sum(1) / question_mask.sum(1, keepdim=True)
+        _, ids = self.ann.search(pooled.float().cpu().numpy(), num_candidates)
+        candidates = [[self.keys[i] for i in row if i >= 0] for row in ids.tolist()]
+        if sum(len(c) for c in candidates) == 0:
+            return [[] for _ in candidates] # every probe reached empty lists only
+        question_index = torch.tensor([q for q, c in enumerate(candidates) for _ in c], dtype=torch.long, device=question_emb.device)
+        choice_emb, choice_mask = self.candidate_index.lookup([k for c in candidates for k in c], question_emb.device)
+        model = getattr(model, 'module', model) # DataParallel / DDP
+        cls_pred = model.late_interaction_score(question_emb, question_mask.long(), choice_emb.type_as(question_emb), choice_mask, question_index)
+        scores = torch.softmax(cls_pred.float(), dim=-1)[:, 0].cpu().split([len(c) for c in candidates])
+        return [sorted(zip(c, s.tolist()), key=lambda x: -x[1])[:top_n] for c, s in zip(candidates, scores)]
+
+
+def open_pool_retrieval(model, dataloader, retriever, device, num_candidates, top_n, k_list):
+    """ Retrieve the top_n choices of every question of dataloader (late_interaction model, only its question rows are encoded).
+        Returns the {example_id: {'choices', 'labels', 'pred_scores', 'num_gold'}} outputs and {k: recall@k} of the gold choices """
+    outputs = {}
+    model.eval()
+    with torch.no_grad():
+        for step, batch in enumerate(dataloader):
+            batch = [t.to(device) if isinstance(t, torch.Tensor) else t for t in batch]
+            input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, do_filter_task, filter_label, logit_mask, ori_choices, task_idx, img, vis_pe, context, cxt_modality_label, example_ids, vis_lens = batch
+            question_emb, question_mask = model(vis_feats=img, vis_pe=vis_pe, input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask,
+                    do_filter_task=do_filter_task, filter_label=filter_label, logit_mask=logit_mask, context=context,
+                    cxt_modality_label=cxt_modality_label, task_idx=task_idx, return_question_embeddings=True)
+            # gold choices of every sample, from its own fixed choices
+            num_choices = logit_mask.view(-1).tolist() if logit_mask.dtype == torch.long else [logit_mask.size(1)] * len(example_ids)
+            keys = batch_choice_keys(ori_choices, None if logit_mask.dtype == torch.long else logit_mask.size(1))
+            labels = filter_label.view(-1, 2)[:, 0].tolist()
+            gold, st = [], 0
+            for n in num_choices:
+                gold.append(set(k for k, l in zip(keys[st:st+n], labels[st:st+n]) if l > 0))
+                st += n
+            for example_id, g, retrieved in zip(example_ids, gold, retriever.retrieve(model, question_emb, question_mask, num_candidates, top_n)):
+                outputs[example_id] = {'choices': [k for k, _ in retrieved], 'labels': [int(k in g) for k, _ in retrieved],
+                                       'pred_scores': ["{0:.4f}".format(s) for _, s in retrieved], 'num_gold': len(g)}
+            if step % 100 == 0:
+                print("open_pool_retrieval: {}/{} batches".format(step+1, len(dataloader)))
+    with_gold = [o for o in outputs.values() if o['num_gold'] > 0]
+    recall = dict((k, float(np.mean([sum(o['labels'][:k]) / float(o['num_gold']) for o in with_gold])) if with_gold else 0.) for k in k_list)
+    return outputs, recall
+
+
+def encode_candidates(model, dataset, writer, batch_size, num_workers, collate_fn, device, fp16=False, pack_img_regions=False):
+    """ Encode the choices of a CandidateDataset with a late_interaction BertForWebqa and add their token embeddings to writer """
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate_fn, pin_memory=True)
+    model.eval()
+    with torch.no_grad():
+        for step, batch in enumerate(dataloader):
+            batch = [t.to(device) if isinstance(t, torch.Tensor) else t for t in batch]
+            input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, do_filter_task, filter_label, logit_mask, ori_choices, task_idx, img, vis_pe, context, cxt_modality_label, example_ids, vis_lens = batch
+            if not pack_img_regions: vis_lens = None # collated from None placeholders
+            if fp16:
+                img, vis_pe = img.half(), vis_pe.half()
+            choice_emb, choice_mask = model(vis_feats=img, vis_pe=vis_pe, input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask,
+                    do_filter_task=do_filter_task, filter_label=filter_label, logit_mask=logit_mask, context=context,
+                    cxt_modality_label=cxt_modality_label, task_idx=task_idx, vis_lens=vis_lens, return_choice_embeddings=True)
+            num_choices = None if logit_mask.dtype == torch.long else logit_mask.size(1)
+            for key, emb, mask in zip(batch_choice_keys(ori_choices, num_choices), choice_emb, choice_mask):
+                # only the tokens of the choice, padding and unattended positions are dropped
+                writer.add(key, emb[mask.nonzero().view(-1)].float().cpu())
+            if step % 100 == 0:
+                print("encode_candidates: {}/{} batches".format(step+1, len(dataloader)))
+
+
+def load_top_k_choices(filter_output_json, k):
+    """ {example_id: keys of the k best scored choices} and the recall@k of the gold choices, from the json written by filter inference
+        (or by open_pool_retrieval, whose outputs count the gold choices that were not retrieved in num_gold) """
+    with open(filter_output_json, 'r') as f:
+        outputs = json.load(f)
+    top_k, num_gold, num_gold_kept = {}, 0, 0
+    for example_id, o in outputs.items():
+        keys = choice_keys(o['choices'])
+        scores = [float(s) for s in o['pred_scores'][:len(keys)]]
+        order = sorted(range(len(keys)), key=lambda i: -scores[i])[:k]
+        top_k[example_id] = [keys[i] for i in order]
+        num_gold += o.get('num_gold', sum(o['labels'][:len(keys)]))
+        num_gold_kept += sum(o['labels'][i] for i in order)
+    return top_k, num_gold_kept / max(num_gold, 1)
+
+
+def choice_pool(instance_list):
+    """ {key: (modality, choice)} of all distinct choices of the instances of a filter dataset """
+    pool = {}
+    for instance in instance_list:
+        for key, modality, c in instance_choices(instance):
+            pool.setdefault(key, (modality, c))
+    return pool
+
+
+def instance_with_choices(instance, keys, pool):
+    """ Copy of a filter instance whose choices are the keys found in pool, the gold choices of the instance stay gold """
+    gold_keys = set(k for k, _, _ in instance_choices((instance[0], [], instance[2], []) + tuple(instance[4:])))
+    choices = [(k,) + pool[k] for k in keys if k in pool]
+    if len(choices) == 0:
+        return instance
+    facts = lambda gold: [c for k, m, c in choices if m == 'txt' and (k in gold_keys) == gold]
+    imgs = lambda gold: [c for k, m, c in choices if m == 'img' and (k in gold_keys) == gold]
+    context = instance[7]
+    if context == 'txt':
+        head = (facts(True), facts(False), [], [])
+    elif context == 'img':
+        gold, distractors = imgs(True), imgs(False)
+        head = ([i for i, _ in gold], [i for i, _ in distractors], [c for _, c in gold], [c for _, c in distractors])
+    else:
+        head = (facts(True), facts(False), imgs(True), imgs(False))
+    return head + tuple(instance[4:])
+
+
+class RetrievedChoices(object):
+    """ Processor wrapper: the filter instances of the example_ids in choices get the listed choices (keys of pool) instead of their own """
+    def __init__(self, processor, choices, pool):
+        self.processor = processor
+        self.choices = choices
+        self.pool = pool
+
+    def __call__(self, instance, filter_max_choices=None, device=None):
+        keys = self.choices.get(instance[-1])
+        if keys is not None:
+            instance = instance_with_choices(instance, keys, self.pool)
+        return self.processor(instance, filter_max_choices, device)
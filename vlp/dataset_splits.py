@@ -0,0 +1,86 @@
+"""Split-partitioned, line-delimited copy of a WebQA dataset json.
+
+The dataset classes json.load the whole txt/img dataset file before filtering it
+by split and Qcate. Convert the file once with
+    python -m vlp.dataset_splits --dataset_json <dataset.json> --output_dir <dataset_splits_dir>
+and pass <dataset_splits_dir> as --txt_dataset_json_path / --img_dataset_json_path.
+The directory contains
+
+    meta.json          source file, its sha1 and the number of data per split
+    <split>.jsonl      one [index, key, datum] line per datum, in file order
+
+so only the requested splits are parsed, and reading stops as soon as
+use_num_samples data of the requested Qcate have been read.
+"""
+
+import os
+import json
+import heapq
+import shutil
+import argparse
+from collections import OrderedDict
+
+from vlp.loader_utils import file_sha1
+
+
+def split_dataset_json(dataset_json_path, output_dir):
+    with open(dataset_json_path, "r") as f:
+        dataset_J = json.load(f)
+    tmp_dir = output_dir.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    files, counts = {}, OrderedDict()
+    for index, key in enumerate(dataset_J):
+        datum = dataset_J[key]
+        split = datum['split']
+        if split not in files:
+            assert '/' not in split, "dataset_splits: invalid split name {}".format(split)
+            files[split] = open(os.path.join(tmp_dir, split + '.jsonl'), "w")
+            counts[split] = 0
+        files[split].write(json.dumps([index, key, datum]) + '\n')
+        counts[split] += 1
+    for f in files.values():
+        f.close()
+    with open(os.path.join(tmp_dir, 'meta.json'), "w") as f:
+        json.dump({'source': os.path.abspath(dataset_json_path), 'sha1': file_sha1(dataset_json_path), 'splits': counts}, f, indent=1)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+    print("Wrote {} data of splits {} to {}".format(sum(counts.values()), dict(counts), output_dir))
+
+
+def _read_split(path):
+    with open(path, "r") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def load_dataset_J(dataset_json_path, split, Qcate, use_num_samples=-1):
+    """ The dataset dict of a webqaDataset_*. A json file is loaded whole; from a dataset_splits directory only
+        the data of the requested splits are parsed, up to the first use_num_samples of the requested Qcate """
+    if not os.path.isdir(dataset_json_path):
+        with open(dataset_json_path, "r") as f:
+            return json.load(f)
+    with open(os.path.join(dataset_json_path, 'meta.json'), "r") as f:
+        meta = json.load(f)
+    # same membership test as the dataset loops
+    streams = [_read_split(os.path.join(dataset_json_path, s + '.jsonl')) for s in meta['splits'] if s in split]
+    dataset_J = OrderedDict()
+    # the indexes are unique, the merge restores the file order across splits
+    for index, key, datum in heapq.merge(*streams):
+        if ('all' in Qcate) or datum['Qcate'] in Qcate:
+            if use_num_samples != -1 and len(dataset_J) >= use_num_samples:
+                break
+            dataset_J[key] = datum
+    return dataset_J
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_json', type=str, required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    args = parser.parse_args()
+    split_dataset_json(args.dataset_json, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,13 +26,15 @@ import random
 import pickle
 
 from pytorch_pretrained_bert.tokenization import BertTokenizer, WhitespaceTokenizer
-from pytorch_pretrained_bert.modeling import BertForWebqaDecoder
+from pytorch_pretrained_bert.modeling import BertForWebqaDecoder, VisEmbeddingCache
 from pytorch_pretrained_bert.optimization import BertAdam, warmup_linear
 
 from vlp.loader_utils import batch_list_to_batch_tensors
+from vlp.candidate_index import image_key
 from misc.data_parallel import DataParallelImbalance
 
 import vlp.webqa_loader as webqa_loader
+from vlp.feature_store import FeatureStore, check_storage_dtype
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 
 from pycocoevalcap.spice.spice import Spice
@@ -272,6 +274,17 @@ def main():
     parser.add_argument('--img_dataset_json_path', type=str, default="/home/yingshac/CYS/WebQnA/WebQnA_data_new/img_dataset_0904_clean_fields.json")
     parser.add_argument('--gold_feature_folder', type=str, default="/data/yingshac/MMMHQA/imgFeatures_upd/gold")
     parser.add_argument('--distractor_feature_folder', type=str, default="/data/yingshac/MMMHQA/imgFeatures_upd/distractors")
+    parser.add_argument('--feature_store_dir', type=str, default=None, help="packed feature store built by vlp/feature_store.py, replaces the .pkl feature folders")
+    parser.add_argument('--feature_dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'], help="dtype img features / vis_pe are shipped in from the data workers, the model upcasts them (bfloat16 needs torch>=1.10)")
+    parser.add_argument('--pack_img_regions', action='store_true', help="ship the regions of each image unpadded instead of zero-padded to max_len_img_cxt, padded regions are masked out (rejected with torch.nn.DataParallel)")
+    parser.add_argument('--dataset_cache_dir', type=str, default=None, help="cache the tokenized dataset instances here, rebuilt when the dataset file, split, Qcate, vocab or use_num_samples change")
+    parser.add_argument('--num_tokenize_workers', type=int, default=0, help="tokenize the dataset texts with this many processes while building the instances, 0 for serial")
+    parser.add_argument('--pre_index_tokens', action='store_true', help="keep the dataset texts as int32 vocab ids instead of wordpiece strings")
+    parser.add_argument('--compact_instances', action='store_true', help="keep the dataset instances in memory-mapped flat arrays that the data workers share instead of copying")
+    parser.add_argument('--compact_attention_mask', action='store_true', help="ship the self-attention masks as a few span boundaries per sample and build them on the device")
+    parser.add_argument('--vis_embed_cache_size', type=int, default=0, help="inference: keep the vis_embed / vis_pe_embed outputs of up to this many images on the device and skip the MLPs for repeated images of img-context batches, 'both' batches are not cached (0: off, single GPU)")
+    parser.add_argument('--vis_embed_cache_file', type=str, default=None, help="load the --vis_embed_cache_size cache from this file if it exists and save it back at the end")
+    parser.add_argument('--attention_backend', default='matmul', choices=['matmul', 'sdpa'], help="self-attention implementation, sdpa uses torch.nn.functional.scaled_dot_product_attention (torch>=2.0)")
     #parser.add_argument('--img_metadata_path', type=str, default="/home/yingshan/CYS/WebQnA/WebQnA_data/img_metadata-Copy1.json", help="how many samples should be loaded into memory")
     parser.add_argument('--use_num_samples', type=int, default=-1, help="how many samples should be loaded into memory")
     parser.add_argument('--answer_provided_by', type=str, default="img|txt")
@@ -313,6 +326,7 @@ def main():
                         help='set to take in region features')
 
     args = parser.parse_args()
+    check_storage_dtype(args.feature_dtype)
     args.use_img_meta = not args.no_img_meta
     args.use_img_content = not args.no_img_content
     args.use_txt_fact= not args.no_txt_fact
@@ -350,19 +364,21 @@ def main():
     args.max_seq_length = args.max_len_b + args.max_len_a + 3 # +3 for 2x[SEP] and [CLS]
     tokenizer.max_len = args.max_seq_length
 
+    feature_store = FeatureStore(args.feature_store_dir) if args.feature_store_dir else None
     processor = webqa_loader.Preprocess4webqaDecoder(list(tokenizer.vocab.keys()), \
             tokenizer.convert_tokens_to_ids, seed=args.seed, max_len=args.max_seq_length, len_vis_input=args.len_vis_input, \
             max_len_a=args.max_len_a, max_len_Q=args.max_len_Q, max_len_img_cxt=args.max_len_img_cxt, \
             max_tgt_len=args.max_tgt_len, new_segment_ids=args.new_segment_ids, \
             truncate_config={'trunc_seg': args.trunc_seg, 'always_truncate_tail': args.always_truncate_tail}, \
-            use_img_meta=args.use_img_meta, use_img_content=args.use_img_content, use_txt_fact=args.use_txt_fact)
+            use_img_meta=args.use_img_meta, use_img_content=args.use_img_content, use_txt_fact=args.use_txt_fact, \
+            feature_store=feature_store, feature_dtype=args.feature_dtype, pack_img_regions=args.pack_img_regions, pre_indexed=args.pre_index_tokens, compact_attention_mask=args.compact_attention_mask)
 
     infr_dataloaders = []
     if 'txt' in args.answer_provided_by:
         args.output_suffix =  args.txt_dataset_json_path.split('/')[-1].replace(".json", "") + args.output_suffix
         train_dataset = webqa_loader.webqaDataset_qa(dataset_json_path=args.txt_dataset_json_path, split=args.split, Qcate=args.Qcate, \
                 batch_size=args.batch_size, tokenizer=tokenizer, use_num_samples=args.use_num_samples, \
-                processor=processor, device=device)
+                processor=processor, device=device, dataset_cache_dir=args.dataset_cache_dir, num_tokenize_workers=args.num_tokenize_workers, pre_index=args.pre_index_tokens, compact_instances=args.compact_instances)
 
         infr_dataloader = _get_loader_from_dataset(train_dataset, args.batch_size, args.num_workers, batch_list_to_batch_tensors)
         infr_dataloaders.append(infr_dataloader)
@@ -372,7 +388,7 @@ def main():
         train_dataset = webqa_loader.webqaDataset_qa_with_img(dataset_json_path=args.img_dataset_json_path, split=args.split, Qcate=args.Qcate, \
                 batch_size=args.batch_size, tokenizer=tokenizer, gold_feature_folder=args.gold_feature_folder, \
                 distractor_feature_folder=args.distractor_feature_folder, use_num_samples=args.use_num_samples, \
-                processor=processor, device=device)
+                processor=processor, device=device, feature_store=feature_store, dataset_cache_dir=args.dataset_cache_dir, num_tokenize_workers=args.num_tokenize_workers, pre_index=args.pre_index_tokens, compact_instances=args.compact_instances)
         infr_dataloader = _get_loader_from_dataset(train_dataset, args.batch_size, args.num_workers, batch_list_to_batch_tensors)
         infr_dataloaders.append(infr_dataloader)
 
@@ -418,7 +434,7 @@ def main():
             task_idx=3, mask_word_id=mask_word_id, search_beam_size=args.beam_size, 
             length_penalty=args.length_penalty, eos_id=eos_word_ids, 
             forbid_duplicate_ngrams=args.forbid_duplicate_ngrams, forbid_ignore_set=forbid_ignore_set, 
-            ngram_size=args.ngram_size, min_len=args.min_len, max_len_img_cxt=args.max_len_img_cxt)
+            ngram_size=args.ngram_size, min_len=args.min_len, attention_backend=args.attention_backend, max_len_img_cxt=args.max_len_img_cxt)
     else:
         if recover_step:
             print("Decoding ... -------------------- recover from step {} -----------------------".format(recover_step))
@@ -438,13 +454,16 @@ def main():
             task_idx=3, mask_word_id=mask_word_id, search_beam_size=args.beam_size, 
             length_penalty=args.length_penalty, eos_id=eos_word_ids, 
             forbid_duplicate_ngrams=args.forbid_duplicate_ngrams, forbid_ignore_set=forbid_ignore_set, 
-            ngram_size=args.ngram_size, min_len=args.min_len, max_len_img_cxt=args.max_len_img_cxt)
+            ngram_size=args.ngram_size, min_len=args.min_len, attention_backend=args.attention_backend, max_len_img_cxt=args.max_len_img_cxt)
         del model_recover
 
         
     if args.fp16:
         model.half()
     model.to(device)
+    # decoding runs on one device, torch.nn.DataParallel would split the flat packed regions out of step with the samples
+    assert not (args.pack_img_regions and isinstance(model, torch.nn.DataParallel)), \
+        "--pack_img_regions does not work with torch.nn.DataParallel"
 
     torch.cuda.empty_cache()
     model.eval()
@@ -461,6 +480,17 @@ def main():
     
     log_txt_content.append("split = {}".format(args.split))
     log_txt_content.append("use_num_samples = {}".format(args.use_num_samples))
+
+    vis_embed_cache, qa_vis_keys = None, {}
+    if args.vis_embed_cache_size > 0:
+        vis_embed_cache = VisEmbeddingCache(args.vis_embed_cache_size, args.vis_embed_cache_file,
+            config="x101fpn qa use_img_content={} pack_img_regions={} len_vis_input={} max_len_img_cxt={} feature_dtype={}".format(args.use_img_content, args.pack_img_regions, args.len_vis_input, args.max_len_img_cxt, args.feature_dtype)).bind(model)
+        print("\n{}".format(vis_embed_cache))
+        # the image context of an img sample is made of its first 2 gold images
+        for l in infr_dataloaders:
+            for instance in l.dataset.instance_list:
+                if instance[7] == 'img' and len(instance[0]) > 0:
+                    qa_vis_keys[instance[-1]] = '+'.join(image_key(i) for i in instance[0][:2])
     
     output_lines = []
     output_confidence = []
@@ -477,7 +507,8 @@ def main():
             #if step<834: continue
             with torch.no_grad():
                 batch = [t.to(device) if not isinstance(t, list) else t for t in batch ]
-                input_ids, segment_ids, position_ids, input_mask, task_idx, img, vis_pe, context, cxt_modality_label, example_ids = batch
+                input_ids, segment_ids, position_ids, input_mask, task_idx, img, vis_pe, context, cxt_modality_label, example_ids, vis_lens = batch
+                if not args.pack_img_regions: vis_lens = None # collated from None placeholders
                 #print(tokenizer.convert_ids_to_tokens([i for i in list(input_ids.detach().cpu().numpy()[0][202:]) if i>0 and i!=102]))
                 time.sleep(2)
                 if args.fp16:
@@ -487,7 +518,8 @@ def main():
                 conv_feats = img.data # Bx100x2048
                 vis_pe = vis_pe.data
 
-                traces = model(conv_feats, vis_pe, input_ids, segment_ids, position_ids, input_mask, context, cxt_modality_label, task_idx=task_idx)
+                vis_keys = [qa_vis_keys.get(e) for e in example_ids] if vis_embed_cache is not None and context[0] == 'img' else None
+                traces = model(conv_feats, vis_pe, input_ids, segment_ids, position_ids, input_mask, context, cxt_modality_label, task_idx=task_idx, vis_lens=vis_lens, vis_keys=vis_keys)
                     
 
                 for i in range(input_ids.size(0)):
@@ -517,6 +549,9 @@ def main():
         output_Guid.extend(Guid)
         output_Qcate.extend(Qcate)
         assert len(output_lines) == len(output_confidence) == len(output_Q) == len(output_A) == len(output_Keywords_A) == len(output_Guid) == len(output_Qcate)
+    if vis_embed_cache is not None:
+        print(vis_embed_cache)
+        vis_embed_cache.save()
 
     if args.no_eval:
         filename = "{}_qainfr_no_eval_{}_beam{}".format(args.split, args.use_num_samples, args.beam_size)
@@ -0,0 +1,108 @@
+"""Shared-memory LRU cache of decoded (img, vis_pe) tensors, keyed by image_id.
+
+The cache is created once in the main process and pickled into the DataLoader
+workers together with the processor, so every worker reads and fills the same
+slots. Its table and slots are memory-mapped files (under /dev/shm when
+available), the workers map them again from their paths. Storage is split into
+fixed-size slots of max_regions rows; the number of slots follows from the byte
+budget. Images with more regions than a slot holds are never cached.
+"""
+
+import os
+import atexit
+import numpy as np
+import torch
+import multiprocessing
+
+from vlp.feature_store import STORAGE_DTYPES, to_storage, from_storage
+from vlp.loader_utils import run_scratch_dir, release_scratch_dir
+
+# per-slot bookkeeping columns of the shared table
+KEY, NUM_ROWS, LAST_USED = 0, 1, 2
+# counters stored in the last row of the table
+HITS, MISSES, CLOCK = 0, 1, 2
+
+
+class SharedFeatureCache(object):
+    def __init__(self, budget_bytes, img_dim=2048, vis_pe_dim=1607, max_regions=100, dtype='float32'):
+        self.img_dim = img_dim
+        self.vis_pe_dim = vis_pe_dim
+        self.max_regions = max_regions
+        assert dtype in STORAGE_DTYPES, "SharedFeatureCache: unsupported dtype {}, choose from {}".format(dtype, list(STORAGE_DTYPES))
+        self.dtype = dtype
+        self.slot_bytes = max_regions * (img_dim + vis_pe_dim) * np.dtype(STORAGE_DTYPES[dtype][0]).itemsize
+        self.num_slots = int(budget_bytes // self.slot_bytes)
+        assert self.num_slots > 0, "SharedFeatureCache: budget of {} bytes is smaller than one slot ({} bytes)".format(budget_bytes, self.slot_bytes)
+
+        self.cache_dir = run_scratch_dir('webqa_feature_cache')
+        np.memmap(os.path.join(self.cache_dir, 'data.bin'), dtype=np.uint8, mode='w+', shape=(self.num_slots * self.slot_bytes,)).flush()
+        np.memmap(os.path.join(self.cache_dir, 'table.bin'), dtype=np.int64, mode='w+', shape=((self.num_slots + 1) * 3,)).flush()
+        # spawn-context lock, it is handed to the workers when the DataLoader pickles the processor
+        self._lock = multiprocessing.get_context('spawn').Lock()
+        self._owner = True
+        self._attach()
+        self._table[:] = 0
+        self._table[:self.num_slots, KEY] = -1
+        atexit.register(self.close)
+        print("SharedFeatureCache: {} slots of {} regions, {:.2f} GB".format(self.num_slots, max_regions, self.num_slots * self.slot_bytes / 1e9))
+
+    def _attach(self):
+        self._table = np.memmap(os.path.join(self.cache_dir, 'table.bin'), dtype=np.int64, mode='r+', shape=(self.num_slots + 1, 3))
+        self._data = np.memmap(os.path.join(self.cache_dir, 'data.bin'), dtype=STORAGE_DTYPES[self.dtype][0], mode='r+',
+                               shape=(self.num_slots, self.max_regions, self.img_dim + self.vis_pe_dim))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['_table', '_data']:
+            del state[k]
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def get(self, image_id):
+        """ Return (img, vis_pe) copied out of the cache, or None on a miss """
+        counters = self._table[self.num_slots]
+        with self._lock:
+            slot = np.flatnonzero(self._table[:self.num_slots, KEY] == image_id)
+            if len(slot) == 0:
+                counters[MISSES] += 1
+                return None
+            slot = slot[0]
+            counters[HITS] += 1
+            counters[CLOCK] += 1
+            self._table[slot, LAST_USED] = counters[CLOCK]
+            x = from_storage(self._data[slot, :self._table[slot, NUM_ROWS]].copy(), self.dtype)
+        return x[:, :self.img_dim], x[:, self.img_dim:]
+
+    def put(self, image_id, img, vis_pe):
+        n = img.size(0)
+        if n > self.max_regions:
+            return
+        x = to_storage(torch.cat((img, vis_pe), dim=-1), self.dtype)
+        counters = self._table[self.num_slots]
+        with self._lock:
+            keys = self._table[:self.num_slots, KEY]
+            if (keys == image_id).any():
+                return
+            empty = np.flatnonzero(keys == -1)
+            slot = empty[0] if len(empty) > 0 else np.argmin(self._table[:self.num_slots, LAST_USED])
+            self._data[slot, :n] = x
+            counters[CLOCK] += 1
+            self._table[slot] = (image_id, n, counters[CLOCK])
+
+    def stats(self):
+        counters = self._table[self.num_slots]
+        hits, misses = int(counters[HITS]), int(counters[MISSES])
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(1, hits + misses),
+                'used_slots': int((self._table[:self.num_slots, KEY] != -1).sum()), 'num_slots': self.num_slots}
+
+    def close(self):
+        if getattr(self, '_table', None) is None:
+            return
+        self._table = None
+        self._data = None
+        if self._owner:
+            release_scratch_dir(self.cache_dir)
@@ -0,0 +1,497 @@
+"""Packed, memory-mapped region feature store.
+
+Replaces the per-image ``<image_id>.pkl`` feature files with a handful of large
+files that are memory-mapped by every data worker. A store directory contains
+
+    meta.json                  field names, row widths and dtypes
+    index.npy                  (image_id, shard, row, n_regions), sorted by image_id
+    <field>.<shard>.bin        row-major float arrays, one file per field and shard
+
+All fields of an image start at the same row of their shard, so a lookup is one
+binary search in the index followed by slicing the mapped arrays.
+
+Build a store from the pickle folders (x101fpn) or from the VinVL tsv files with
+    python -m vlp.feature_store --feature_folders <gold> <distractors> <x_distractors> --output_dir <store>
+    python -m vlp.feature_store --img_tsvs <gold_tsv> <neg_tsv> <x_neg_tsv> --output_dir <store>
+Large pickle folders are converted by a pool of workers, one shard per task; the
+conversion validates every pickle and can be resumed by re-running the command
+    python -m vlp.feature_store --feature_folders <gold> <distractors> <x_distractors> --output_dir <store> --num_workers 16
+and optionally precompute the normalized visual position encodings (vis_pe field)
+    python -m vlp.feature_store --precompute_vis_pe --output_dir <store>
+With --dtype float16 / bfloat16 the region features (and vis_pe) are stored in half
+precision; box coordinates and scores always stay float32. Check a half store
+against a float32 one with
+    python -m vlp.feature_store --validate <fp32_store> --output_dir <half_store>
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+FEATURE_FIELDS = ('fc1_features', 'cls_features', 'pred_boxes', 'scores')
+# box coordinates are normalized by their max and scores are tiny, keep them in full precision
+FLOAT32_FIELDS = ('pred_boxes', 'scores')
+
+
+def _bfloat16_supported():
+    """ bfloat16 storage needs torch.bfloat16 and Tensor.view(dtype), which older torch (e.g. the pinned 1.1.0) lacks """
+    if not hasattr(torch, 'bfloat16'):
+        return False
+    try:
+        torch.zeros(1, dtype=torch.int16).view(torch.bfloat16)
+    except (TypeError, RuntimeError):
+        return False
+    return True
+
+
+# dtype name -> (numpy storage dtype, torch dtype). numpy has no bfloat16, its bits are stored as uint16
+STORAGE_DTYPES = {'float32': (np.float32, torch.float32), 'float16': (np.float16, torch.float16)}
+if _bfloat16_supported():
+    STORAGE_DTYPES['bfloat16'] = (np.uint16, torch.bfloat16)
+INDEX_DTYPE = np.dtype([('image_id', np.int64), ('shard', np.int32), ('row', np.int64), ('n_regions', np.int32)])
+
+
+def shard_file(store_dir, field, shard):
+    return os.path.join(store_dir, '{}.{:05d}.bin'.format(field, shard))
+
+
+def image_id_from_path(img_path):
+    return int(os.path.basename(img_path).replace('.pkl', ''))
+
+
+_folder_listings = {}
+
+
+def folder_listing(folder):
+    """ Names of the files in folder, listed with a single scandir and memoized for the process """
+    if folder not in _folder_listings:
+        try:
+            with os.scandir(folder) as entries:
+                _folder_listings[folder] = frozenset(e.name for e in entries)
+        except FileNotFoundError:
+            _folder_listings[folder] = frozenset()
+        logger.info("Indexed {} files in {}".format(len(_folder_listings[folder]), folder))
+    return _folder_listings[folder]
+
+
+def feature_file_exists(path):
+    """ os.path.exists for the per-image .pkl files, answered from the listing of their folder """
+    folder, name = os.path.split(path)
+    return name in folder_listing(folder)
+
+
+def check_storage_dtype(dtype):
+    assert dtype in STORAGE_DTYPES, "feature_store: dtype {} is not supported with torch {}, choose from {} (bfloat16 needs torch>=1.10)".format(dtype, torch.__version__, list(STORAGE_DTYPES))
+
+
+def to_storage(x, dtype):
+    """ Tensor or array -> numpy array holding the bits of dtype ('float32' / 'float16' / 'bfloat16') """
+    np_dtype, torch_dtype = STORAGE_DTYPES[dtype]
+    x = torch.as_tensor(x).detach().cpu().to(torch_dtype)
+    if torch_dtype == torch.bfloat16:
+        x = x.view(torch.int16)
+    return x.numpy().view(np_dtype)
+
+
+def from_storage(arr, dtype):
+    """ Inverse of to_storage, shares memory with arr """
+    np_dtype, torch_dtype = STORAGE_DTYPES[dtype]
+    if torch_dtype == torch.float32 or torch_dtype == torch.float16:
+        return torch.from_numpy(arr)
+    # torch.from_numpy has no uint16, go through int16
+    return torch.from_numpy(arr.view(np.int16)).view(torch.bfloat16)
+
+
+def compute_vis_pe(pred_boxes, scores, cls_features):
+    """ Box geometry, detection score and class distribution of every region, as fed to vis_pe_embed """
+    vis_pe = pred_boxes.to(torch.float32, copy=True)
+    # Lazy normalization of the coordinates
+    w_est = torch.max(vis_pe[:, [0, 2]])*1.+1e-5
+    h_est = torch.max(vis_pe[:, [1, 3]])*1.+1e-5
+    vis_pe[:, [0, 2]] /= w_est
+    vis_pe[:, [1, 3]] /= h_est
+    assert h_est > 0, 'loader Processor: box h_est should greater than 0! {}'.format(h_est)
+    assert w_est > 0, 'loader Processor: box w_est should greater than 0! {}'.format(w_est)
+    rel_area = (vis_pe[:, 3]-vis_pe[:, 1])*(vis_pe[:, 2]-vis_pe[:, 0])
+    rel_area.clamp_(0)
+
+    vis_pe = torch.cat((vis_pe[:, :4], rel_area.view(-1, 1), scores.float().view(-1, 1)), -1)
+    cls_features = cls_features.float()
+    return torch.cat((F.layer_norm(vis_pe, [6]), F.layer_norm(cls_features, [cls_features.size(-1)])), dim=-1) # x101fpn: 1601, VinVL: 1595
+
+
+def img_and_vis_pe(features, dtype=torch.float32):
+    """ (fc1_features, vis_pe) of one image in dtype. Takes the precomputed vis_pe when the features come from a store that has it """
+    features = {k: torch.as_tensor(v).detach().cpu() for k, v in features.items()}
+    img = features['fc1_features'].to(dtype)
+    if 'vis_pe' in features:
+        return img, features['vis_pe'].to(dtype)
+    # the normalization runs in float32 whatever the storage dtype is
+    return img, compute_vis_pe(features['pred_boxes'], features['scores'], features['cls_features']).to(dtype)
+
+
+def feature_arrays(image_id, features, dtype='float32'):
+    """ {field: (n_regions, dim) storage array} of one image """
+    arrays = {}
+    for field in FEATURE_FIELDS:
+        x = to_storage(features[field], 'float32' if field in FLOAT32_FIELDS else dtype)
+        arrays[field] = x.reshape(len(x), -1)
+    n = len(arrays['fc1_features'])
+    assert all(len(x) == n for x in arrays.values()), "FeatureStoreWriter: fields of image {} have different number of regions".format(image_id)
+    return arrays
+
+
+def field_info(arrays, dtype='float32'):
+    return {field: {'dim': int(x.shape[1]), 'dtype': 'float32' if field in FLOAT32_FIELDS else dtype} for field, x in arrays.items()}
+
+
+def write_index(store_dir, index, fields, num_shards):
+    """ Sort the (image_id, shard, row, n_regions) entries and write index.npy and meta.json """
+    index = np.array(index, dtype=INDEX_DTYPE)
+    index.sort(order='image_id')
+    assert len(np.unique(index['image_id'])) == len(index), "FeatureStoreWriter: duplicated image_ids"
+    np.save(os.path.join(store_dir, 'index.npy'), index)
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({'fields': fields, 'num_images': len(index), 'num_shards': num_shards}, f, indent=2)
+
+
+class FeatureStore(object):
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        meta_file = os.path.join(store_dir, 'meta.json')
+        assert os.path.exists(meta_file), "FeatureStore: meta.json doesn't exist! {}".format(meta_file)
+        with open(meta_file, 'r') as f:
+            self.meta = json.load(f)
+        self.fields = self.meta['fields']
+        self._index = None
+        self._image_ids = None
+        self._arrays = {}
+        # mmaps can't be shared across processes, re-open them when the pid changes
+        self.pid = None
+
+    def __getstate__(self):
+        # only ship the store location to the data workers
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_image_ids'] = None
+        state['_arrays'] = {}
+        state['pid'] = None
+        return state
+
+    def __str__(self):
+        return "FeatureStore(store_dir='{}')".format(self.store_dir)
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        self._ensure_opened()
+        return len(self._index)
+
+    def __contains__(self, image_id):
+        return self._find(image_id) >= 0
+
+    def __getitem__(self, image_id):
+        return self.get(image_id)
+
+    def image_ids(self):
+        self._ensure_opened()
+        return self._image_ids
+
+    def get(self, image_id):
+        """ Return {field: np.ndarray} for image_id. The arrays are views into the mapped shards, bfloat16 fields come as raw uint16. """
+        i = self._find(image_id)
+        if i < 0:
+            raise KeyError("FeatureStore: image_id {} is not in {}".format(image_id, self.store_dir))
+        entry = self._index[i]
+        shard, row, n = int(entry['shard']), int(entry['row']), int(entry['n_regions'])
+        return {field: self._array(field, shard)[row:row+n] for field in self.fields}
+
+    def get_tensors(self, image_id):
+        """ Like get, as torch tensors in the stored dtype """
+        return {field: from_storage(x, self.fields[field]['dtype']) for field, x in self.get(image_id).items()}
+
+    def _find(self, image_id):
+        self._ensure_opened()
+        image_id = int(image_id)
+        i = int(np.searchsorted(self._image_ids, image_id))
+        if i < len(self._image_ids) and self._image_ids[i] == image_id:
+            return i
+        return -1
+
+    def _array(self, field, shard):
+        key = (field, shard)
+        if key not in self._arrays:
+            info = self.fields[field]
+            check_storage_dtype(info['dtype'])
+            # copy-on-write mapping: torch.from_numpy needs a writable buffer, writes never reach the file
+            arr = np.memmap(shard_file(self.store_dir, field, shard), dtype=STORAGE_DTYPES[info['dtype']][0], mode='c')
+            self._arrays[key] = arr.reshape(-1, info['dim'])
+        return self._arrays[key]
+
+    def _ensure_opened(self):
+        if self.pid != os.getpid():
+            self._index = np.load(os.path.join(self.store_dir, 'index.npy'), mmap_mode='r')
+            self._image_ids = self._index['image_id']
+            self._arrays = {}
+            self.pid = os.getpid()
+
+
+class FeatureStoreWriter(object):
+    def __init__(self, store_dir, images_per_shard=20000, dtype='float32'):
+        self.store_dir = store_dir
+        self.images_per_shard = images_per_shard
+        check_storage_dtype(dtype)
+        self.dtype = dtype
+        self.fields = None
+        self.entries = []
+        self.shard = -1
+        self.row = 0
+        self.num_in_shard = images_per_shard
+        self._fps = {}
+        os.makedirs(store_dir, exist_ok=True)
+
+    def add(self, image_id, features):
+        arrays = feature_arrays(image_id, features, self.dtype)
+        n = len(arrays['fc1_features'])
+        if self.fields is None:
+            self.fields = field_info(arrays, self.dtype)
+        for field, x in arrays.items():
+            assert x.shape[1] == self.fields[field]['dim'], "FeatureStoreWriter: {} of image {} has dim {}, expected {}".format(field, image_id, x.shape[1], self.fields[field]['dim'])
+
+        if self.num_in_shard >= self.images_per_shard:
+            self._next_shard()
+        for field, x in arrays.items():
+            self._fps[field].write(np.ascontiguousarray(x).tobytes())
+        self.entries.append((int(image_id), self.shard, self.row, n))
+        self.row += n
+        self.num_in_shard += 1
+
+    def _next_shard(self):
+        self._close_shard()
+        self.shard += 1
+        self.row = 0
+        self.num_in_shard = 0
+        self._fps = {field: open(shard_file(self.store_dir, field, self.shard), 'wb') for field in FEATURE_FIELDS}
+
+    def _close_shard(self):
+        for fp in self._fps.values():
+            fp.close()
+        self._fps = {}
+
+    def close(self):
+        self._close_shard()
+        write_index(self.store_dir, self.entries, self.fields, self.shard + 1)
+        print("FeatureStoreWriter: wrote {} images in {} shards to {}".format(len(self.entries), self.shard + 1, self.store_dir))
+
+
+def precompute_vis_pe(store_dir):
+    """ Write the final (unpadded) vis_pe of every image as an extra field of the store """
+    store = FeatureStore(store_dir)
+    assert all(f in store.fields for f in FEATURE_FIELDS), "precompute_vis_pe: {} misses raw box/score/cls fields".format(store_dir)
+    # read the raw fields only, an older vis_pe field is being overwritten
+    store.fields = {f: store.meta['fields'][f] for f in FEATURE_FIELDS}
+    store._ensure_opened()
+    index = store._index
+    dtype = store.fields['fc1_features']['dtype']
+    dim = None
+    for shard in range(store.meta['num_shards']):
+        entries = index[index['shard'] == shard]
+        entries = entries[np.argsort(entries['row'])]
+        with open(shard_file(store_dir, 'vis_pe', shard), 'wb') as fp:
+            for entry in entries:
+                _, vis_pe = img_and_vis_pe(store.get_tensors(entry['image_id']))
+                dim = vis_pe.size(-1)
+                fp.write(to_storage(vis_pe, dtype).tobytes())
+        print("precompute_vis_pe: shard {}/{} done".format(shard+1, store.meta['num_shards']))
+    store.meta['fields']['vis_pe'] = {'dim': int(dim), 'dtype': dtype}
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump(store.meta, f, indent=2)
+
+
+def validate_store(store_dir, reference_dir, max_images=None):
+    """ Max absolute deviation of the (img, vis_pe) a store feeds the loader from the ones of a float32 reference store """
+    store, reference = FeatureStore(store_dir), FeatureStore(reference_dir)
+    image_ids = reference.image_ids()
+    if max_images is not None:
+        image_ids = image_ids[np.linspace(0, len(image_ids)-1, min(max_images, len(image_ids))).astype(np.int64)]
+    max_dev = {'img': 0., 'vis_pe': 0.}
+    for n, image_id in enumerate(image_ids):
+        ref = img_and_vis_pe(reference.get_tensors(image_id))
+        # upcast the way the model does, right before vis_embed / vis_pe_embed
+        out = [x.float() for x in img_and_vis_pe(store.get_tensors(image_id), dtype=STORAGE_DTYPES[store.fields['fc1_features']['dtype']][1])]
+        for k, x, y in zip(['img', 'vis_pe'], ref, out):
+            assert x.shape == y.shape, "validate_store: {} of image {} has shape {}, expected {}".format(k, image_id, tuple(y.shape), tuple(x.shape))
+            max_dev[k] = max(max_dev[k], (x - y).abs().max().item() if x.numel() else 0.)
+        if (n+1) % 10000 == 0:
+            print("{}/{} images".format(n+1, len(image_ids)))
+    print("validate_store: {} ({}) vs {} over {} images, max abs deviation img {:.3e}, vis_pe {:.3e}".format(
+        store_dir, store.fields['fc1_features']['dtype'], reference_dir, len(image_ids), max_dev['img'], max_dev['vis_pe']))
+    return max_dev
+
+
+def list_feature_files(feature_folders):
+    files = []
+    for folder in feature_folders:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.name.endswith('.pkl'):
+                    files.append((image_id_from_path(entry.name), entry.path))
+    files.sort()
+    return files
+
+
+def write_from_pkl(writer, feature_folders):
+    files = list_feature_files(feature_folders)
+    print("Found {} feature files in {} folders".format(len(files), len(feature_folders)))
+    for n, (image_id, path) in enumerate(files):
+        with open(path, "rb") as f:
+            features = pickle.load(f)
+        writer.add(image_id, features)
+        if (n+1) % 10000 == 0:
+            print("{}/{} images".format(n+1, len(files)))
+
+
+def _shard_part(store_dir, shard):
+    return os.path.join(store_dir, 'index.{:05d}'.format(shard))
+
+
+def _convert_shard(task):
+    """ Validate and pack the pickles of one shard. The part index is written last, its .json marks the shard as done """
+    store_dir, shard, files, dtype = task
+    start = time.time()
+    fps = {field: open(shard_file(store_dir, field, shard), 'wb') for field in FEATURE_FIELDS}
+    entries, bad_files, fields, row, num_bytes = [], [], None, 0, 0
+    for image_id, path in files:
+        try:
+            with open(path, "rb") as f:
+                features = pickle.load(f)
+            arrays = feature_arrays(image_id, features, dtype)
+            info = field_info(arrays, dtype)
+            assert fields is None or info == fields, "field dims {} differ from the rest of the shard {}".format(info, fields)
+            for field, x in arrays.items():
+                # also catches values that overflow a half precision dtype
+                assert torch.isfinite(from_storage(x, info[field]['dtype'])).all(), "{} has non-finite values".format(field)
+        except Exception as e:
+            bad_files.append([path, repr(e)])
+            continue
+        fields = info
+        for field, x in arrays.items():
+            fps[field].write(np.ascontiguousarray(x).tobytes())
+            num_bytes += x.nbytes
+        n = len(arrays['fc1_features'])
+        entries.append((image_id, shard, row, n))
+        row += n
+    for fp in fps.values():
+        fp.close()
+    part = _shard_part(store_dir, shard)
+    np.save(part + '.npy', np.array(entries, dtype=INDEX_DTYPE))
+    with open(part + '.json.tmp', 'w') as f:
+        json.dump({'fields': fields, 'num_images': len(entries), 'bad_files': bad_files}, f)
+    os.replace(part + '.json.tmp', part + '.json')
+    return shard, len(files), num_bytes, time.time() - start
+
+
+def convert_pkl_folders(feature_folders, store_dir, num_workers=8, images_per_shard=20000, dtype='float32'):
+    """ Multiprocess, resumable version of write_from_pkl: each worker packs whole shards, re-running skips the finished ones """
+    os.makedirs(store_dir, exist_ok=True)
+    files = list_feature_files(feature_folders)
+    shards = [files[i:i+images_per_shard] for i in range(0, len(files), images_per_shard)]
+    plan = {'feature_folders': [os.path.abspath(d) for d in feature_folders], 'num_files': len(files), 'images_per_shard': images_per_shard, 'dtype': dtype}
+    plan_file = os.path.join(store_dir, 'convert.json')
+    if os.path.exists(plan_file):
+        with open(plan_file, 'r') as f:
+            old_plan = json.load(f)
+        assert old_plan == plan, "convert_pkl_folders: {} was started with {}, now {}. Use a new --output_dir".format(store_dir, old_plan, plan)
+    else:
+        with open(plan_file, 'w') as f:
+            json.dump(plan, f, indent=2)
+
+    tasks = [(store_dir, k, shard, dtype) for k, shard in enumerate(shards) if not os.path.exists(_shard_part(store_dir, k) + '.json')]
+    print("Found {} feature files in {} folders, {} shards, {} left to convert".format(len(files), len(feature_folders), len(shards), len(tasks)))
+    start = time.time()
+    done_images, done_bytes = 0, 0
+    with multiprocessing.Pool(num_workers) as pool:
+        for n, (shard, num_images, num_bytes, secs) in enumerate(pool.imap_unordered(_convert_shard, tasks)):
+            done_images += num_images
+            done_bytes += num_bytes
+            elapsed = time.time() - start
+            print("shard {} done in {:.0f}s ({}/{}), {:.0f} images/s, {:.1f} MB/s overall".format(
+                shard, secs, n+1, len(tasks), done_images / elapsed, done_bytes / elapsed / 1e6))
+
+    index, fields, bad_files = [], None, []
+    for k in range(len(shards)):
+        part = _shard_part(store_dir, k)
+        with open(part + '.json', 'r') as f:
+            info = json.load(f)
+        bad_files += info['bad_files']
+        if info['num_images'] == 0:
+            continue
+        assert fields is None or info['fields'] == fields, "convert_pkl_folders: shard {} has fields {}, expected {}".format(k, info['fields'], fields)
+        fields = info['fields']
+        index.append(np.load(part + '.npy'))
+    assert fields is not None, "convert_pkl_folders: no valid feature file in {}".format(feature_folders)
+    index = np.concatenate(index)
+    write_index(store_dir, index, fields, len(shards))
+    with open(os.path.join(store_dir, 'bad_files.json'), 'w') as f:
+        json.dump(bad_files, f, indent=2)
+    print("convert_pkl_folders: {} images in {} shards written to {}, {} bad files listed in bad_files.json".format(len(index), len(shards), store_dir, len(bad_files)))
+    return bad_files
+
+
+def write_from_tsv(writer, img_tsvs):
+    # VinVL image ids encode the tsv in the leading digit: image_id = tsv_idx * 10000000 + row
+    from vlp.ImgDataTsv import ImgDataTsv
+    for k, tsv in enumerate(img_tsvs):
+        img_data = ImgDataTsv(tsv)
+        for row in range(len(img_data)):
+            if img_data.img_tsv.seek(row)[0] == 'None':
+                continue
+            pred_boxes, scores, fc1_features, cls_features = img_data[row]
+            writer.add(k * 10000000 + row, {'fc1_features': fc1_features, 'cls_features': cls_features, 'pred_boxes': pred_boxes, 'scores': scores})
+            if (row+1) % 10000 == 0:
+                print("{}: {}/{} images".format(tsv, row+1, len(img_data)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feature_folders', type=str, nargs='+', default=None, help="folders of <image_id>.pkl files")
+    parser.add_argument('--img_tsvs', type=str, nargs='+', default=None, help="VinVL gold/neg/x_neg tsv files, in this order")
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--images_per_shard', type=int, default=20000)
+    parser.add_argument('--num_workers', type=int, default=0, help="convert --feature_folders with this many processes, resumable")
+    parser.add_argument('--precompute_vis_pe', action='store_true', help="add the normalized vis_pe of every image to the store")
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'], help="storage dtype of the region features and vis_pe, bfloat16 needs torch>=1.10")
+    parser.add_argument('--validate', type=str, default=None, help="float32 reference store, report the max deviation of --output_dir from it")
+    parser.add_argument('--validate_max_images', type=int, default=None)
+    args = parser.parse_args()
+    check_storage_dtype(args.dtype)
+
+    if args.feature_folders and args.num_workers > 0:
+        assert not args.img_tsvs, "--num_workers only applies to --feature_folders"
+        convert_pkl_folders(args.feature_folders, args.output_dir, num_workers=args.num_workers, images_per_shard=args.images_per_shard, dtype=args.dtype)
+    elif args.feature_folders or args.img_tsvs:
+        writer = FeatureStoreWriter(args.output_dir, images_per_shard=args.images_per_shard, dtype=args.dtype)
+        if args.feature_folders:
+            write_from_pkl(writer, args.feature_folders)
+        if args.img_tsvs:
+            write_from_tsv(writer, args.img_tsvs)
+        writer.close()
+    if args.precompute_vis_pe:
+        precompute_vis_pe(args.output_dir)
+    if args.validate:
+        validate_store(args.output_dir, args.validate, max_images=args.validate_max_images)
+
+
+if __name__ == "__main__":
+    main()
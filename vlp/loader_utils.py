@@ -1,8 +1,19 @@
 from random import randint, shuffle
 from random import random as rand
+import random
+import os
+import math
+import atexit
+import shutil
+import tempfile
+import fcntl
+import hashlib
 import pickle
 import json
+import itertools
+import multiprocessing
 from collections import namedtuple
+import numpy as np
 import torch
 import torch.nn as nn
 import unicodedata
@@ -47,6 +58,486 @@ def batch_list_to_batch_tensors(batch):
     return batch_tensors
 
 
+def trim_batch_tensors(batch_tensors, multiple_of=8):
+    """ Cut input_ids, segment_ids and input_mask (the first 3 fields of a training / filter batch) down from max_len
+        to the longest sequence of the batch, rounded up to multiple_of. The image prefix is part of every sequence
+        that has one, and no position attends to the padding that is cut off """
+    input_ids, segment_ids, input_mask = batch_tensors[:3]
+    max_len = input_ids.size(-1)
+    nonzero_cols = (input_ids.view(-1, max_len) != 0).sum(0).nonzero()
+    seq_len = int(nonzero_cols[-1]) + 1 if nonzero_cols.numel() > 0 else 1
+    seq_len = min(max_len, (seq_len + multiple_of - 1) // multiple_of * multiple_of)
+    if seq_len == max_len:
+        return batch_tensors
+    input_ids = input_ids[..., :seq_len].contiguous()
+    segment_ids = segment_ids[..., :seq_len].contiguous()
+    if input_mask.size(-1) == max_len: # compact span masks are expanded to the length of input_ids by the model
+        input_mask = input_mask[..., :seq_len, :seq_len].contiguous()
+    return [input_ids, segment_ids, input_mask] + list(batch_tensors[3:])
+
+
+def batch_list_to_trimmed_batch_tensors(batch):
+    return trim_batch_tensors(batch_list_to_batch_tensors(batch))
+
+
+def instance_length(instance):
+    """ (number of image contexts, number of text tokens) of a webqaDataset_* instance, an estimate of the sequence
+        length the processor makes of it: a filter instance is as long as its longest choice, qa concatenates its contexts """
+    Q, A = instance[4], instance[5]
+    if len(instance) == 9: # filter: gold, distractor, gold_cxt, distractor_cxt, Q, A, do_filter_task, context, example_id
+        gold, distractor, gold_cxt, distractor_cxt, context = instance[0], instance[1], instance[2], instance[3], instance[7]
+        if context == 'txt':
+            cxts, num_img = [f['fact'] for f in gold + distractor], 0
+        elif context == 'img':
+            cxts, num_img = list(gold_cxt) + list(distractor_cxt), 1
+        else: # both, gold_cxt / distractor_cxt hold (image, caption) pairs
+            cxts = [f['fact'] for f in gold + distractor] + [cxt for _, cxt in list(gold_cxt) + list(distractor_cxt)]
+            num_img = 1 if len(gold_cxt) + len(distractor_cxt) > 0 else 0
+        text_len = max([len(cxt) for cxt in cxts] + [0])
+    else: # qa: gold, [], gold_cxt, [], Q, A, Keywords_A, A_list, do_filter_task, context, example_id, Qcate
+        if instance[9] == 'txt':
+            text_len, num_img = sum(len(f) for f in instance[0]), 0
+        else: # at most 2 images
+            text_len, num_img = sum(len(cxt) for cxt in instance[2][:2]), min(len(instance[0]), 2)
+    return num_img, text_len + len(Q) + len(A)
+
+
+class LengthBucketBatchSampler(object):
+    """ Batch sampler that puts samples of similar length into the same batch, so trim_batch_tensors cuts most of the
+        padding. Every epoch the indexes are shuffled and cut into pools of pool_batches batches per replica, each pool
+        is sorted by lengths (e.g. instance_length: image contexts first, then text tokens) and batched, and the groups of
+        num_replicas consecutive batches are shuffled. Like DistributedSampler, each replica iterates over len(self)
+        batches of its own and the order only changes with set_epoch, which must be called before iter() """
+
+    def __init__(self, lengths, batch_size, num_replicas=None, rank=None, shuffle=True, pool_batches=50, seed=0):
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        assert 0 <= rank < num_replicas, "loader_utils: rank {} out of {} replicas".format(rank, num_replicas)
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.pool_batches = pool_batches
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = int(math.ceil(int(math.ceil(len(self.lengths) / float(batch_size))) / float(num_replicas)))
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths), generator=g).tolist()
+        else:
+            order = list(range(len(self.lengths)))
+        pool_size = self.batch_size * self.num_replicas * self.pool_batches
+        batches = []
+        for st in range(0, len(order), pool_size):
+            pool = sorted(order[st:st+pool_size], key=self.lengths.__getitem__)
+            batches.extend(pool[i:i+self.batch_size] for i in range(0, len(pool), self.batch_size))
+        # repeat batches until every replica has the same number, the replicas step through batches of similar length
+        total = self.num_batches * self.num_replicas
+        while len(batches) < total:
+            batches.extend(batches[:total-len(batches)])
+        groups = [batches[i:i+self.num_replicas] for i in range(0, total, self.num_replicas)]
+        if self.shuffle:
+            groups = [groups[i] for i in torch.randperm(len(groups), generator=g).tolist()]
+        return iter([group[self.rank] for group in groups])
+
+    def __len__(self):
+        return self.num_batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+def pack_img_regions(img, vis_pe, input_mask, img_end_pos, use_img_content=True):
+    """ Unpadded alternative to zero-padding an image context to max_len_img_cxt regions:
+        keep the regions that can be attended to and stop attending to the image positions past them """
+    n = min(img.size(0), img_end_pos - 1) if use_img_content else 0
+    if input_mask.dim() == 1:
+        # compact mask, the image span is its first one
+        input_mask[1] = min(int(input_mask[1]), 1 + n)
+    else:
+        input_mask[:, 1+n:img_end_pos].fill_(0)
+    return img[:n], vis_pe[:n]
+
+
+def span_attention_mask(max_len, spans, causal=None, compact=False):
+    """ max_len x max_len self-attention mask: every position attends to the (st, end) column spans (at most 2),
+        positions in the causal (st, end) block attend to the block only up to themselves.
+        With compact=True the int32 (st0, end0, st1, end1, causal_st, causal_end) boundaries are returned instead,
+        BertModel expands them on the device """
+    assert len(spans) <= 2, "loader_utils: at most 2 attention spans"
+    if compact:
+        bounds = [b for span in spans for b in span] + [0, 0] * (2 - len(spans)) + list(causal or (0, 0))
+        return torch.tensor(bounds, dtype=torch.int32)
+    input_mask = torch.zeros(max_len, max_len, dtype=torch.long)
+    for st, end in spans:
+        input_mask[:, st:end].fill_(1)
+    if causal is not None:
+        st, end = causal
+        input_mask[st:end, st:end].copy_(torch.ones(end - st, end - st, dtype=torch.long).tril_())
+    return input_mask
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_sha1(path, chunk_size=1 << 24):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dataset_sha1(dataset_json_path):
+    """ sha1 of a dataset json, or of the json a dataset_splits directory was made from """
+    if os.path.isdir(dataset_json_path):
+        with open(os.path.join(dataset_json_path, 'meta.json'), "r") as f:
+            return json.load(f)['sha1']
+    return file_sha1(dataset_json_path)
+
+
+def folder_stamp(folder):
+    """ A folder and its mtime, which changes when files are added to or removed from it """
+    if folder is None or not os.path.isdir(folder):
+        return folder
+    return [folder, os.stat(folder).st_mtime]
+
+
+def index_tokens(indexer, tokens, max_len=None, prefix_ids=None):
+    """ int64 ids of tokens, zero-padded to max_len (default len(tokens)). prefix_ids are the ids of a
+        constant head of tokens such as [CLS] + [UNK] * max_len_img_cxt, copied instead of looked up again.
+        Wordpieces go through indexer (one vocab dict lookup each), a numpy lookup of the strings is slower than the
+        dict; pre-indexed datasets (--pre_index_tokens) hold the ids already and indexer is a plain copy """
+    input_ids = np.zeros(len(tokens) if max_len is None else max_len, dtype=np.int64)
+    st = 0
+    if prefix_ids is not None:
+        st = len(prefix_ids)
+        input_ids[:st] = prefix_ids
+    input_ids[st:len(tokens)] = indexer(tokens[st:])
+    return input_ids
+
+
+def id_array_tokenize(tokenize, tokenizer):
+    """ tokenize returning the vocab ids of the pieces as an np.int32 array, for pre-indexed datasets """
+    vocab = tokenizer.vocab
+
+    def tokenize_ids(text):
+        return np.array([vocab[t] for t in tokenize(text)], dtype=np.int32)
+    return tokenize_ids
+
+
+def ids_to_lists(x):
+    """ Copy of a pre-indexed instance with its id arrays turned into lists of ints """
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, list):
+        return [ids_to_lists(v) for v in x]
+    if isinstance(x, tuple):
+        return tuple(ids_to_lists(v) for v in x)
+    if isinstance(x, dict):
+        return dict((k, ids_to_lists(v)) for k, v in x.items())
+    return x
+
+
+def read_ids_to_lists(instance):
+    """ Pre-indexed (gold, distractors, gold_cxt, distractor_cxt, Q, A, do_filter_task, context, example_id) instance with
+        lists instead of id arrays in the fields a processor reads and truncates: all the choices of a filter instance
+        (sampled by the dataset already), the gold contexts and Q / A of a QA instance. The distractors of a QA instance
+        are never read and keep their arrays """
+    gold, distractors, gold_cxt, distractor_cxt, Q, A, do_filter_task, context, example_id = instance
+    if do_filter_task:
+        distractors, distractor_cxt = ids_to_lists(distractors), ids_to_lists(distractor_cxt)
+    return (ids_to_lists(gold), distractors, ids_to_lists(gold_cxt), distractor_cxt, ids_to_lists(Q), ids_to_lists(A), do_filter_task, context, example_id)
+
+
+_pool_tokenizer = None
+
+
+def _init_tokenize_worker(tokenizer):
+    global _pool_tokenizer
+    _pool_tokenizer = tokenizer
+
+
+def _tokenize_chunk(texts):
+    return [_pool_tokenizer.tokenize(t) for t in texts]
+
+
+def dataset_texts(dataset_J, split, Qcate, use_num_samples=-1):
+    """ Every string the webqaDataset_* loops tokenize, normalized the way they do it """
+    count = 0
+    for i in dataset_J:
+        datum = dataset_J[i]
+        if datum['split'] not in split or not (('all' in Qcate) or datum['Qcate'] in Qcate):
+            continue
+        if use_num_samples != -1 and count >= use_num_samples:
+            break
+        count += 1
+        yield datum['Q'].replace('"', "")
+        yield datum['A'][0].replace('"', "")
+        for fa in datum.get('txt_posFacts', []) + datum.get('txt_negFacts', []):
+            yield fa['fact']
+        for im in datum.get('img_posFacts', []) + datum.get('img_negFacts', []):
+            yield im['caption'].strip()
+
+
+def parallel_tokenize(tokenizer, dataset_J, split, Qcate, use_num_samples=-1, num_workers=0, chunk_size=2000):
+    """ tokenizer.tokenize backed by a table of the dataset texts, tokenized by a pool of num_workers processes.
+        Tokenization is a pure function of the text, so the instances come out identical to serial mode;
+        texts missing from the table are tokenized on the spot. """
+    if num_workers <= 1:
+        return tokenizer.tokenize
+    texts = list(dict.fromkeys(dataset_texts(dataset_J, split, Qcate, use_num_samples)))
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with multiprocessing.Pool(num_workers, initializer=_init_tokenize_worker, initargs=(tokenizer,)) as pool:
+        table = dict(zip(texts, itertools.chain.from_iterable(pool.imap(_tokenize_chunk, chunks))))
+    print("Tokenized {} unique texts with {} processes".format(len(texts), num_workers))
+
+    def tokenize(text):
+        # a fresh list per call like tokenizer.tokenize, repeated texts must not share one
+        return list(table[text]) if text in table else tokenizer.tokenize(text)
+    return tokenize
+
+
+class InstanceCache(object):
+    """ Persisted instance_list of a webqaDataset_*, keyed by everything its construction depends on.
+        The python random state is part of the key and restored on a hit, so the shuffles done while
+        building the instances come out the same as without the cache. """
+
+    def __init__(self, cache_dir, dataset, dataset_json_path, tokenizer, **key):
+        self.cache_dir = cache_dir
+        if cache_dir is None:
+            return
+        dataset_name = type(dataset).__name__
+        key.update(dataset='{}.{}'.format(type(dataset).__module__, dataset_name), dataset_json=dataset_sha1(dataset_json_path),
+                   vocab=_sha1(json.dumps(list(tokenizer.vocab.keys())).encode()),
+                   do_lower_case=getattr(getattr(tokenizer, 'basic_tokenizer', None), 'do_lower_case', None),
+                   random_state=_sha1(pickle.dumps(random.getstate())))
+        digest = _sha1(json.dumps(key, sort_keys=True, default=str).encode())
+        self.path = os.path.join(cache_dir, '{}.{}.pkl'.format(dataset_name, digest[:16]))
+
+    def load(self):
+        """ Cached instance_list, or None when it has to be built """
+        if self.cache_dir is None or not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            instance_list, random_state = pickle.load(f)
+        random.setstate(random_state)
+        print("Load {} instances from cache {}".format(len(instance_list), self.path))
+        return instance_list
+
+    def save(self, instance_list):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # several ranks may build the same dataset, the last rename wins
+        tmp = '{}.tmp{}'.format(self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump((instance_list, random.getstate()), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+
+SCRATCH_LOCK = '.lock'
+_scratch_locks = {}
+
+
+def run_scratch_dir(prefix, root=None):
+    """ New directory <root>/<prefix>.<pid>.<random> for the scratch files of this run, under /dev/shm when available.
+        The run holds an flock on the .lock file inside it until release_scratch_dir. Directories of earlier runs
+        whose lock can be taken (the run was killed, went out of memory) are removed first. Pids are not compared,
+        containers sharing /dev/shm may live in other pid namespaces """
+    if root is None:
+        root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.startswith(prefix + '.') or path in _scratch_locks:
+            continue
+        try:
+            fd = os.open(os.path.join(path, SCRATCH_LOCK), os.O_RDWR)
+        except OSError:
+            continue  # not a scratch dir, or its run has not taken the lock yet
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)  # alive
+            continue
+        try:
+            print("Remove stale {}".format(path))
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            pass  # removed by another run meanwhile
+        finally:
+            os.close(fd)
+    path = tempfile.mkdtemp(prefix='{}.{}.'.format(prefix, os.getpid()), dir=root)
+    fd = os.open(os.path.join(path, SCRATCH_LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    _scratch_locks[path] = fd
+    return path
+
+
+def release_scratch_dir(path):
+    """ Remove a run_scratch_dir of this run and drop its lock """
+    shutil.rmtree(path, ignore_errors=True)
+    fd = _scratch_locks.pop(path, None)
+    if fd is not None:
+        os.close(fd)
+
+
+# tags of the int32 streams of InstanceStore fields
+_LIST, _TUPLE, _DICT, _STR, _STRS, _INT, _BIGINT, _BOOL, _NONE, _IDS = range(10)
+
+
+def _encode(x, out, strings):
+    """ Append the int32 stream of x to out, interning its strings in strings ({str: id}) """
+    if isinstance(x, np.ndarray) and x.dtype == np.int32 and x.ndim == 1: # pre-indexed tokens
+        out.extend((_IDS, len(x)))
+        out.extend(x.tolist())
+    elif isinstance(x, str):
+        out.extend((_STR, strings.setdefault(x, len(strings))))
+    elif isinstance(x, bool):
+        out.extend((_BOOL, int(x)))
+    elif isinstance(x, (int, np.integer)):
+        if -2**31 <= x < 2**31:
+            out.extend((_INT, int(x)))
+        else:
+            out.extend((_BIGINT, strings.setdefault(str(int(x)), len(strings))))
+    elif x is None:
+        out.append(_NONE)
+    elif isinstance(x, list) and len(x) > 0 and all(isinstance(t, str) for t in x): # wordpiece tokens
+        out.extend((_STRS, len(x)))
+        out.extend(strings.setdefault(t, len(strings)) for t in x)
+    elif isinstance(x, (list, tuple)):
+        out.extend((_LIST if isinstance(x, list) else _TUPLE, len(x)))
+        for y in x:
+            _encode(y, out, strings)
+    elif isinstance(x, dict):
+        out.extend((_DICT, len(x)))
+        for k, v in x.items():
+            _encode(k, out, strings)
+            _encode(v, out, strings)
+    else:
+        raise TypeError("InstanceStore: can't store {} in an instance".format(type(x)))
+
+
+class InstanceStore(object):
+    """ Read-only, array-backed stand-in for the instance_list of a webqaDataset_*.
+        Field j of all instances is one concatenated int32 array field<j>.npy indexed by field<j>.offsets.npy, with the
+        strings (wordpieces, snippet ids, paths, Guids) interned in one utf-8 buffer. Pre-indexed token id arrays come
+        back as read-only views of the field array. All arrays are files of a run_scratch_dir opened with
+        np.load(mmap_mode='r'), so pickling the store into spawned workers only sends the directory and the workers
+        share the pages instead of holding a copy of the instances each. """
+
+    def __init__(self, instance_list, store_dir=None):
+        self.store_dir = run_scratch_dir('webqa_instances', store_dir)
+        self._owner = True
+        atexit.register(self.close)
+        self.num_fields = len(instance_list[0]) if len(instance_list) > 0 else 0
+        strings = {}
+        for j in range(self.num_fields):
+            values = []
+            offsets = np.zeros(len(instance_list) + 1, dtype=np.int64)
+            for i, instance in enumerate(instance_list):
+                assert len(instance) == self.num_fields, "InstanceStore: instances of {} and {} fields".format(self.num_fields, len(instance))
+                _encode(instance[j], values, strings)
+                offsets[i + 1] = len(values)
+            # one trailing element each, numpy can not memory-map empty arrays
+            np.save(os.path.join(self.store_dir, 'field{}.npy'.format(j)), np.array(values + [0], dtype=np.int32))
+            np.save(os.path.join(self.store_dir, 'field{}.offsets.npy'.format(j)), offsets)
+        encoded = [t.encode('utf-8') for t in sorted(strings, key=strings.get)]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        string_offsets[1:] = np.cumsum([len(b) for b in encoded])
+        np.save(os.path.join(self.store_dir, 'strings.npy'), np.frombuffer(b''.join(encoded) + b'\0', dtype=np.uint8))
+        np.save(os.path.join(self.store_dir, 'strings.offsets.npy'), string_offsets)
+        self.num_instances = len(instance_list)
+        self._attach()
+        size = sum(os.path.getsize(os.path.join(self.store_dir, f)) for f in os.listdir(self.store_dir))
+        print("InstanceStore: {} instances, {} strings, {:.1f} MB in {}".format(len(self), len(strings), size / 1e6, self.store_dir))
+
+    def _attach(self):
+        load = lambda name: np.load(os.path.join(self.store_dir, name), mmap_mode='r')
+        self._fields = [load('field{}.npy'.format(j)) for j in range(self.num_fields)]
+        self._field_offsets = [load('field{}.offsets.npy'.format(j)) for j in range(self.num_fields)]
+        self._strings = load('strings.npy')
+        self._string_offsets = load('strings.offsets.npy')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['_fields', '_field_offsets', '_strings', '_string_offsets']:
+            del state[k]
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def __len__(self):
+        return self.num_instances
+
+    def _string(self, i):
+        return self._strings[self._string_offsets[i]:self._string_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def _decode(self, arr, values, pos):
+        """ (value, next pos) of the stream starting at values[pos], values is arr.tolist() """
+        tag = values[pos]
+        if tag == _IDS:
+            n = values[pos + 1]
+            return arr[pos + 2:pos + 2 + n], pos + 2 + n
+        if tag == _STR:
+            return self._string(values[pos + 1]), pos + 2
+        if tag == _STRS:
+            n = values[pos + 1]
+            return [self._string(i) for i in values[pos + 2:pos + 2 + n]], pos + 2 + n
+        if tag == _INT:
+            return values[pos + 1], pos + 2
+        if tag == _BIGINT:
+            return int(self._string(values[pos + 1])), pos + 2
+        if tag == _BOOL:
+            return bool(values[pos + 1]), pos + 2
+        if tag == _NONE:
+            return None, pos + 1
+        n, pos = values[pos + 1], pos + 2
+        if tag == _DICT:
+            out = {}
+            for _ in range(n):
+                k, pos = self._decode(arr, values, pos)
+                out[k], pos = self._decode(arr, values, pos)
+            return out, pos
+        out = []
+        for _ in range(n):
+            x, pos = self._decode(arr, values, pos)
+            out.append(x)
+        return (out if tag == _LIST else tuple(out)), pos
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("InstanceStore: index {} out of range".format(idx))
+        instance = []
+        for field, offsets in zip(self._fields, self._field_offsets):
+            arr = field[offsets[idx]:offsets[idx + 1]]
+            instance.append(self._decode(arr, arr.tolist(), 0)[0])
+        return tuple(instance)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def close(self):
+        if self._owner:
+            self._fields = self._field_offsets = self._strings = self._string_offsets = None
+            release_scratch_dir(self.store_dir)
+            self._owner = False
+
+
 class Pipeline():
     """ Pre-process Pipeline Class : callable """
 
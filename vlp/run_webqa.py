@@ -27,11 +27,15 @@ import random
 import copy
 
 from pytorch_pretrained_bert.tokenization import BertTokenizer, WhitespaceTokenizer
-from pytorch_pretrained_bert.modeling import BertForWebqa
+from pytorch_pretrained_bert.modeling import BertForWebqa, VisEmbeddingCache
 from pytorch_pretrained_bert.optimization import BertAdam, warmup_linear
 
-from vlp.loader_utils import batch_list_to_batch_tensors
+from vlp.loader_utils import batch_list_to_batch_tensors, batch_list_to_trimmed_batch_tensors, instance_length, LengthBucketBatchSampler
 import vlp.webqa_loader as webqa_loader
+from vlp.feature_store import FeatureStore, check_storage_dtype
+from vlp.feature_cache import SharedFeatureCache
+from vlp.candidate_index import CandidateDataset, CandidateIndexWriter, CandidateIndex, encode_candidates, batch_choice_keys, load_top_k_choices, \
+    choice_pool, RetrievedChoices, OpenPoolRetriever, open_pool_retrieval
 from misc.data_parallel import DataParallelImbalance
 import matplotlib.pyplot as plt
 from datetime import datetime
@@ -53,7 +57,14 @@ def _get_max_epoch_model(output_dir):
     else:
         return None
 
-def _get_loader_from_dataset(train_dataset, world_size, train_batch_size, num_workers, collate_fn):
+def _get_loader_from_dataset(train_dataset, world_size, train_batch_size, num_workers, collate_fn, bucket_by_length=False, seed=0):
+    if bucket_by_length:
+        print("\nLengthBucketBatchSampler")
+        train_sampler = LengthBucketBatchSampler([instance_length(instance) for instance in train_dataset.instance_list], train_batch_size, seed=seed)
+        train_dataloader = torch.utils.data.DataLoader(train_dataset,
+            batch_sampler=train_sampler, num_workers=num_workers,
+            collate_fn=collate_fn, pin_memory=True)
+        return train_dataloader, train_sampler
     if world_size == 1:
         print("\nRandomSampler")
         train_sampler = RandomSampler(train_dataset, replacement=False)
@@ -194,6 +205,31 @@ def main():
     parser.add_argument('--gold_feature_folder', type=str, default="/data/yingshac/MMMHQA/imgFeatures_upd/gold")
     parser.add_argument('--distractor_feature_folder', type=str, default="/data/yingshac/MMMHQA/imgFeatures_upd/distractors")
     parser.add_argument('--x_distractor_feature_folder', type=str, default="/data/yingshac/MMMHQA/imgFeatures_x_distractors/x_distractors")
+    parser.add_argument('--feature_cache_gb', type=float, default=0, help="size of the shared-memory LRU cache of decoded image features, 0 to disable")
+    parser.add_argument('--feature_store_dir', type=str, default=None, help="packed feature store built by vlp/feature_store.py, replaces the .pkl feature folders")
+    parser.add_argument('--feature_dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'], help="dtype img features / vis_pe are shipped in from the data workers, the model upcasts them (bfloat16 needs torch>=1.10)")
+    parser.add_argument('--pack_img_regions', action='store_true', help="ship the regions of each image unpadded instead of zero-padded to max_len_img_cxt, padded regions are masked out (rejected with torch.nn.DataParallel)")
+    parser.add_argument('--dataset_cache_dir', type=str, default=None, help="cache the tokenized dataset instances here, rebuilt when the dataset file, split, Qcate, vocab or use_num_samples change")
+    parser.add_argument('--num_tokenize_workers', type=int, default=0, help="tokenize the dataset texts with this many processes while building the instances, 0 for serial")
+    parser.add_argument('--pre_index_tokens', action='store_true', help="keep the dataset texts as int32 vocab ids instead of wordpiece strings")
+    parser.add_argument('--compact_instances', action='store_true', help="keep the dataset instances in memory-mapped flat arrays that the data workers share instead of copying")
+    parser.add_argument('--compact_attention_mask', action='store_true', help="ship the self-attention masks as a few span boundaries per sample and build them on the device")
+    parser.add_argument('--ragged_filter_choices', action='store_true', help="filter task: batch only the real choices of each sample instead of padding them with placeholders to txt/img_filter_max_choices (rejected with torch.nn.DataParallel)")
+    parser.add_argument('--trim_batch_seq_len', action='store_true', help="cut the padding of each batch down to its longest sequence instead of max_seq_length")
+    parser.add_argument('--bucket_by_length', action='store_true', help="batch samples of similar length (and number of images) together, best combined with --trim_batch_seq_len")
+    parser.add_argument('--filter_scoring', default='cross_encoder', choices=['cross_encoder', 'late_interaction'], help="filter task: cross_encoder encodes Q with every choice, late_interaction encodes Q once per sample and matches its tokens with those of the choices encoded without Q")
+    parser.add_argument('--build_candidate_index', type=str, default=None, help="filter inference with a late_interaction model: encode every distinct choice of the datasets once and write their embeddings to this directory")
+    parser.add_argument('--candidate_index_dir', type=str, default=None, help="filter inference with a late_interaction model: only encode the questions and take the choice embeddings from this --build_candidate_index directory")
+    parser.add_argument('--rerank_choices_json', type=str, default=None, help="filter inference: only score the --rerank_top_k best choices of every question in this output json of a previous filter inference")
+    parser.add_argument('--rerank_top_k', type=int, default=5)
+    parser.add_argument('--open_pool_top_n', type=int, default=None, help="filter inference with --candidate_index_dir: retrieve this many choices per question among all distinct choices of the datasets instead of scoring its own choices")
+    parser.add_argument('--ann_candidates', type=int, default=100, help="choices found by the ANN search and scored exactly for every question with --open_pool_top_n")
+    parser.add_argument('--ann_backend', default='numpy', choices=['numpy', 'faiss', 'exact'], help="ANN index of --open_pool_top_n, faiss needs faiss installed, exact scores every choice")
+    parser.add_argument('--ann_nlist', type=int, default=None, help="number of IVF lists, 4 * sqrt(number of choices) by default")
+    parser.add_argument('--ann_nprobe', type=int, default=8, help="IVF lists searched per question")
+    parser.add_argument('--vis_embed_cache_size', type=int, default=0, help="inference: keep the vis_embed / vis_pe_embed outputs of up to this many images on the device and skip the MLPs for repeated images of img-context batches, 'both' batches are not cached (0: off, single GPU)")
+    parser.add_argument('--vis_embed_cache_file', type=str, default=None, help="load the --vis_embed_cache_size cache from this file if it exists and save it back at the end")
+    parser.add_argument('--attention_backend', default='matmul', choices=['matmul', 'sdpa'], help="self-attention implementation, sdpa uses torch.nn.functional.scaled_dot_product_attention (torch>=2.0)")
 
     #parser.add_argument('--img_metadata_path', type=str, default="/home/yingshac/CYS/WebQnA/WebQnA_data/img_metadata-Copy1.json", help="how many samples should be loaded into memory")
     parser.add_argument('--use_num_samples', type=int, default=-1, help="how many samples should be loaded into memory")
@@ -248,6 +284,7 @@ def main():
                         help='Self-critical sequence training')
 
     args = parser.parse_args()
+    check_storage_dtype(args.feature_dtype)
 
     log_txt_content = []
     print('global_rank: {}, local rank: {}'.format(args.global_rank, args.local_rank))
@@ -287,6 +324,12 @@ def main():
             world_size=args.world_size, rank=args.global_rank)
     logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
         device, n_gpu, bool(args.local_rank != -1), args.fp16))
+    # torch.nn.DataParallel scatters the flat (sum(vis_lens), dim) region tensors along dim 0, out of step with the samples
+    assert not (args.pack_img_regions and n_gpu > 1 and args.local_rank == -1), \
+        "--pack_img_regions does not work with torch.nn.DataParallel, use one GPU or --local_rank (DistributedDataParallel)"
+    # the ragged choice rows of a batch are not B * max_choices, a dim 0 scatter would not match logit_mask and filter_label
+    assert not (args.ragged_filter_choices and n_gpu > 1 and args.local_rank == -1), \
+        "--ragged_filter_choices does not work with torch.nn.DataParallel, use one GPU or --local_rank (DistributedDataParallel)"
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
@@ -314,13 +357,19 @@ def main():
         tokenizer.max_len = args.max_position_embeddings
     # doesn't support WhitespaceTokenizer
 
+    feature_store = FeatureStore(args.feature_store_dir) if args.feature_store_dir else None
+    feature_cache = None
+    if args.feature_cache_gb > 0:
+        feature_cache = SharedFeatureCache(args.feature_cache_gb * 1e9, img_dim=2048, vis_pe_dim=1607, max_regions=args.len_vis_input, dtype=args.feature_dtype)
     processor = webqa_loader.Preprocess4webqa(args.max_pred, args.mask_prob, \
             list(tokenizer.vocab.keys()), tokenizer.convert_tokens_to_ids, seed=args.seed, max_len=args.max_seq_length, \
             len_vis_input=args.len_vis_input, max_len_a=args.max_len_a, max_len_b=args.max_len_b, \
             max_len_img_cxt=args.max_len_img_cxt, new_segment_ids=args.new_segment_ids, \
             truncate_config={'trunc_seg': args.trunc_seg, 'always_truncate_tail': args.always_truncate_tail}, \
-            use_img_meta=args.use_img_meta, use_img_content=args.use_img_content, use_txt_fact=args.use_txt_fact)
+            use_img_meta=args.use_img_meta, use_img_content=args.use_img_content, use_txt_fact=args.use_txt_fact, \
+            feature_store=feature_store, feature_cache=feature_cache, feature_dtype=args.feature_dtype, pack_img_regions=args.pack_img_regions, pre_indexed=args.pre_index_tokens, compact_attention_mask=args.compact_attention_mask, ragged_filter_choices=args.ragged_filter_choices, filter_scoring=args.filter_scoring)
     
+    collate_fn = batch_list_to_trimmed_batch_tensors if args.trim_batch_seq_len else batch_list_to_batch_tensors
     train_dataloaders = []
     train_samplers = []
     if "filter" in args.task_to_learn:
@@ -331,13 +380,13 @@ def main():
                     batch_size=args.train_batch_size, tokenizer=tokenizer, gold_feature_folder=args.gold_feature_folder, \
                     distractor_feature_folder=args.distractor_feature_folder, x_distractor_feature_folder=args.x_distractor_feature_folder, \
                     use_num_samples=args.use_num_samples, processor=processor, answer_provided_by='txt', \
-                    max_snippets=args.txt_filter_max_choices, max_imgs=args.img_filter_max_choices, device=device)
+                    max_snippets=args.txt_filter_max_choices, max_imgs=args.img_filter_max_choices, device=device, feature_store=feature_store, dataset_cache_dir=args.dataset_cache_dir, num_tokenize_workers=args.num_tokenize_workers, pre_index=args.pre_index_tokens, compact_instances=args.compact_instances)
             else:
                 train_dataset = webqa_loader.webqaDataset_filter(dataset_json_path=args.txt_dataset_json_path, split=args.split, Qcate=args.Qcate, \
                     batch_size=args.train_batch_size, tokenizer=tokenizer, use_num_samples=args.use_num_samples, \
-                    processor=processor, filter_max_choices=args.txt_filter_max_choices, device=device)
+                    processor=processor, filter_max_choices=args.txt_filter_max_choices, device=device, dataset_cache_dir=args.dataset_cache_dir, num_tokenize_workers=args.num_tokenize_workers, pre_index=args.pre_index_tokens, compact_instances=args.compact_instances)
 
-            train_dataloader, train_sampler = _get_loader_from_dataset(train_dataset, args.world_size, args.train_batch_size, args.num_workers, batch_list_to_batch_tensors)
+            train_dataloader, train_sampler = _get_loader_from_dataset(train_dataset, args.world_size, args.train_batch_size, args.num_workers, collate_fn, bucket_by_length=args.bucket_by_length, seed=args.seed)
             train_dataloaders.append(train_dataloader)
             train_samplers.append(train_sampler)
         
@@ -348,13 +397,13 @@ def main():
                     batch_size=args.train_batch_size, tokenizer=tokenizer, gold_feature_folder=args.gold_feature_folder, \
                     distractor_feature_folder=args.distractor_feature_folder, x_distractor_feature_folder=args.x_distractor_feature_folder, \
                     use_num_samples=args.use_num_samples, processor=processor, answer_provided_by='img', \
-                    max_snippets=args.txt_filter_max_choices, max_imgs=args.img_filter_max_choices, device=device)
+                    max_snippets=args.txt_filter_max_choices, max_imgs=args.img_filter_max_choices, device=device, feature_store=feature_store, dataset_cache_dir=args.dataset_cache_dir, num_tokenize_workers=args.num_tokenize_workers, pre_index=args.pre_index_tokens, compact_instances=args.compact_instances)
             else:
                 train_dataset = webqa_loader.webqaDataset_filter_with_img(dataset_json_path=args.img_dataset_json_path, split=args.split, Qcate=args.Qcate, \
                     batch_size=args.train_batch_size, tokenizer=tokenizer, gold_feature_folder=args.gold_feature_folder, \
                     distractor_feature_folder=args.distractor_feature_folder, use_num_samples=args.use_num_samples, \
-                    processor=processor, filter_max_choices=args.img_filter_max_choices, device=device)
-            train_dataloader, train_sampler = _get_loader_from_dataset(train_dataset, args.world_size, args.train_batch_size, args.num_workers, batch_list_to_batch_tensors)
+                    processor=processor, filter_max_choices=args.img_filter_max_choices, device=device, feature_store=feature_store, dataset_cache_dir=args.dataset_cache_dir, num_tokenize_workers=args.num_tokenize_workers, pre_index=args.pre_index_tokens, compact_instances=args.compact_instances)
+            train_dataloader, train_sampler = _get_loader_from_dataset(train_dataset, args.world_size, args.train_batch_size, args.num_workers, collate_fn, bucket_by_length=args.bucket_by_length, seed=args.seed)
             train_dataloaders.append(train_dataloader)
             train_samplers.append(train_sampler)
     
@@ -362,9 +411,9 @@ def main():
         if "txt" in args.answer_provided_by:
             train_dataset = webqa_loader.webqaDataset_qa(dataset_json_path=args.txt_dataset_json_path, split=args.split, Qcate=args.Qcate, \
                     batch_size=args.train_batch_size, tokenizer=tokenizer, use_num_samples=args.use_num_samples, \
-                    processor=processor, device=device)
+                    processor=processor, device=device, dataset_cache_dir=args.dataset_cache_dir, num_tokenize_workers=args.num_tokenize_workers, pre_index=args.pre_index_tokens, compact_instances=args.compact_instances)
 
-            train_dataloader, train_sampler = _get_loader_from_dataset(train_dataset, args.world_size, args.train_batch_size, args.num_workers, batch_list_to_batch_tensors)
+            train_dataloader, train_sampler = _get_loader_from_dataset(train_dataset, args.world_size, args.train_batch_size, args.num_workers, collate_fn, bucket_by_length=args.bucket_by_length, seed=args.seed)
             train_dataloaders.append(train_dataloader)
             train_samplers.append(train_sampler)
         
@@ -372,8 +421,8 @@ def main():
             train_dataset = webqa_loader.webqaDataset_qa_with_img(dataset_json_path=args.img_dataset_json_path, split=args.split, Qcate=args.Qcate, \
                     batch_size=args.train_batch_size, tokenizer=tokenizer, gold_feature_folder=args.gold_feature_folder, \
                     distractor_feature_folder=args.distractor_feature_folder, use_num_samples=args.use_num_samples, \
-                    processor=processor, device=device)
-            train_dataloader, train_sampler = _get_loader_from_dataset(train_dataset, args.world_size, args.train_batch_size, args.num_workers, batch_list_to_batch_tensors)
+                    processor=processor, device=device, feature_store=feature_store, dataset_cache_dir=args.dataset_cache_dir, num_tokenize_workers=args.num_tokenize_workers, pre_index=args.pre_index_tokens, compact_instances=args.compact_instances)
+            train_dataloader, train_sampler = _get_loader_from_dataset(train_dataset, args.world_size, args.train_batch_size, args.num_workers, collate_fn, bucket_by_length=args.bucket_by_length, seed=args.seed)
             train_dataloaders.append(train_dataloader)
             train_samplers.append(train_sampler)
 
@@ -420,7 +469,7 @@ def main():
             config_path=args.config_path, task_idx=task_idx_proj,
             max_position_embeddings=args.max_position_embeddings, label_smoothing=args.label_smoothing,
             fp32_embedding=args.fp32_embedding, cache_dir=args.output_dir+'/.pretrained_model_{}'.format(args.global_rank),
-            drop_prob=args.drop_prob, max_len_img_cxt=args.max_len_img_cxt)
+            drop_prob=args.drop_prob, attention_backend=args.attention_backend, max_len_img_cxt=args.max_len_img_cxt, filter_scoring=args.filter_scoring)
         global_step = 0
     else:
         if recover_step:
@@ -446,7 +495,7 @@ def main():
                 config_path=args.config_path, task_idx=task_idx_proj,
                 max_position_embeddings=args.max_position_embeddings, label_smoothing=args.label_smoothing,
                 fp32_embedding=args.fp32_embedding, cache_dir=args.output_dir+'/.pretrained_model_{}'.format(args.global_rank),
-                drop_prob=args.drop_prob, max_len_img_cxt=args.max_len_img_cxt)
+                drop_prob=args.drop_prob, attention_backend=args.attention_backend, max_len_img_cxt=args.max_len_img_cxt, filter_scoring=args.filter_scoring)
         else:
             raise NotImplementedError
 
@@ -548,10 +597,11 @@ def main():
             start_epoch = 1
         for i_epoch in trange(start_epoch, args.num_train_epochs+1, desc="Epoch"):
             print(i_epoch)
-            dataloader_iters = [iter(l) for l in train_dataloaders]
-            if args.local_rank >= 0:
-                for train_sampler in train_samplers:
+            # set the epoch before iter(), the samplers draw their order when the loader iterator is created
+            for train_sampler in train_samplers:
+                if hasattr(train_sampler, 'set_epoch'):
                     train_sampler.set_epoch(i_epoch-1)
+            dataloader_iters = [iter(l) for l in train_dataloaders]
             iter_bar = tqdm(train_dataloader_order, desc='Iter (loss=X.XXX), loader_idx=X') 
             nbatches = sum(loader_lengths)
             
@@ -565,7 +615,8 @@ def main():
                     if torch.isnan(model.state_dict()[param_tensor]).any().item():
                         print("\n nan exists in ", param_tensor)
                 batch = [t.to(device) if not isinstance(t, list) else t for t in batch ]
-                input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, do_filter_task, filter_label, logit_mask, ori_choices, task_idx, img, vis_pe, context, cxt_modality_label, example_ids = batch
+                input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, do_filter_task, filter_label, logit_mask, ori_choices, task_idx, img, vis_pe, context, cxt_modality_label, example_ids, vis_lens = batch
+                if not args.pack_img_regions: vis_lens = None # collated from None placeholders
                 if args.fp16:
                     img = img.half()
                     vis_pe = vis_pe.half()
@@ -576,7 +627,7 @@ def main():
                 loss_tuple = model(vis_feats=conv_feats, vis_pe=vis_pe, input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask, \
                         masked_lm_labels=masked_ids, do_filter_task=do_filter_task, filter_label=filter_label, logit_mask=logit_mask, context=context, \
                         cxt_modality_label=cxt_modality_label, next_sentence_label=is_next, masked_pos=masked_pos, masked_weights=masked_weights, \
-                        task_idx=task_idx, drop_worst_ratio=args.max_drop_worst_ratio if i_epoch > args.drop_after else 0)
+                        task_idx=task_idx, drop_worst_ratio=args.max_drop_worst_ratio if i_epoch > args.drop_after else 0, vis_lens=vis_lens)
                 mean_reward = loss_tuple[0].new(1).fill_(0)
 
                 # disable pretext_loss_deprecated for now
@@ -649,6 +700,8 @@ def main():
             print(qa_loss)
             print(filter_loss)
             print(loss_dict)
+            if feature_cache is not None:
+                logger.info("feature cache: {}".format(feature_cache.stats()))
             
             # Save a trained model
             logger.info(
@@ -721,7 +774,8 @@ def main():
                     if torch.isnan(model.state_dict()[param_tensor]).any().item():
                         print("\n nan exists in ", param_tensor)
                 batch = [t.to(device) if not isinstance(t, list) else t for t in batch ]
-                input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, do_filter_task, filter_label, logit_mask, ori_choices, task_idx, img, vis_pe, context, cxt_modality_label, example_ids = batch
+                input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, do_filter_task, filter_label, logit_mask, ori_choices, task_idx, img, vis_pe, context, cxt_modality_label, example_ids, vis_lens = batch
+                if not args.pack_img_regions: vis_lens = None # collated from None placeholders
                 if args.fp16:
                     img = img.half()
                     vis_pe = vis_pe.half()
@@ -732,7 +786,7 @@ def main():
                 loss_tuple = model(vis_feats=conv_feats, vis_pe=vis_pe, input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask, \
                     masked_lm_labels=masked_ids, do_filter_task=do_filter_task, filter_label=filter_label, logit_mask=logit_mask, context=context, \
                         cxt_modality_label=cxt_modality_label, next_sentence_label=is_next, masked_pos=masked_pos, masked_weights=masked_weights, \
-                        task_idx=task_idx, drop_worst_ratio=0)
+                        task_idx=task_idx, drop_worst_ratio=0, vis_lens=vis_lens)
                 mean_reward = loss_tuple[0].new(1).fill_(0)
 
                 # disable pretext_loss_deprecated for now
@@ -759,6 +813,8 @@ def main():
             print(qa_loss)
             print(filter_loss)
             print(loss_dict)
+            if feature_cache is not None:
+                logger.info("feature cache: {}".format(feature_cache.stats()))
             print("Mean loss = ", np.mean([l for L in loss_dict for l in L]))
             
             logger.info("***** CUDA.empty_cache() *****")
@@ -784,6 +840,67 @@ def main():
             print("\ntxt Filter_max_choices: {}".format(args.txt_filter_max_choices))
         print("-------------------- Filter Inference mode ------------------------")
         log_txt_content.append("-------------------- Filter Inference mode ------------------------")
+
+        if args.filter_scoring == 'late_interaction':
+            # the index and the question passes have to see the same tokens of a long snippet on every run
+            processor.always_truncate_tail = True
+        if args.build_candidate_index:
+            assert args.filter_scoring == 'late_interaction', "--build_candidate_index needs a --filter_scoring late_interaction model"
+            writer = CandidateIndexWriter(args.build_candidate_index)
+            for l in train_dataloaders:
+                for modality, num_choices in [('txt', args.txt_filter_max_choices), ('img', args.img_filter_max_choices)]:
+                    candidates = CandidateDataset(l.dataset, num_choices, modality, skip_keys=writer.entries)
+                    if len(candidates) > 0:
+                        encode_candidates(model, candidates, writer, args.train_batch_size, args.num_workers, collate_fn, device, fp16=args.fp16, pack_img_regions=args.pack_img_regions)
+            writer.close(checkpoint=os.path.join(args.ckpts_dir, "model.{0}.bin".format(recover_step)) if recover_step else args.model_recover_path)
+            return
+        candidate_index = None
+        if args.candidate_index_dir:
+            assert args.filter_scoring == 'late_interaction', "--candidate_index_dir needs a --filter_scoring late_interaction model"
+            candidate_index = CandidateIndex(args.candidate_index_dir)
+            print("\n{}: {} choices, built with {}".format(candidate_index, len(candidate_index), candidate_index.meta['checkpoint']))
+            log_txt_content.append("candidate_index_dir = {}".format(args.candidate_index_dir))
+        vis_embed_cache = None
+        if args.vis_embed_cache_size > 0:
+            # the image choices of a batch are its vis_feats rows, in the order of their keys in ori_choices
+            vis_embed_cache = VisEmbeddingCache(args.vis_embed_cache_size, args.vis_embed_cache_file,
+                config="x101fpn filter use_img_content={} pack_img_regions={} len_vis_input={} max_len_img_cxt={} feature_dtype={}".format(args.use_img_content, args.pack_img_regions, args.len_vis_input, args.max_len_img_cxt, args.feature_dtype)).bind(getattr(model, 'module', model))
+            print("\n{}".format(vis_embed_cache))
+        if args.open_pool_top_n:
+            assert candidate_index is not None, "--open_pool_top_n needs a --candidate_index_dir"
+            pool = {}
+            for l in train_dataloaders:
+                pool.update(choice_pool(l.dataset.instance_list))
+            retriever = OpenPoolRetriever(candidate_index, sorted(pool), backend=args.ann_backend, nlist=args.ann_nlist, nprobe=args.ann_nprobe)
+            print("\nOpen pool retrieval of the top {} among {} choices, {} ANN candidates per question ({})".format(args.open_pool_top_n, len(retriever.keys), args.ann_candidates, args.ann_backend))
+            log_txt_content.append("Open pool retrieval of the top {} among {} choices, {} ANN candidates per question ({}, nlist = {}, nprobe = {})".format(args.open_pool_top_n, len(retriever.keys), args.ann_candidates, args.ann_backend, args.ann_nlist, args.ann_nprobe))
+            k_list = sorted(set([k for k in [1, 5, 10] if k < args.open_pool_top_n] + [args.open_pool_top_n]))
+            output_pkl = {}
+            num_gold_retrieved = dict((k, 0.) for k in k_list)
+            for l in train_dataloaders:
+                outputs, recall = open_pool_retrieval(model, l, retriever, device, args.ann_candidates, args.open_pool_top_n, k_list)
+                output_pkl.update(outputs)
+                for k in k_list:
+                    num_gold_retrieved[k] += recall[k] * len([o for o in outputs.values() if o['num_gold'] > 0])
+            num_with_gold = max(len([o for o in output_pkl.values() if o['num_gold'] > 0]), 1)
+            for k in k_list:
+                print("recall@{} = {}".format(k, num_gold_retrieved[k] / num_with_gold))
+                log_txt_content.append("recall@{} = {}".format(k, num_gold_retrieved[k] / num_with_gold))
+            pkl_filename = "{}_{}_step{}_open_pool_top{}".format(str(args.split), args.use_num_samples, recover_step, args.open_pool_top_n)
+            with open(os.path.join(args.output_dir, "{}.json".format(pkl_filename)), "w") as f:
+                json.dump(output_pkl, f, indent=4)
+            with open(os.path.join(args.output_dir, "{}.txt".format(pkl_filename)), "w") as f:
+                f.write("\n".join(log_txt_content))
+            return
+        if args.rerank_choices_json:
+            top_k_choices, recall_at_k = load_top_k_choices(args.rerank_choices_json, args.rerank_top_k)
+            pool = {}
+            for l in train_dataloaders:
+                pool.update(choice_pool(l.dataset.instance_list))
+            for l in train_dataloaders:
+                l.dataset.processor = RetrievedChoices(l.dataset.processor, top_k_choices, pool)
+            print("\nRerank the top {} choices of {}, first stage recall@{} = {}".format(args.rerank_top_k, args.rerank_choices_json, args.rerank_top_k, recall_at_k))
+            log_txt_content.append("Rerank the top {} choices of {}, first stage recall@{} = {}".format(args.rerank_top_k, args.rerank_choices_json, args.rerank_top_k, recall_at_k))
         
         log_txt_content.append("split = {}".format(args.split))
         log_txt_content.append("use_num_samples = {}".format(args.use_num_samples))
@@ -813,22 +930,31 @@ def main():
                     if torch.isnan(model.state_dict()[param_tensor]).any().item():
                         print("\n nan exists in ", param_tensor)
                 batch = [t.to(device) if not isinstance(t, list) else t for t in batch ]
-                input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, do_filter_task, filter_label, logit_mask, ori_choices, task_idx, img, vis_pe, context, cxt_modality_label, example_ids = batch
+                input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next, do_filter_task, filter_label, logit_mask, ori_choices, task_idx, img, vis_pe, context, cxt_modality_label, example_ids, vis_lens = batch
+                if not args.pack_img_regions: vis_lens = None # collated from None placeholders
                 if args.fp16:
                     img = img.half()
                     vis_pe = vis_pe.half()
                         
                 conv_feats = img.data # Bx100x2048
                 vis_pe = vis_pe.data
+                choice_embeddings = None
+                if candidate_index is not None:
+                    choice_embeddings = candidate_index.lookup(batch_choice_keys(ori_choices, None if logit_mask.dtype == torch.long else logit_mask.size(1)), device)
+                vis_keys = batch_choice_keys(ori_choices) if vis_embed_cache is not None and context[0] == 'img' else None
 
                 # doesn't support scst training for not
                 cur_batch_score, pred = model(vis_feats=conv_feats, vis_pe=vis_pe, input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask, \
                         masked_lm_labels=masked_ids, do_filter_task=do_filter_task, filter_label=filter_label, logit_mask=logit_mask, context=context, \
                         cxt_modality_label=cxt_modality_label, next_sentence_label=is_next, masked_pos=masked_pos, masked_weights=masked_weights, \
-                        task_idx=task_idx, drop_worst_ratio=0, filter_infr_th=th_list)
+                        task_idx=task_idx, drop_worst_ratio=0, filter_infr_th=th_list, vis_lens=vis_lens, choice_embeddings=choice_embeddings, vis_keys=vis_keys)
                 assert len(cur_batch_score) == len(th_list)
-                Pred.append(pred)
-                Filter_labels.append(filter_label.detach().cpu())
+                if isinstance(pred, list): # --ragged_filter_choices, one tensor of choice scores per sample
+                    Pred.extend(p.numpy() for p in pred)
+                    Filter_labels.extend(l.numpy() for l in filter_label.detach().cpu().view(-1, 2).split([len(p) for p in pred]))
+                else:
+                    Pred.extend(pred.numpy())
+                    Filter_labels.extend(filter_label.detach().cpu().numpy())
                 Choices.extend(ori_choices)
                 Example_ids.extend(example_ids)
                 if "filter" in args.task_to_learn:
@@ -840,11 +966,7 @@ def main():
                 else:
                     raise ValueError("Currently don't support qa task in inference mode")
             
-            Pred = torch.cat(Pred, dim=0)
-            Pred = Pred.numpy()
             Pred = [["{0:.4f}".format(s) for s in p] for p in Pred]
-            Filter_labels = torch.cat(Filter_labels, dim=0)
-            Filter_labels = Filter_labels.numpy()
             Filter_labels = [[int(i[0]) for i in b] for b in Filter_labels]
             for th in th_list:
                 score_dict[th]['pr'] = np.sum(score_dict[th]['pr']) / float(total_samples)
@@ -879,6 +1001,9 @@ def main():
             f.write(pkl_filename)
             f.write("\n")
             f.write("\n".join(log_txt_content))
+        if vis_embed_cache is not None:
+            print(vis_embed_cache)
+            vis_embed_cache.save()
         torch.cuda.empty_cache()
 
 
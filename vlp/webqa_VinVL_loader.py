@@ -9,14 +9,33 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from vlp.loader_utils import get_random_word, batch_list_to_batch_tensors, Pipeline
-from vlp.ImgDataTsv import ImgDataTsv
+from vlp.loader_utils import get_random_word, batch_list_to_batch_tensors, pack_img_regions, span_attention_mask, index_tokens, InstanceCache, folder_stamp, parallel_tokenize, id_array_tokenize, read_ids_to_lists, InstanceStore, Pipeline
+from vlp.ImgDataTsv import ImgDataTsv, open_img_data
+from vlp.dataset_splits import load_dataset_J
+from vlp.feature_store import compute_vis_pe, img_and_vis_pe
 
 import os
 import imghdr
 import numpy as np
 import sys
 
+def load_img_and_vis_pe(image_id, img_data_tsv, feature_store=None, feature_cache=None, dtype=torch.float32):
+    """ (fc1_features, vis_pe) of one image in dtype, from the shared feature cache or the packed FeatureStore when given,
+        else from the tsv picked by the leading digit of image_id """
+    image_id = int(image_id)
+    if feature_cache is not None:
+        cached = feature_cache.get(image_id)
+        if cached is not None:
+            return tuple(x.to(dtype) for x in cached)
+    if feature_store is not None:
+        img, vis_pe = img_and_vis_pe(feature_store.get_tensors(image_id), dtype)
+    else:
+        pred_boxes, scores, img, cls_label = img_data_tsv[image_id//10000000][image_id % 10000000]
+        img, vis_pe = img.to(dtype), compute_vis_pe(pred_boxes, scores, cls_label).to(dtype)
+    if feature_cache is not None:
+        feature_cache.put(image_id, img, vis_pe)
+    return img, vis_pe
+
 def truncate_tokens_pair(tokens_a, tokens_b, max_len, max_len_a=0, max_len_b=0, trunc_seg=None, always_truncate_tail=False):
     num_truncated_a = [0, 0]
     num_truncated_b = [0, 0]
@@ -56,47 +75,58 @@ def truncate_tokens_pair(tokens_a, tokens_b, max_len, max_len_a=0, max_len_b=0,
 
 class webqaDataset_filter(torch.utils.data.Dataset):
     """ Load image feature path, q, a """
-    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, filter_max_choices=10, device=None):
+    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, filter_max_choices=10, device=None, dataset_cache_dir=None, num_tokenize_workers=0, pre_index=False, compact_instances=False):
         super().__init__()
         self.processor = processor
         self.tokenizer = tokenizer
         self.batch_size = batch_size
         self.filter_max_choices = filter_max_choices
         self.instance_list = []
+        self.pre_index = pre_index
         if device is not None:
             self.device=device
         assert os.path.exists(dataset_json_path), "loader.Dataset: dataset json file doesn't exist! {}".format(dataset_json_path)
-        with open(dataset_json_path, "r") as f:
-            dataset_J = json.load(f)
-        count = 0
-        for i in dataset_J:
-            datum = dataset_J[i]
-            if datum['split'] in split: # modify here after we create split!
-                if ('all' in Qcate) or datum['Qcate'] in Qcate:
-                    if use_num_samples == -1 or count < use_num_samples:
-                        Guid = datum['Guid']
-                        Q = self.tokenizer.tokenize(datum['Q'].replace('"', ""))
-                        A = self.tokenizer.tokenize(datum['A'][0].replace('"', ""))
-                        gold_facts = []
-                        distractor_facts = []
-                        for fa in datum['txt_posFacts']:
-                            gold_facts.append({
-                                'fact': self.tokenizer.tokenize(fa['fact']),
-                                'snippet_id': fa['snippet_id']
-                            })
-
-                        for fa in datum['txt_negFacts']:
-                            distractor_facts.append({
-                                'fact': self.tokenizer.tokenize(fa['fact']),
-                                'snippet_id': fa['snippet_id']
-                            })
-                        shuffle(gold_facts)
-                        shuffle(distractor_facts)
-                        self.instance_list.append((gold_facts, distractor_facts, [], [], Q, A, True, "txt", Guid)) # do_filter_task, context
+        instance_cache = InstanceCache(dataset_cache_dir, self, dataset_json_path, tokenizer, split=split, Qcate=Qcate, use_num_samples=use_num_samples, pre_index=pre_index)
+        cached = instance_cache.load()
+        if cached is not None:
+            self.instance_list = cached
+        else:
+            dataset_J = load_dataset_J(dataset_json_path, split, Qcate, use_num_samples)
+            tokenize = parallel_tokenize(self.tokenizer, dataset_J, split, Qcate, use_num_samples, num_tokenize_workers)
+            if pre_index:
+                tokenize = id_array_tokenize(tokenize, self.tokenizer)
+            count = 0
+            for i in dataset_J:
+                datum = dataset_J[i]
+                if datum['split'] in split: # modify here after we create split!
+                    if ('all' in Qcate) or datum['Qcate'] in Qcate:
+                        if use_num_samples == -1 or count < use_num_samples:
+                            Guid = datum['Guid']
+                            Q = tokenize(datum['Q'].replace('"', ""))
+                            A = tokenize(datum['A'][0].replace('"', ""))
+                            gold_facts = []
+                            distractor_facts = []
+                            for fa in datum['txt_posFacts']:
+                                gold_facts.append({
+                                    'fact': tokenize(fa['fact']),
+                                    'snippet_id': fa['snippet_id']
+                                })
+
+                            for fa in datum['txt_negFacts']:
+                                distractor_facts.append({
+                                    'fact': tokenize(fa['fact']),
+                                    'snippet_id': fa['snippet_id']
+                                })
+                            shuffle(gold_facts)
+                            shuffle(distractor_facts)
+                            self.instance_list.append((gold_facts, distractor_facts, [], [], Q, A, True, "txt", Guid)) # do_filter_task, context
                         
-                        count += 1
+                            count += 1
 
-        print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            instance_cache.save(self.instance_list)
+        if compact_instances:
+            self.instance_list = InstanceStore(self.instance_list)
 
     def __len__(self):
         return len(self.instance_list)
@@ -123,40 +153,51 @@ class webqaDataset_filter(torch.utils.data.Dataset):
 
 class webqaDataset_qa(torch.utils.data.Dataset):
     """ Load image feature path, q, a """
-    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, device=None):
+    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, device=None, dataset_cache_dir=None, num_tokenize_workers=0, pre_index=False, compact_instances=False):
         super().__init__()
         self.processor = processor
         self.tokenizer = tokenizer
         self.batch_size = batch_size
         self.instance_list = []
+        self.pre_index = pre_index
         if device is not None:
             self.device=device
         assert os.path.exists(dataset_json_path), "loader.Dataset: dataset json file doesn't exist! {}".format(dataset_json_path)
-        with open(dataset_json_path, "r") as f:
-            dataset_J = json.load(f)
-        count = 0
-        for i in dataset_J:
-            datum = dataset_J[i]
-            if datum['split'] in split: # modify here after we have split!!!!
-                if ('all' in Qcate) or datum['Qcate'] in Qcate:
-                    if use_num_samples == -1 or count < use_num_samples:
-                        guid = datum['Guid']
-                        qcate = datum['Qcate'] if 'Qcate' in datum else 'TBD'
-                        Q = self.tokenizer.tokenize(datum['Q'].replace('"', ""))
-                        A = self.tokenizer.tokenize(datum['A'][0].replace('"', ""))
-                        A_list = [a.replace('"', "") for a in datum['A']]
-                        try: Keywords_A = datum['Keywords_A'].replace('"', "")
-                        except: Keywords_A = "TBD"
-                        gold_facts = []
-                        distractor_facts = []
-                        for fa in datum['txt_posFacts']:
-                            gold_facts.append(self.tokenizer.tokenize(fa['fact']))
-
-                        self.instance_list.append((gold_facts, [], [], [], Q, A, Keywords_A, A_list, False, "txt", guid, qcate)) # do_filter_task, context
+        instance_cache = InstanceCache(dataset_cache_dir, self, dataset_json_path, tokenizer, split=split, Qcate=Qcate, use_num_samples=use_num_samples, pre_index=pre_index)
+        cached = instance_cache.load()
+        if cached is not None:
+            self.instance_list = cached
+        else:
+            dataset_J = load_dataset_J(dataset_json_path, split, Qcate, use_num_samples)
+            tokenize = parallel_tokenize(self.tokenizer, dataset_J, split, Qcate, use_num_samples, num_tokenize_workers)
+            if pre_index:
+                tokenize = id_array_tokenize(tokenize, self.tokenizer)
+            count = 0
+            for i in dataset_J:
+                datum = dataset_J[i]
+                if datum['split'] in split: # modify here after we have split!!!!
+                    if ('all' in Qcate) or datum['Qcate'] in Qcate:
+                        if use_num_samples == -1 or count < use_num_samples:
+                            guid = datum['Guid']
+                            qcate = datum['Qcate'] if 'Qcate' in datum else 'TBD'
+                            Q = tokenize(datum['Q'].replace('"', ""))
+                            A = tokenize(datum['A'][0].replace('"', ""))
+                            A_list = [a.replace('"', "") for a in datum['A']]
+                            try: Keywords_A = datum['Keywords_A'].replace('"', "")
+                            except: Keywords_A = "TBD"
+                            gold_facts = []
+                            distractor_facts = []
+                            for fa in datum['txt_posFacts']:
+                                gold_facts.append(tokenize(fa['fact']))
+
+                            self.instance_list.append((gold_facts, [], [], [], Q, A, Keywords_A, A_list, False, "txt", guid, qcate)) # do_filter_task, context
                         
-                        count += 1
+                            count += 1
 
-        print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            instance_cache.save(self.instance_list)
+        if compact_instances:
+            self.instance_list = InstanceStore(self.instance_list)
 
     def __len__(self):
         return len(self.instance_list)
@@ -179,7 +220,14 @@ class webqaDataset_qa(torch.utils.data.Dataset):
             yield batch_list_to_batch_tensors(batch)
 
     def get_QA_list(self):
-        return [i[4] for i in self.instance_list], [i[7] for i in self.instance_list], [i[6] for i in self.instance_list]
+
+        Q = [i[4] for i in self.instance_list]
+
+        if self.pre_index:
+
+            Q = [self.tokenizer.convert_ids_to_tokens(q.tolist()) for q in Q]
+
+        return Q, [i[7] for i in self.instance_list], [i[6] for i in self.instance_list]
     def get_guid_list(self):
         return [i[-2] for i in self.instance_list]
     def get_Qcate_list(self):
@@ -187,55 +235,66 @@ class webqaDataset_qa(torch.utils.data.Dataset):
 
 class webqaDataset_filter_with_img(torch.utils.data.Dataset):
     """ Load image feature path, q, a """
-    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, filter_max_choices=10, device=None):
+    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, filter_max_choices=10, device=None, dataset_cache_dir=None, num_tokenize_workers=0, pre_index=False, compact_instances=False):
         super().__init__()
         self.processor = processor
         self.tokenizer = tokenizer
         self.batch_size = batch_size
         self.filter_max_choices = filter_max_choices
         self.instance_list = []
+        self.pre_index = pre_index
         if device is not None:
             self.device=device
         assert os.path.exists(dataset_json_path), "loader.Dataset: dataset json file doesn't exist!"
-        with open(dataset_json_path, "r") as f:
-            dataset_J = json.load(f)
+        instance_cache = InstanceCache(dataset_cache_dir, self, dataset_json_path, tokenizer, split=split, Qcate=Qcate, use_num_samples=use_num_samples, pre_index=pre_index)
+        cached = instance_cache.load()
+        if cached is not None:
+            self.instance_list = cached
+        else:
+            dataset_J = load_dataset_J(dataset_json_path, split, Qcate, use_num_samples)
+            tokenize = parallel_tokenize(self.tokenizer, dataset_J, split, Qcate, use_num_samples, num_tokenize_workers)
+            if pre_index:
+                tokenize = id_array_tokenize(tokenize, self.tokenizer)
         
-        count = 0
-        for i in dataset_J:
-            datum = dataset_J[i]
-            if datum['split'] in split:
-                if ('all' in Qcate) or datum['Qcate'] in Qcate:
-                    if use_num_samples == -1 or count < use_num_samples:
-                        Guid = datum['Guid']
-                        Q = self.tokenizer.tokenize(datum['Q'].replace('"', ""))
-                        A = self.tokenizer.tokenize(datum['A'][0].replace('"', ""))
-
-                        gold_img_and_caps = []
-                        distractor_img_and_caps = []
-
-                        for im in datum['img_posFacts']:
-                            image_id = im['image_id']
-                            cxt = self.tokenizer.tokenize(im['caption'].strip())
-                            gold_img_and_caps.append((image_id, cxt))
-
-                        for im in datum['img_negFacts']:
-                            image_id = im['image_id']
-                            cxt = self.tokenizer.tokenize(im['caption'].strip())
-                            distractor_img_and_caps.append((image_id, cxt))
+            count = 0
+            for i in dataset_J:
+                datum = dataset_J[i]
+                if datum['split'] in split:
+                    if ('all' in Qcate) or datum['Qcate'] in Qcate:
+                        if use_num_samples == -1 or count < use_num_samples:
+                            Guid = datum['Guid']
+                            Q = tokenize(datum['Q'].replace('"', ""))
+                            A = tokenize(datum['A'][0].replace('"', ""))
+
+                            gold_img_and_caps = []
+                            distractor_img_and_caps = []
+
+                            for im in datum['img_posFacts']:
+                                image_id = im['image_id']
+                                cxt = tokenize(im['caption'].strip())
+                                gold_img_and_caps.append((image_id, cxt))
+
+                            for im in datum['img_negFacts']:
+                                image_id = im['image_id']
+                                cxt = tokenize(im['caption'].strip())
+                                distractor_img_and_caps.append((image_id, cxt))
                             
-                        shuffle(gold_img_and_caps)
-                        shuffle(distractor_img_and_caps)
+                            shuffle(gold_img_and_caps)
+                            shuffle(distractor_img_and_caps)
 
-                        gold_image_ids = [x[0] for x in gold_img_and_caps]
-                        distractor_image_ids = [x[0] for x in distractor_img_and_caps]
-                        gold_cxt_list = [x[1] for x in gold_img_and_caps]
-                        distractor_cxt_list = [x[1] for x in distractor_img_and_caps]
+                            gold_image_ids = [x[0] for x in gold_img_and_caps]
+                            distractor_image_ids = [x[0] for x in distractor_img_and_caps]
+                            gold_cxt_list = [x[1] for x in gold_img_and_caps]
+                            distractor_cxt_list = [x[1] for x in distractor_img_and_caps]
                         
-                        self.instance_list.append((gold_image_ids, distractor_image_ids, gold_cxt_list, distractor_cxt_list, Q, A, True, "img", Guid)) # do_filter_task, context
+                            self.instance_list.append((gold_image_ids, distractor_image_ids, gold_cxt_list, distractor_cxt_list, Q, A, True, "img", Guid)) # do_filter_task, context
                         
-                        count += 1
+                            count += 1
 
-        print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            instance_cache.save(self.instance_list)
+        if compact_instances:
+            self.instance_list = InstanceStore(self.instance_list)
 
     def __len__(self):
         return len(self.instance_list)
@@ -264,42 +323,53 @@ class webqaDataset_filter_with_img(torch.utils.data.Dataset):
 
 class webqaDataset_qa_with_img(torch.utils.data.Dataset):
     """ Load image feature path, q, a """
-    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, device=None):
+    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, device=None, dataset_cache_dir=None, num_tokenize_workers=0, pre_index=False, compact_instances=False):
         super().__init__()
         self.processor = processor
         self.tokenizer = tokenizer
         self.batch_size = batch_size
         self.instance_list = []
+        self.pre_index = pre_index
         if device is not None:
             self.device=device
         assert os.path.exists(dataset_json_path), "loader.Dataset: dataset json file doesn't exist!"
-        with open(dataset_json_path, "r") as f:
-            dataset_J = json.load(f)
+        instance_cache = InstanceCache(dataset_cache_dir, self, dataset_json_path, tokenizer, split=split, Qcate=Qcate, use_num_samples=use_num_samples, pre_index=pre_index)
+        cached = instance_cache.load()
+        if cached is not None:
+            self.instance_list = cached
+        else:
+            dataset_J = load_dataset_J(dataset_json_path, split, Qcate, use_num_samples)
+            tokenize = parallel_tokenize(self.tokenizer, dataset_J, split, Qcate, use_num_samples, num_tokenize_workers)
+            if pre_index:
+                tokenize = id_array_tokenize(tokenize, self.tokenizer)
         
-        count = 0
-        for i in dataset_J:
-            datum = dataset_J[i]
-            if datum['split'] in split:
-                if ('all' in Qcate) or datum['Qcate'] in Qcate:
-                    if use_num_samples == -1 or count < use_num_samples:
-                        guid = datum['Guid']
-                        qcate = datum['Qcate'] if 'Qcate' in datum else 'TBD'
-                        Q = self.tokenizer.tokenize(datum['Q'].replace('"', ""))
-                        A = self.tokenizer.tokenize(datum['A'][0].replace('"', ""))
-                        A_list = [a.replace('"', "") for a in datum['A']]
-                        try: Keywords_A = datum['Keywords_A'].replace('"', "")
-                        except: Keywords_A = "TBD"
-                        gold_image_ids = []
-                        gold_cxt_list = []
-                        for im in datum['img_posFacts']:
-                            image_id = im['image_id']
-                            gold_image_ids.append(image_id)
-                            cxt = self.tokenizer.tokenize(im['caption'].strip())
-                            gold_cxt_list.append(cxt)
-                        self.instance_list.append((gold_image_ids, [], gold_cxt_list, [], Q, A, Keywords_A, A_list, False, "img", guid, qcate)) # do_filter_task, context )
-                        count += 1
-
-        print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            count = 0
+            for i in dataset_J:
+                datum = dataset_J[i]
+                if datum['split'] in split:
+                    if ('all' in Qcate) or datum['Qcate'] in Qcate:
+                        if use_num_samples == -1 or count < use_num_samples:
+                            guid = datum['Guid']
+                            qcate = datum['Qcate'] if 'Qcate' in datum else 'TBD'
+                            Q = tokenize(datum['Q'].replace('"', ""))
+                            A = tokenize(datum['A'][0].replace('"', ""))
+                            A_list = [a.replace('"', "") for a in datum['A']]
+                            try: Keywords_A = datum['Keywords_A'].replace('"', "")
+                            except: Keywords_A = "TBD"
+                            gold_image_ids = []
+                            gold_cxt_list = []
+                            for im in datum['img_posFacts']:
+                                image_id = im['image_id']
+                                gold_image_ids.append(image_id)
+                                cxt = tokenize(im['caption'].strip())
+                                gold_cxt_list.append(cxt)
+                            self.instance_list.append((gold_image_ids, [], gold_cxt_list, [], Q, A, Keywords_A, A_list, False, "img", guid, qcate)) # do_filter_task, context )
+                            count += 1
+
+            print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            instance_cache.save(self.instance_list)
+        if compact_instances:
+            self.instance_list = InstanceStore(self.instance_list)
 
     def __len__(self):
         return len(self.instance_list)
@@ -322,7 +392,14 @@ class webqaDataset_qa_with_img(torch.utils.data.Dataset):
             yield batch_list_to_batch_tensors(batch)
 
     def get_QA_list(self):
-        return [i[4] for i in self.instance_list], [i[7] for i in self.instance_list], [i[6] for i in self.instance_list]
+
+        Q = [i[4] for i in self.instance_list]
+
+        if self.pre_index:
+
+            Q = [self.tokenizer.convert_ids_to_tokens(q.tolist()) for q in Q]
+
+        return Q, [i[7] for i in self.instance_list], [i[6] for i in self.instance_list]
     def get_guid_list(self):
         return [i[-2] for i in self.instance_list]
     def get_Qcate_list(self):
@@ -331,7 +408,7 @@ class webqaDataset_qa_with_img(torch.utils.data.Dataset):
 class webqaDataset_filter_with_both(torch.utils.data.Dataset):
     ## TODO: define a new Dataset, return img+cap in a tuple instead of two separate lists
     """ Load image feature path, q, a """
-    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, answer_provided_by, max_snippets=10, max_imgs=10, device=None):
+    def __init__(self, dataset_json_path, split, Qcate, batch_size, tokenizer, use_num_samples, processor, answer_provided_by, max_snippets=10, max_imgs=10, device=None, dataset_cache_dir=None, num_tokenize_workers=0, pre_index=False, compact_instances=False):
         super().__init__()
         self.processor = processor
         self.tokenizer = tokenizer
@@ -340,61 +417,72 @@ class webqaDataset_filter_with_both(torch.utils.data.Dataset):
         self.max_snippets = max_snippets
         self.max_imgs = max_imgs
         self.instance_list = []
+        self.pre_index = pre_index
         if device is not None:
             self.device=device
         assert os.path.exists(dataset_json_path), "loader.Dataset: dataset json file doesn't exist!"
-        with open(dataset_json_path, "r") as f:
-            dataset_J = json.load(f)
+        instance_cache = InstanceCache(dataset_cache_dir, self, dataset_json_path, tokenizer, split=split, Qcate=Qcate, use_num_samples=use_num_samples, pre_index=pre_index)
+        cached = instance_cache.load()
+        if cached is not None:
+            self.instance_list = cached
+        else:
+            dataset_J = load_dataset_J(dataset_json_path, split, Qcate, use_num_samples)
+            tokenize = parallel_tokenize(self.tokenizer, dataset_J, split, Qcate, use_num_samples, num_tokenize_workers)
+            if pre_index:
+                tokenize = id_array_tokenize(tokenize, self.tokenizer)
         
-        count = 0
-        for i in dataset_J:
-            datum = dataset_J[i]
-            if datum['split'] in split:
-                if ('all' in Qcate) or datum['Qcate'] in Qcate:
-                    if use_num_samples == -1 or count < use_num_samples:
-                        Guid = datum['Guid']
-                        Q = self.tokenizer.tokenize(datum['Q'].replace('"', ""))
-                        A = self.tokenizer.tokenize(datum['A'][0].replace('"', ""))
-
-                        gold_facts = []
-                        distractor_facts = []
-
-                        if 'txt_posFacts' in datum:
-                            for fa in datum['txt_posFacts']: 
-                                gold_facts.append({
-                                    'fact': self.tokenizer.tokenize(fa['fact']),
+            count = 0
+            for i in dataset_J:
+                datum = dataset_J[i]
+                if datum['split'] in split:
+                    if ('all' in Qcate) or datum['Qcate'] in Qcate:
+                        if use_num_samples == -1 or count < use_num_samples:
+                            Guid = datum['Guid']
+                            Q = tokenize(datum['Q'].replace('"', ""))
+                            A = tokenize(datum['A'][0].replace('"', ""))
+
+                            gold_facts = []
+                            distractor_facts = []
+
+                            if 'txt_posFacts' in datum:
+                                for fa in datum['txt_posFacts']: 
+                                    gold_facts.append({
+                                        'fact': tokenize(fa['fact']),
+                                        'snippet_id': fa['snippet_id']
+                                    })
+                            for fa in datum['txt_negFacts']:
+                                distractor_facts.append({
+                                    'fact': tokenize(fa['fact']),
                                     'snippet_id': fa['snippet_id']
                                 })
-                        for fa in datum['txt_negFacts']:
-                            distractor_facts.append({
-                                'fact': self.tokenizer.tokenize(fa['fact']),
-                                'snippet_id': fa['snippet_id']
-                            })
-                        shuffle(gold_facts)
-                        shuffle(distractor_facts)
-
-                        gold_img_and_caps = []
-                        distractor_img_and_caps = []
-
-                        if 'img_posFacts' in datum:
-                            for im in datum['img_posFacts']:
-                                image_id = im['image_id']
-                                cxt = self.tokenizer.tokenize(im['caption'].strip())
-                                gold_img_and_caps.append((image_id, cxt))
+                            shuffle(gold_facts)
+                            shuffle(distractor_facts)
+
+                            gold_img_and_caps = []
+                            distractor_img_and_caps = []
+
+                            if 'img_posFacts' in datum:
+                                for im in datum['img_posFacts']:
+                                    image_id = im['image_id']
+                                    cxt = tokenize(im['caption'].strip())
+                                    gold_img_and_caps.append((image_id, cxt))
 
-                        for im in datum['img_negFacts']:
-                            image_id = im['image_id']
-                            cxt = self.tokenizer.tokenize(im['caption'].strip())
-                            distractor_img_and_caps.append((image_id, cxt))
+                            for im in datum['img_negFacts']:
+                                image_id = im['image_id']
+                                cxt = tokenize(im['caption'].strip())
+                                distractor_img_and_caps.append((image_id, cxt))
                             
-                        shuffle(gold_img_and_caps)
-                        shuffle(distractor_img_and_caps)
+                            shuffle(gold_img_and_caps)
+                            shuffle(distractor_img_and_caps)
 
-                        self.instance_list.append((gold_facts, distractor_facts, gold_img_and_caps, distractor_img_and_caps, Q, A, True, "both", Guid)) # do_filter_task, context
+                            self.instance_list.append((gold_facts, distractor_facts, gold_img_and_caps, distractor_img_and_caps, Q, A, True, "both", Guid)) # do_filter_task, context
                         
-                        count += 1
+                            count += 1
 
-        print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            print("Load {} instances from {} samples".format(len(self.instance_list), count))
+            instance_cache.save(self.instance_list)
+        if compact_instances:
+            self.instance_list = InstanceStore(self.instance_list)
 
     def __len__(self):
         return len(self.instance_list)
@@ -431,7 +519,7 @@ class webqaDataset_filter_with_both(torch.utils.data.Dataset):
 
 class Preprocess4webqa_VinVL(Pipeline):
 
-    def __init__(self, max_pred, mask_prob, vocab_words, indexer, seed, max_len, len_vis_input, max_len_a, max_len_b, max_len_img_cxt=200, new_segment_ids=True, truncate_config={}, use_img_meta=True, use_img_content=True, use_txt_fact=True, ImgDataTsv_dict=None):
+    def __init__(self, max_pred, mask_prob, vocab_words, indexer, seed, max_len, len_vis_input, max_len_a, max_len_b, max_len_img_cxt=200, new_segment_ids=True, truncate_config={}, use_img_meta=True, use_img_content=True, use_txt_fact=True, ImgDataTsv_dict=None, feature_store=None, feature_cache=None, feature_dtype='float32', pack_img_regions=False, pre_indexed=False, compact_attention_mask=False, ragged_filter_choices=False, filter_scoring='cross_encoder'):
         super().__init__()
         self.task_idx = 3 # use task_idx for s2s in relaxed projection layer
         self.max_pred = max_pred
@@ -439,8 +527,17 @@ class Preprocess4webqa_VinVL(Pipeline):
         self.len_vis_input = len_vis_input
         self.vocab_words = vocab_words
         self.indexer = indexer
+        # ids of the [CLS] + [UNK] * max_len_img_cxt head of every image context
+        self._img_prefix_ids = index_tokens(indexer, ['[CLS]'] + ['[UNK]'] * max_len_img_cxt)
+        # pre_indexed: the instances hold np.int32 vocab ids instead of wordpieces (pre_index of the datasets),
+        # the special tokens and the random words of the masking become ids as well and indexing is a copy
+        self.pre_indexed = pre_indexed
+        self.cls_token, self.sep_token, self.unk_token, self.mask_token, self.pad_token = '[CLS]', '[SEP]', '[UNK]', '[MASK]', '[PAD]'
+        if pre_indexed:
+            self.cls_token, self.sep_token, self.unk_token, self.mask_token, self.pad_token = indexer(['[CLS]', '[SEP]', '[UNK]', '[MASK]', '[PAD]'])
+            self.vocab_words = [indexer([w])[0] for w in vocab_words]
+            self.indexer = list
         self.max_len_img_cxt = max_len_img_cxt
-        self._tril_matrix = torch.tril(torch.ones((max_len, max_len), dtype=torch.long))
         self.always_truncate_tail = truncate_config.get('always_truncate_tail', False)
         self.max_len_b = max_len_b
         self.max_len_a = max_len_a
@@ -455,9 +552,34 @@ class Preprocess4webqa_VinVL(Pipeline):
         np.random.seed(seed)
         assert max_len_a+max_len_b <= max_len, "loader Processor: max_len_a + max_len_b > max_len"
 
+        self.feature_store = feature_store
+        self.feature_cache = feature_cache
+        # img / vis_pe are shipped to the model in this dtype, it upcasts them before vis_embed / vis_pe_embed
+        self.feature_dtype = getattr(torch, feature_dtype)
+        # ship the regions of each image context unpadded, with their count in vis_lens
+        self.pack_img_regions = pack_img_regions
+        # ship the self-attention masks as span boundaries, the model expands them
+        self.compact_attention_mask = compact_attention_mask
+        # filter task: no placeholder choices up to filter_max_choices, logit_mask holds the number of choices instead
+        self.ragged_filter_choices = ragged_filter_choices
+        # filter task: late_interaction encodes the question once, in front of the choices, and the choices without Q+A
+        assert filter_scoring in ['cross_encoder', 'late_interaction'], "loader Processor: unknown filter_scoring {}".format(filter_scoring)
+        self.filter_scoring = filter_scoring
         self.img_data_tsv = {}
-        for k in ImgDataTsv_dict:
-            self.img_data_tsv[k] = ImgDataTsv(ImgDataTsv_dict[k])
+        for k in (ImgDataTsv_dict or {}):
+            self.img_data_tsv[k] = open_img_data(ImgDataTsv_dict[k])
+
+    def question_row(self, Q):
+        """ late_interaction filter scoring: input_ids, segment_ids, input_mask of the question alone, laid out as a choice with an empty context """
+        tokens_b = Q[:self.max_len_b]
+        tokens = [self.cls_token, self.sep_token] + tokens_b + [self.sep_token]
+        if self.new_segment_ids:
+            segment_ids = [4] * 2 + [5] * (len(tokens_b)+1)
+        else:
+            segment_ids = [0] * 2 + [1] * (len(tokens_b)+1)
+        segment_ids.extend([0] * (self.max_len - len(tokens)))
+        input_mask = span_attention_mask(self.max_len, [(0, len(tokens_b)+2)], compact=self.compact_attention_mask)
+        return torch.from_numpy(index_tokens(self.indexer, tokens, self.max_len)), torch.tensor(segment_ids), input_mask
 
     def detokenize(self, tk_list):
         r_list = []
@@ -469,9 +591,17 @@ class Preprocess4webqa_VinVL(Pipeline):
         return r_list
 
     def __call__(self, instance, filter_max_choices=None, device=None):
+        if self.pre_indexed:
+            instance = read_ids_to_lists(instance)
         _, __, ___, ____, _____, ______, do_filter_task, context, example_id = instance
         if do_filter_task:
             assert filter_max_choices is not None, "must pass in a valid filter_max_choices when doing filter task"
+            question_row = None
+            if self.filter_scoring == 'late_interaction':
+                # the question becomes the first row of the sample, the choices are encoded without Q+A
+                question_row = self.question_row(instance[4])
+                instance = tuple(instance[:4]) + ([], []) + tuple(instance[6:])
+            first_choice_row = 0 if question_row is None else 1
             if context == 'both':
                 gold_facts, distractor_facts, gold_img_and_caps, distractor_img_and_caps, Q, A, do_filter_task, context, example_id = instance
                 ## TODO: define a new Dataset, return img+cap in a tuple instead of two separate lists
@@ -492,6 +622,7 @@ class Preprocess4webqa_VinVL(Pipeline):
                 input_mask_list = []
                 img_list = []
                 vis_pe_list = []
+                vis_lens_list = []
 
                 for o in order:
                     if o%2 == 1: # context is img
@@ -501,13 +632,13 @@ class Preprocess4webqa_VinVL(Pipeline):
                             image_id, cxt = distractor_img_and_caps.pop()
                         ori_choices.append(image_id)
                         image_id = int(image_id)
-                        tokens_a = ['[UNK]'] * self.max_len_img_cxt # 200
+                        tokens_a = [self.unk_token] * self.max_len_img_cxt # 200
                         tokens_b = Q+A
                         max_len_cxt_meta = self.max_len_a - self.max_len_img_cxt # 200
                         truncate_tokens_pair(cxt, tokens_b, max_len=max_len_cxt_meta + self.max_len_b, max_len_a=max_len_cxt_meta, max_len_b=self.max_len_b, trunc_seg=self.trunc_seg, always_truncate_tail=self.always_truncate_tail)
                         if self.use_img_meta: tokens_a += cxt
                         
-                        tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + tokens_b + ['[SEP]']
+                        tokens = [self.cls_token] + tokens_a + [self.sep_token] + tokens_b + [self.sep_token]
                         if self.new_segment_ids:
                             segment_ids = [4] * (len(tokens_a)+2) + [5] * (len(tokens_b)+1)
                         else:
@@ -515,52 +646,36 @@ class Preprocess4webqa_VinVL(Pipeline):
 
 
                         # self-attention mask
-                        input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
                         # everyone can attend to img, cxt_meta and Q. Nobody cares attention to A for filter task
                         img_end_pos = 1+self.len_vis_input
-                        if self.use_img_content: input_mask[:, :img_end_pos].fill_(1)
                         st, end = 1 + self.max_len_img_cxt, len(tokens_a) + 2 + len(Q)
-                        input_mask[:, st:end].fill_(1)
+                        input_mask = span_attention_mask(self.max_len, [(0, img_end_pos if self.use_img_content else 0), (st, end)], compact=self.compact_attention_mask)
                         
-                        input_ids = self.indexer(tokens)
-                        n_pad = self.max_len - len(input_ids)
-                        input_ids.extend([0] * n_pad)
+                        input_ids = index_tokens(self.indexer, tokens, self.max_len, prefix_ids=self._img_prefix_ids)
+                        n_pad = self.max_len - len(tokens)
                         segment_ids.extend([0] * n_pad)
 
-                        image_id = int(image_id)
-                        vis_pe, scores, img, cls_label = self.img_data_tsv[image_id//10000000][image_id % 10000000]
-                        
-
-                        # Lazy normalization of the coordinates
-                        w_est = torch.max(vis_pe[:, [0, 2]])*1.+1e-5
-                        h_est = torch.max(vis_pe[:, [1, 3]])*1.+1e-5
-                        vis_pe[:, [0, 2]] /= w_est
-                        vis_pe[:, [1, 3]] /= h_est
-                        assert h_est > 0, 'loader Processor: box h_est should greater than 0! {}'.format(h_est)
-                        assert w_est > 0, 'loader Processor: box w_est should greater than 0! {}'.format(w_est)
-                        rel_area = (vis_pe[:, 3]-vis_pe[:, 1])*(vis_pe[:, 2]-vis_pe[:, 0])
-                        rel_area.clamp_(0)
-
-                        #vis_pe = torch.cat((vis_pe[:, :4], rel_area.view(-1, 1), features['scores'].detach().cpu().view(-1, 1)), -1)
-                        vis_pe = torch.cat((vis_pe[:, :4], rel_area.view(-1, 1), scores.view(-1, 1)), -1)
-                        normalized_coord = F.normalize(vis_pe.data[:, :5] - 0.5, dim=-1)
-                        vis_pe = torch.cat((F.layer_norm(vis_pe, [6]), F.layer_norm(cls_label, [1595])), dim=-1) # prev vg: 1601, VinVL: 1595
+                        img, vis_pe = load_img_and_vis_pe(image_id, self.img_data_tsv, self.feature_store, self.feature_cache, self.feature_dtype)
 
                         assert img.size(0) == vis_pe.size(0), "img features and vis_pe should have the same token length!"
-                        vis_pad = torch.zeros((self.max_len_img_cxt - img.size(0), img.size(-1)))
-                        img = torch.cat((img, vis_pad), dim=0) 
-                        pe_pad = torch.zeros((self.max_len_img_cxt - vis_pe.size(0), vis_pe.size(-1)))
-                        vis_pe = torch.cat((vis_pe, pe_pad), dim=0)
-                        assert vis_pe.size(0) == self.max_len_img_cxt
-                        assert img.size(0) == self.max_len_img_cxt
-                        input_ids_list.append(torch.tensor(input_ids))
+                        if self.pack_img_regions:
+                            img, vis_pe = pack_img_regions(img, vis_pe, input_mask, img_end_pos, self.use_img_content)
+                        else:
+                            vis_pad = torch.zeros((self.max_len_img_cxt - img.size(0), img.size(-1)), dtype=img.dtype)
+                            img = torch.cat((img, vis_pad), dim=0) 
+                            pe_pad = torch.zeros((self.max_len_img_cxt - vis_pe.size(0), vis_pe.size(-1)), dtype=vis_pe.dtype)
+                            vis_pe = torch.cat((vis_pe, pe_pad), dim=0)
+                            assert vis_pe.size(0) == self.max_len_img_cxt
+                            assert img.size(0) == self.max_len_img_cxt
+                        input_ids_list.append(torch.from_numpy(input_ids))
                         segment_ids_list.append(torch.tensor(segment_ids))
                         input_mask_list.append(input_mask)
                         if not self.use_img_content: 
-                            img = torch.zeros_like(img).float()
-                            vis_pe = torch.zeros_like(vis_pe).float()
+                            img = torch.zeros_like(img)
+                            vis_pe = torch.zeros_like(vis_pe)
                         img_list.append(img)
                         vis_pe_list.append(vis_pe)
+                        vis_lens_list.append(img.size(0))
 
                     else: # context is snippet
                         tokens_a = []
@@ -576,7 +691,7 @@ class Preprocess4webqa_VinVL(Pipeline):
                         
                         tokens_b = Q+A
                         truncate_tokens_pair(tokens_a, tokens_b, max_len=self.max_len_a+self.max_len_b, max_len_a=self.max_len_a, max_len_b=self.max_len_b, trunc_seg=self.trunc_seg, always_truncate_tail=self.always_truncate_tail)
-                        tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + tokens_b + ['[SEP]']
+                        tokens = [self.cls_token] + tokens_a + [self.sep_token] + tokens_b + [self.sep_token]
 
                         if self.new_segment_ids:
                             segment_ids = [4] * (len(tokens_a)+2) + [5] * (len(tokens_b)+1)
@@ -584,43 +699,51 @@ class Preprocess4webqa_VinVL(Pipeline):
                             segment_ids = [0] * (len(tokens_a)+2) + [1] * (len(tokens_b)+1)
 
                         # self-attention mask
-                        input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
                         # everyone can attend to cxt and Q. Nobody cares attention to A for filter task
-                        input_mask[:, :len(tokens_a)+2+len(Q)].fill_(1)
+                        input_mask = span_attention_mask(self.max_len, [(0, len(tokens_a)+2+len(Q))], compact=self.compact_attention_mask)
 
-                        input_ids = self.indexer(tokens)
-                        n_pad = self.max_len - len(input_ids)
-                        input_ids.extend([0] * n_pad)
+                        input_ids = index_tokens(self.indexer, tokens, self.max_len)
+                        n_pad = self.max_len - len(tokens)
                         segment_ids.extend([0] * n_pad)
 
-                        input_ids_list.append(torch.tensor(input_ids))
+                        input_ids_list.append(torch.from_numpy(input_ids))
                         segment_ids_list.append(torch.tensor(segment_ids))
                         input_mask_list.append(input_mask)
                     
                 logit_mask = [1.] * len(input_ids_list)
-                if len(input_ids_list) < filter_max_choices:
+                if self.ragged_filter_choices:
+                    logit_mask = [len(input_ids_list)]
+                elif len(input_ids_list) < filter_max_choices:
                     num_placeholder = filter_max_choices - len(input_ids_list)
                     input_ids_list.extend([input_ids_list[-1]] * num_placeholder)
                     segment_ids_list.extend([segment_ids_list[-1]] * num_placeholder)
                     input_mask_list.extend([input_mask_list[-1]] * num_placeholder)
                     logit_mask.extend([0.] * num_placeholder)
                     label = torch.cat([label, torch.tensor([[0., 0.]] * num_placeholder)], dim=0)
+                if question_row is not None:
+                    for rows, q in zip((input_ids_list, segment_ids_list, input_mask_list), question_row):
+                        rows.insert(0, q)
                 input_ids = torch.stack(input_ids_list, dim=0) 
                 segment_ids = torch.stack(segment_ids_list, dim=0)
                 input_mask = torch.stack(input_mask_list, dim=0)
                 assert len(img_list) == len(vis_pe_list)
+                vis_lens = torch.tensor(vis_lens_list) if self.pack_img_regions and len(img_list) > 0 else None
                 if len(img_list) == 0:
                     img = None
                     vis_pe = None
                 else:
-                    img = torch.stack(img_list, dim=0)
-                    vis_pe = torch.stack(vis_pe_list, dim=0)
+                    if self.pack_img_regions:
+                        img = torch.cat(img_list, dim=0)
+                        vis_pe = torch.cat(vis_pe_list, dim=0)
+                    else:
+                        img = torch.stack(img_list, dim=0)
+                        vis_pe = torch.stack(vis_pe_list, dim=0)
                 logit_mask = torch.tensor(logit_mask)
                 
-                cxt_modality_label = [i for i in range(len(order)) if order[i]%2 == 1]
+                cxt_modality_label = [first_choice_row + i for i in range(len(order)) if order[i]%2 == 1]
 
-                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
-                return (input_ids, segment_ids, input_mask,       None,        None,        None,         -1,         do_filter_task,        label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id) 
+                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
+                return (input_ids, segment_ids, input_mask,       None,        None,        None,         -1,         do_filter_task,        label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
                 
 
             elif context == 'img':
@@ -640,17 +763,18 @@ class Preprocess4webqa_VinVL(Pipeline):
                 input_mask_list = []
                 img_list = []
                 vis_pe_list = []
+                vis_lens_list = []
                 for i in range(filter_num_choices):
                     cxt = all_choices_cxt_list[i]
                     image_id = int(all_choices_image_ids[i])
-                    tokens_a = ['[UNK]'] * self.max_len_img_cxt # 200
+                    tokens_a = [self.unk_token] * self.max_len_img_cxt # 200
                     tokens_b = Q+A
                     max_len_cxt_meta = self.max_len_a - self.max_len_img_cxt # 200
                     truncate_tokens_pair(cxt, tokens_b, max_len=max_len_cxt_meta + self.max_len_b, max_len_a=max_len_cxt_meta, max_len_b=self.max_len_b, trunc_seg=self.trunc_seg, always_truncate_tail=self.always_truncate_tail)
                     if self.use_img_meta: tokens_a += cxt
                     
                     
-                    tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + tokens_b + ['[SEP]']
+                    tokens = [self.cls_token] + tokens_a + [self.sep_token] + tokens_b + [self.sep_token]
 
                     if self.new_segment_ids:
                         segment_ids = [4] * (len(tokens_a)+2) + [5] * (len(tokens_b)+1)
@@ -660,55 +784,41 @@ class Preprocess4webqa_VinVL(Pipeline):
                     
 
                     # self-attention mask
-                    input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
                     # everyone can attend to img, cxt_meta and Q. Nobody cares attention to A for filter task
                     img_end_pos = 1+self.len_vis_input
-                    if self.use_img_content: input_mask[:, :img_end_pos].fill_(1)
                     st, end = 1 + self.max_len_img_cxt, len(tokens_a) + 2 + len(Q)
-                    input_mask[:, st:end].fill_(1)
+                    input_mask = span_attention_mask(self.max_len, [(0, img_end_pos if self.use_img_content else 0), (st, end)], compact=self.compact_attention_mask)
 
-                    input_ids = self.indexer(tokens)
-                    n_pad = self.max_len - len(input_ids)
-                    input_ids.extend([0] * n_pad)
+                    input_ids = index_tokens(self.indexer, tokens, self.max_len, prefix_ids=self._img_prefix_ids)
+                    n_pad = self.max_len - len(tokens)
                     segment_ids.extend([0] * n_pad)
 
-                    image_id = int(image_id)
-                    vis_pe, scores, img, cls_label = self.img_data_tsv[image_id//10000000][image_id % 10000000]
-                    
-                    
-
-                    # Lazy normalization of the coordinates
-                    w_est = torch.max(vis_pe[:, [0, 2]])*1.+1e-5
-                    h_est = torch.max(vis_pe[:, [1, 3]])*1.+1e-5
-                    vis_pe[:, [0, 2]] /= w_est
-                    vis_pe[:, [1, 3]] /= h_est
-                    assert h_est > 0, 'loader Processor: box h_est should greater than 0! {}'.format(h_est)
-                    assert w_est > 0, 'loader Processor: box w_est should greater than 0! {}'.format(w_est)
-                    rel_area = (vis_pe[:, 3]-vis_pe[:, 1])*(vis_pe[:, 2]-vis_pe[:, 0])
-                    rel_area.clamp_(0)
-
-                    vis_pe = torch.cat((vis_pe[:, :4], rel_area.view(-1, 1), scores.view(-1, 1)), -1)
-                    normalized_coord = F.normalize(vis_pe.data[:, :5] - 0.5, dim=-1)
-                    vis_pe = torch.cat((F.layer_norm(vis_pe, [6]), F.layer_norm(cls_label, [1595])), dim=-1)
+                    img, vis_pe = load_img_and_vis_pe(image_id, self.img_data_tsv, self.feature_store, self.feature_cache, self.feature_dtype)
 
                     assert img.size(0) == vis_pe.size(0), "img features and vis_pe should have the same token length!"
-                    vis_pad = torch.zeros((self.max_len_img_cxt - img.size(0), img.size(-1)))
-                    img = torch.cat((img, vis_pad), dim=0) 
-                    pe_pad = torch.zeros((self.max_len_img_cxt - vis_pe.size(0), vis_pe.size(-1)))
-                    vis_pe = torch.cat((vis_pe, pe_pad), dim=0)
-                    assert vis_pe.size(0) == self.max_len_img_cxt
-                    assert img.size(0) == self.max_len_img_cxt
-                    input_ids_list.append(torch.tensor(input_ids))
+                    if self.pack_img_regions:
+                        img, vis_pe = pack_img_regions(img, vis_pe, input_mask, img_end_pos, self.use_img_content)
+                    else:
+                        vis_pad = torch.zeros((self.max_len_img_cxt - img.size(0), img.size(-1)), dtype=img.dtype)
+                        img = torch.cat((img, vis_pad), dim=0) 
+                        pe_pad = torch.zeros((self.max_len_img_cxt - vis_pe.size(0), vis_pe.size(-1)), dtype=vis_pe.dtype)
+                        vis_pe = torch.cat((vis_pe, pe_pad), dim=0)
+                        assert vis_pe.size(0) == self.max_len_img_cxt
+                        assert img.size(0) == self.max_len_img_cxt
+                    input_ids_list.append(torch.from_numpy(input_ids))
                     segment_ids_list.append(torch.tensor(segment_ids))
                     input_mask_list.append(input_mask)
                     if not self.use_img_content: 
-                        img = torch.zeros_like(img).float()
-                        vis_pe = torch.zeros_like(vis_pe).float()
+                        img = torch.zeros_like(img)
+                        vis_pe = torch.zeros_like(vis_pe)
                     img_list.append(img)
                     vis_pe_list.append(vis_pe)
+                    vis_lens_list.append(img.size(0))
                 
                 logit_mask = [1.] * len(input_ids_list)
-                if len(input_ids_list) < filter_max_choices:
+                if self.ragged_filter_choices:
+                    logit_mask = [len(input_ids_list)]
+                elif len(input_ids_list) < filter_max_choices:
                     num_placeholder = filter_max_choices - len(input_ids_list)
                     input_ids_list.extend([input_ids_list[-1]] * num_placeholder)
                     segment_ids_list.extend([segment_ids_list[-1]] * num_placeholder)
@@ -716,17 +826,25 @@ class Preprocess4webqa_VinVL(Pipeline):
 
                     logit_mask.extend([0.] * num_placeholder)
                     label = torch.cat([label, torch.tensor([[0., 0.]] * num_placeholder)], dim=0)
+                if question_row is not None:
+                    for rows, q in zip((input_ids_list, segment_ids_list, input_mask_list), question_row):
+                        rows.insert(0, q)
                 input_ids = torch.stack(input_ids_list, dim=0)
                 segment_ids = torch.stack(segment_ids_list, dim=0)
                 input_mask = torch.stack(input_mask_list, dim=0)
-                img = torch.stack(img_list, dim=0)
-                vis_pe = torch.stack(vis_pe_list, dim=0)
+                if self.pack_img_regions:
+                    img = torch.cat(img_list, dim=0)
+                    vis_pe = torch.cat(vis_pe_list, dim=0)
+                else:
+                    img = torch.stack(img_list, dim=0)
+                    vis_pe = torch.stack(vis_pe_list, dim=0)
                 logit_mask = torch.tensor(logit_mask)
                 ori_choices = [all_choices_image_ids]
 
-                cxt_modality_label = range(filter_num_choices)
-                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
-                return (input_ids, segment_ids, input_mask,       None,       None,       None,       -1,       do_filter_task,        label,       logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
+                vis_lens = torch.tensor(vis_lens_list) if self.pack_img_regions else None
+                cxt_modality_label = range(first_choice_row, first_choice_row + filter_num_choices)
+                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
+                return (input_ids, segment_ids, input_mask,       None,       None,       None,       -1,       do_filter_task,        label,       logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
 
             elif context == 'txt': # do_filter_task && context_is_text
                 gold_facts, distractor_facts, gold_cxt_list, distractor_cxt_list, Q, A, do_filter_task, context, example_id = instance
@@ -747,7 +865,7 @@ class Preprocess4webqa_VinVL(Pipeline):
                     if self.use_txt_fact: tokens_a = all_choices_facts[i].copy()
                     tokens_b = Q+A
                     truncate_tokens_pair(tokens_a, tokens_b, max_len=self.max_len_a+self.max_len_b, max_len_a=self.max_len_a, max_len_b=self.max_len_b, trunc_seg=self.trunc_seg, always_truncate_tail=self.always_truncate_tail)
-                    tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + tokens_b + ['[SEP]']
+                    tokens = [self.cls_token] + tokens_a + [self.sep_token] + tokens_b + [self.sep_token]
 
                     if self.new_segment_ids:
                         segment_ids = [4] * (len(tokens_a)+2) + [5] * (len(tokens_b)+1)
@@ -755,27 +873,30 @@ class Preprocess4webqa_VinVL(Pipeline):
                         segment_ids = [0] * (len(tokens_a)+2) + [1] * (len(tokens_b)+1)
 
                     # self-attention mask
-                    input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
                     # everyone can attend to cxt and Q. Nobody cares attention to A for filter task
-                    input_mask[:, :len(tokens_a)+2+len(Q)].fill_(1)
+                    input_mask = span_attention_mask(self.max_len, [(0, len(tokens_a)+2+len(Q))], compact=self.compact_attention_mask)
 
-                    input_ids = self.indexer(tokens)
-                    n_pad = self.max_len - len(input_ids)
-                    input_ids.extend([0] * n_pad)
+                    input_ids = index_tokens(self.indexer, tokens, self.max_len)
+                    n_pad = self.max_len - len(tokens)
                     segment_ids.extend([0] * n_pad)
 
-                    input_ids_list.append(torch.tensor(input_ids))
+                    input_ids_list.append(torch.from_numpy(input_ids))
                     segment_ids_list.append(torch.tensor(segment_ids))
                     input_mask_list.append(input_mask)
 
                 logit_mask = [1.] * len(input_ids_list)
-                if len(input_ids_list) < filter_max_choices:
+                if self.ragged_filter_choices:
+                    logit_mask = [len(input_ids_list)]
+                elif len(input_ids_list) < filter_max_choices:
                     num_placeholder = filter_max_choices - len(input_ids_list)
                     input_ids_list.extend([input_ids_list[-1]] * num_placeholder)
                     segment_ids_list.extend([segment_ids_list[-1]] * num_placeholder)
                     input_mask_list.extend([input_mask_list[-1]] * num_placeholder)
                     logit_mask.extend([0.] * num_placeholder)
                     label = torch.cat([label, torch.tensor([[0., 0.]] * num_placeholder)], dim=0)
+                if question_row is not None:
+                    for rows, q in zip((input_ids_list, segment_ids_list, input_mask_list), question_row):
+                        rows.insert(0, q)
                 input_ids = torch.stack(input_ids_list, dim=0) 
                 segment_ids = torch.stack(segment_ids_list, dim=0)
                 input_mask = torch.stack(input_mask_list, dim=0)
@@ -783,8 +904,8 @@ class Preprocess4webqa_VinVL(Pipeline):
                 ori_choices = all_choices_ids 
 
                 cxt_modality_label = []
-                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
-                return (input_ids, segment_ids, input_mask,       None,        None,        None,         -1,         do_filter_task,        label, logit_mask, ori_choices, self.task_idx, None, None, context, cxt_modality_label, example_id)
+                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
+                return (input_ids, segment_ids, input_mask,       None,        None,        None,         -1,         do_filter_task,        label, logit_mask, ori_choices, self.task_idx, None, None, context, cxt_modality_label, example_id, None)
                 raise NotImplementedError
         
         else: # qa task
@@ -792,14 +913,14 @@ class Preprocess4webqa_VinVL(Pipeline):
                 gold_image_ids, distractor_image_ids, gold_cxt_list, distractor_cxt_list, Q, A, do_filter_task, context, example_id = instance
                 gold_image_ids = gold_image_ids[:2]
                 gold_cxt_list = gold_cxt_list[:2]
-                tokens_a = ['[UNK]'] * self.max_len_img_cxt
+                tokens_a = [self.unk_token] * self.max_len_img_cxt
                 tokens_b = Q+A
                 
                 cxt = sum(gold_cxt_list, [])
 
                 num_truncated_a, num_truncated_b = truncate_tokens_pair(cxt, tokens_b, max_len=self.max_len_a - self.max_len_img_cxt + self.max_len_b, max_len_a=self.max_len_a - self.max_len_img_cxt, max_len_b=self.max_len_b, trunc_seg=self.trunc_seg, always_truncate_tail=self.always_truncate_tail)
                 if self.use_img_meta: tokens_a += cxt
-                tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + tokens_b + ['[SEP]']
+                tokens = [self.cls_token] + tokens_a + [self.sep_token] + tokens_b + [self.sep_token]
                 
                 if self.new_segment_ids:
                     segment_ids = [4] * (len(tokens_a)+2) + [5] * (len(tokens_b)+1)
@@ -819,7 +940,7 @@ class Preprocess4webqa_VinVL(Pipeline):
                 masked_tokens = [tokens[pos] for pos in masked_pos] # gth token in masked_pos
                 for pos in masked_pos:
                     if rand() < 0.8:
-                        tokens[pos] = '[MASK]'
+                        tokens[pos] = self.mask_token
                     elif rand() < 0.5:
                         random_word = get_random_word(self.vocab_words)
                         tokens[pos] = random_word
@@ -827,22 +948,18 @@ class Preprocess4webqa_VinVL(Pipeline):
 
                 masked_weights = [1] * len(masked_tokens)
                 masked_ids = self.indexer(masked_tokens)
-                input_ids = self.indexer(tokens)
-                n_pad = self.max_len - len(input_ids)
-                input_ids.extend([0] * n_pad)
+                input_ids = index_tokens(self.indexer, tokens, self.max_len, prefix_ids=self._img_prefix_ids)
+                n_pad = self.max_len - len(tokens)
                 segment_ids.extend([0] * n_pad)
 
                 # self-attention mask
                 num_img = len(gold_image_ids)
-                input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
 
                 img_end_pos = 1 + self.len_vis_input*num_img
-                if self.use_img_content: input_mask[:, :img_end_pos].fill_(1)
                 st, end = 1 + self.max_len_img_cxt, 2 + len(tokens_a) + len(Q)
-                input_mask[:, st:end].fill_(1)
                 # Tokens in A can attend to previous tokens in A
                 pred_st, pred_end = 2 + len(tokens_a) + len(Q), len(tokens)
-                input_mask[pred_st:pred_end, pred_st:pred_end].copy_(self._tril_matrix[:pred_end-pred_st, :pred_end-pred_st])
+                input_mask = span_attention_mask(self.max_len, [(0, img_end_pos if self.use_img_content else 0), (st, end)], causal=(pred_st, pred_end), compact=self.compact_attention_mask)
                 # Zero padding for masked target
                 
                 if self.max_pred > n_pred:
@@ -852,7 +969,7 @@ class Preprocess4webqa_VinVL(Pipeline):
                     masked_weights.extend([0] * n_pad)
                 
                 # Convert some inputs to tensors
-                input_ids = torch.LongTensor(input_ids)
+                input_ids = torch.from_numpy(input_ids)
                 segment_ids = torch.LongTensor(segment_ids)
                 masked_ids = torch.LongTensor(masked_ids)
                 masked_pos = torch.LongTensor(masked_pos)
@@ -861,23 +978,7 @@ class Preprocess4webqa_VinVL(Pipeline):
                 img_list = []
                 vis_pe_list = []
                 for image_id in gold_image_ids:
-                    image_id = int(image_id)
-                    vis_pe, scores, img, cls_label = self.img_data_tsv[image_id//10000000][image_id % 10000000]
-
-                   
-                    # Lazy normalization of the coordinates
-                    w_est = torch.max(vis_pe[:, [0, 2]])*1.+1e-5
-                    h_est = torch.max(vis_pe[:, [1, 3]])*1.+1e-5
-                    vis_pe[:, [0, 2]] /= w_est
-                    vis_pe[:, [1, 3]] /= h_est
-                    assert h_est > 0, 'loader Processor: box h_est should greater than 0! {}'.format(h_est)
-                    assert w_est > 0, 'loader Processor: box w_est should greater than 0! {}'.format(w_est)
-                    rel_area = (vis_pe[:, 3]-vis_pe[:, 1])*(vis_pe[:, 2]-vis_pe[:, 0])
-                    rel_area.clamp_(0)
-
-                    vis_pe = torch.cat((vis_pe[:, :4], rel_area.view(-1, 1), scores.view(-1, 1)), -1)
-                    normalized_coord = F.normalize(vis_pe.data[:, :5] - 0.5, dim=-1)
-                    vis_pe = torch.cat((F.layer_norm(vis_pe, [6]), F.layer_norm(cls_label, [1595])), dim=-1)
+                    img, vis_pe = load_img_and_vis_pe(image_id, self.img_data_tsv, self.feature_store, self.feature_cache, self.feature_dtype)
 
                     img_list.append(img)
                     vis_pe_list.append(vis_pe)
@@ -885,12 +986,15 @@ class Preprocess4webqa_VinVL(Pipeline):
                 img = torch.cat(img_list, dim=0)
                 vis_pe = torch.cat(vis_pe_list, dim=0)
                 assert img.size(0) == vis_pe.size(0), "img features and vis_pe should have the same token length!"
-                vis_pad = torch.zeros((self.max_len_img_cxt - img.size(0), img.size(-1)))#.to(device)
-                img = torch.cat((img, vis_pad), dim=0)
-                vis_pad = torch.zeros((self.max_len_img_cxt - vis_pe.size(0), vis_pe.size(-1)))#.to(device)
-                vis_pe = torch.cat((vis_pe, vis_pad), dim=0)
-                assert vis_pe.size(0) == self.max_len_img_cxt
-                assert img.size(0) == self.max_len_img_cxt
+                if self.pack_img_regions:
+                    img, vis_pe = pack_img_regions(img, vis_pe, input_mask, img_end_pos, self.use_img_content)
+                else:
+                    vis_pad = torch.zeros((self.max_len_img_cxt - img.size(0), img.size(-1)), dtype=img.dtype)#.to(device)
+                    img = torch.cat((img, vis_pad), dim=0)
+                    vis_pad = torch.zeros((self.max_len_img_cxt - vis_pe.size(0), vis_pe.size(-1)), dtype=vis_pe.dtype)#.to(device)
+                    vis_pe = torch.cat((vis_pe, vis_pad), dim=0)
+                    assert vis_pe.size(0) == self.max_len_img_cxt
+                    assert img.size(0) == self.max_len_img_cxt
                 if len(masked_pos) < self.max_pred: 
                     print("num_truncated_b = ", num_truncated_b)
                     print(masked_pos)
@@ -901,9 +1005,10 @@ class Preprocess4webqa_VinVL(Pipeline):
                     print("len(Q) = ", len(Q))
                     print("--------------")
                     print(tokens)
+                vis_lens = torch.tensor([img.size(0)]) if self.pack_img_regions else None
                 cxt_modality_label = [1]
-                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
-                return (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights,      -1,      do_filter_task,        None,        None,        None,     self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
+                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
+                return (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights,      -1,      do_filter_task,        None,        None,        None,     self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
             
             
             else: # qa task, context is txt
@@ -912,7 +1017,7 @@ class Preprocess4webqa_VinVL(Pipeline):
                 if self.use_txt_fact: tokens_a = sum(gold_facts, [])
                 tokens_b = Q+A
                 num_truncated_a, num_truncated_b = truncate_tokens_pair(tokens_a, tokens_b, max_len=self.max_len_a+self.max_len_b, max_len_a=self.max_len_a, max_len_b=self.max_len_b, trunc_seg=self.trunc_seg, always_truncate_tail=self.always_truncate_tail)
-                tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + tokens_b + ['[SEP]']
+                tokens = [self.cls_token] + tokens_a + [self.sep_token] + tokens_b + [self.sep_token]
                 if self.new_segment_ids:
                     segment_ids = [4] * (len(tokens_a)+2) + [5] * (len(tokens_b)+1)
                 else:
@@ -931,22 +1036,19 @@ class Preprocess4webqa_VinVL(Pipeline):
                 masked_tokens = [tokens[pos] for pos in masked_pos] # gth token in masked_pos
                 for pos in masked_pos:
                     if rand() < 0.8:
-                        tokens[pos] = '[MASK]'
+                        tokens[pos] = self.mask_token
                     elif rand() < 0.5:
                         tokens[pos] = get_random_word(self.vocab_words)
 
                 masked_weights = [1] * len(masked_tokens)
                 masked_ids = self.indexer(masked_tokens)
 
-                input_ids = self.indexer(tokens)
-                n_pad = self.max_len - len(input_ids)
-                input_ids.extend([0] * n_pad)
+                input_ids = index_tokens(self.indexer, tokens, self.max_len)
+                n_pad = self.max_len - len(tokens)
                 segment_ids.extend([0] * n_pad)
 
-                input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
-                input_mask[:, :len(tokens_a)+2+len(Q)].fill_(1)
                 pred_st, pred_end = 2 + len(tokens_a) + len(Q), len(tokens)
-                input_mask[pred_st:pred_end, pred_st:pred_end].copy_(self._tril_matrix[:pred_end-pred_st, :pred_end-pred_st])
+                input_mask = span_attention_mask(self.max_len, [(0, len(tokens_a)+2+len(Q))], causal=(pred_st, pred_end), compact=self.compact_attention_mask)
 
                 # Zero padding for masked target
                 if self.max_pred > n_pred:
@@ -956,26 +1058,35 @@ class Preprocess4webqa_VinVL(Pipeline):
                     masked_weights.extend([0] * n_pad)
 
                 # Convert some inputs to tensors
-                input_ids = torch.LongTensor(input_ids)
+                input_ids = torch.from_numpy(input_ids)
                 segment_ids = torch.LongTensor(segment_ids)
                 masked_ids = torch.LongTensor(masked_ids)
                 masked_pos = torch.LongTensor(masked_pos)
                 masked_weights = torch.LongTensor(masked_weights)
                 
-                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
-                return (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights,       -1,      do_filter_task,      None,      None,       None,         self.task_idx, None, None,  context, None,               example_id)
+                # schema: (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights, is_next_label, do_filter_task, filter_label, logit_mask, ori_choices, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
+                return (input_ids, segment_ids, input_mask, masked_ids, masked_pos, masked_weights,       -1,      do_filter_task,      None,      None,       None,         self.task_idx, None, None,  context, None,               example_id, None)
                 raise NotImplementedError
 
 class Preprocess4webqaDecoder_VinVL(Pipeline):
 
-    def __init__(self, vocab_words, indexer, seed, max_len, len_vis_input, max_len_a, max_len_Q, max_len_img_cxt=200, max_tgt_len=30, new_segment_ids=True, truncate_config={}, use_img_meta=True, use_img_content=True, use_txt_fact=True, ImgDataTsv_dict=None):
+    def __init__(self, vocab_words, indexer, seed, max_len, len_vis_input, max_len_a, max_len_Q, max_len_img_cxt=200, max_tgt_len=30, new_segment_ids=True, truncate_config={}, use_img_meta=True, use_img_content=True, use_txt_fact=True, ImgDataTsv_dict=None, feature_store=None, feature_cache=None, feature_dtype='float32', pack_img_regions=False, pre_indexed=False, compact_attention_mask=False):
         super().__init__()
         self.task_idx = 3 # use task_idx for s2s in relaxed projection layer
         self.len_vis_input = len_vis_input
         self.vocab_words = vocab_words
         self.indexer = indexer
+        # ids of the [CLS] + [UNK] * max_len_img_cxt head of every image context
+        self._img_prefix_ids = index_tokens(indexer, ['[CLS]'] + ['[UNK]'] * max_len_img_cxt)
+        # pre_indexed: the instances hold np.int32 vocab ids instead of wordpieces (pre_index of the datasets),
+        # the special tokens and the random words of the masking become ids as well and indexing is a copy
+        self.pre_indexed = pre_indexed
+        self.cls_token, self.sep_token, self.unk_token, self.mask_token, self.pad_token = '[CLS]', '[SEP]', '[UNK]', '[MASK]', '[PAD]'
+        if pre_indexed:
+            self.cls_token, self.sep_token, self.unk_token, self.mask_token, self.pad_token = indexer(['[CLS]', '[SEP]', '[UNK]', '[MASK]', '[PAD]'])
+            self.vocab_words = [indexer([w])[0] for w in vocab_words]
+            self.indexer = list
         self.max_len_img_cxt = max_len_img_cxt
-        self._tril_matrix = torch.tril(torch.ones((max_len, max_len), dtype=torch.long))
         self.always_truncate_tail = truncate_config.get('always_truncate_tail', False)
         self.max_len_Q = max_len_Q
         self.max_len_a = max_len_a
@@ -991,11 +1102,21 @@ class Preprocess4webqaDecoder_VinVL(Pipeline):
         print("loader.use_img_meta = ", use_img_meta)
         print("loader.use_img_content = ", use_img_content)
         
+        self.feature_store = feature_store
+        self.feature_cache = feature_cache
+        # img / vis_pe are shipped to the model in this dtype, it upcasts them before vis_embed / vis_pe_embed
+        self.feature_dtype = getattr(torch, feature_dtype)
+        # ship the regions of each image context unpadded, with their count in vis_lens
+        self.pack_img_regions = pack_img_regions
+        # ship the self-attention masks as span boundaries, the model expands them
+        self.compact_attention_mask = compact_attention_mask
         self.img_data_tsv = {}
-        for k in ImgDataTsv_dict:
-            self.img_data_tsv[k] = ImgDataTsv(ImgDataTsv_dict[k])
+        for k in (ImgDataTsv_dict or {}):
+            self.img_data_tsv[k] = open_img_data(ImgDataTsv_dict[k])
 
     def __call__(self, instance, filter_max_choices=None, device=None):
+        if self.pre_indexed:
+            instance = read_ids_to_lists(instance)
         _, __, ___, ____, _____, ______, do_filter_task, context, example_id = instance
         if do_filter_task:
             raise ValueError("Processor for decoder does not support filter task. \nFor filter task inference, please use run_webqa.py by setting args.do_train=False")
@@ -1004,7 +1125,7 @@ class Preprocess4webqaDecoder_VinVL(Pipeline):
                 gold_image_ids, distractor_image_ids, gold_cxt_list, distractor_cxt_list, Q, _, do_filter_task, context, example_id = instance # '_' as a placeholder for 'A'
                 gold_image_ids = gold_image_ids[:2]
                 gold_cxt_list = gold_cxt_list[:2]
-                tokens_a = ['[UNK]'] * self.max_len_img_cxt
+                tokens_a = [self.unk_token] * self.max_len_img_cxt
                 cxt = sum(gold_cxt_list, [])
 
                
@@ -1013,9 +1134,9 @@ class Preprocess4webqaDecoder_VinVL(Pipeline):
                 if self.use_img_meta: tokens_a += cxt                
                 
                 n_pad = self.max_len_Q + self.max_len_a - len(tokens_a) - len(tokens_b)
-                tokens_b += ['[PAD]'] * n_pad
+                tokens_b += [self.pad_token] * n_pad
 
-                tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + tokens_b # + ['[SEP]'] # start generating right after Q
+                tokens = [self.cls_token] + tokens_a + [self.sep_token] + tokens_b # + [self.sep_token] # start generating right after Q
                 if self.new_segment_ids:
                     segment_ids = [4] * (len(tokens_a)+2) + [5] * len(tokens_b) + [5] * (self.max_len - len(tokens))
                 else:
@@ -1036,47 +1157,29 @@ class Preprocess4webqaDecoder_VinVL(Pipeline):
                 
 
                 # Token Indexing
-                input_ids = self.indexer(tokens)
+                input_ids = index_tokens(self.indexer, tokens, prefix_ids=self._img_prefix_ids)
 
                 # self-attention mask
                 num_img = len(gold_image_ids)
-                input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
 
                 img_end_pos = 1 + self.len_vis_input*num_img
-                if self.use_img_content: input_mask[:, :img_end_pos].fill_(1)
                 st, end = 1 + self.max_len_img_cxt, len(tokens_a) + 2 + ori_Q_len # paddings at the end of tokens_b don't need attention
-                input_mask[:, st:end].fill_(1)
                 # Tokens in A can attend to previous tokens in A
                 pred_st, pred_end = len(tokens), self.max_len
-                input_mask[pred_st:pred_end, pred_st:pred_end].copy_(self._tril_matrix[:pred_end-pred_st, :pred_end-pred_st])
+                input_mask = span_attention_mask(self.max_len, [(0, img_end_pos if self.use_img_content else 0), (st, end)], causal=(pred_st, pred_end), compact=self.compact_attention_mask)
                 
                 # Convert some inputs to tensors
-                input_ids = torch.LongTensor(input_ids)
+                input_ids = torch.from_numpy(input_ids)
                 segment_ids = torch.LongTensor(segment_ids)
                 position_ids = torch.LongTensor(position_ids)
 
                 img_list = []
                 vis_pe_list = []
                 for image_id in gold_image_ids:
-                    image_id = int(image_id)
-                    try: vis_pe, scores, img, cls_label = self.img_data_tsv[image_id//10000000][image_id % 10000000]
+                    try: img, vis_pe = load_img_and_vis_pe(image_id, self.img_data_tsv, self.feature_store, self.feature_cache, self.feature_dtype)
                     except:
                         print("\nimage_id = {}\n".format(image_id))
                         raise
-
-                    # Lazy normalization of the coordinates
-                    w_est = torch.max(vis_pe[:, [0, 2]])*1.+1e-5
-                    h_est = torch.max(vis_pe[:, [1, 3]])*1.+1e-5
-                    vis_pe[:, [0, 2]] /= w_est
-                    vis_pe[:, [1, 3]] /= h_est
-                    assert h_est > 0, 'loader Processor: box h_est should greater than 0! {}'.format(h_est)
-                    assert w_est > 0, 'loader Processor: box w_est should greater than 0! {}'.format(w_est)
-                    rel_area = (vis_pe[:, 3]-vis_pe[:, 1])*(vis_pe[:, 2]-vis_pe[:, 0])
-                    rel_area.clamp_(0)
-
-                    vis_pe = torch.cat((vis_pe[:, :4], rel_area.view(-1, 1), scores.view(-1, 1)), -1)
-                    normalized_coord = F.normalize(vis_pe.data[:, :5] - 0.5, dim=-1)
-                    vis_pe = torch.cat((F.layer_norm(vis_pe, [6]), F.layer_norm(cls_label, [1595])), dim=-1)
                     
                     img_list.append(img)
                     vis_pe_list.append(vis_pe)
@@ -1084,22 +1187,33 @@ class Preprocess4webqaDecoder_VinVL(Pipeline):
 
                 if len(img_list) == 0:
                     assert len(vis_pe_list) == 0
-                    img = torch.zeros((self.max_len_img_cxt, 2048)) # 2048 is hard-coded
-                    vis_pe = torch.zeros((self.max_len_img_cxt, 1601)) # 1607 is hard-coded
+                    if self.pack_img_regions:
+                        img = torch.zeros((0, 2048), dtype=self.feature_dtype)
+                        vis_pe = torch.zeros((0, 1601), dtype=self.feature_dtype)
+                    else:
+                        img = torch.zeros((self.max_len_img_cxt, 2048), dtype=self.feature_dtype) # 2048 is hard-coded
+                        vis_pe = torch.zeros((self.max_len_img_cxt, 1601), dtype=self.feature_dtype) # 1607 is hard-coded
                 else:
                     img = torch.cat(img_list, dim=0)
                     vis_pe = torch.cat(vis_pe_list, dim=0)
                     assert img.size(0) == vis_pe.size(0), "img features and vis_pe should have the same token length!"
-                    vis_pad = torch.zeros((self.max_len_img_cxt - img.size(0), img.size(-1)))#.to(device)
-                    img = torch.cat((img, vis_pad), dim=0)
-                    vis_pad = torch.zeros((self.max_len_img_cxt - vis_pe.size(0), vis_pe.size(-1)))#.to(device)
-                    vis_pe = torch.cat((vis_pe, vis_pad), dim=0)
-                assert vis_pe.size(0) == self.max_len_img_cxt
-                assert img.size(0) == self.max_len_img_cxt
+                    if self.pack_img_regions:
+                        img, vis_pe = pack_img_regions(img, vis_pe, input_mask, img_end_pos, self.use_img_content)
+                    else:
+                        vis_pad = torch.zeros((self.max_len_img_cxt - img.size(0), img.size(-1)), dtype=img.dtype)#.to(device)
+                        img = torch.cat((img, vis_pad), dim=0)
+                        vis_pad = torch.zeros((self.max_len_img_cxt - vis_pe.size(0), vis_pe.size(-1)), dtype=vis_pe.dtype)#.to(device)
+                        vis_pe = torch.cat((vis_pe, vis_pad), dim=0)
+                if self.pack_img_regions:
+                    vis_lens = torch.tensor([img.size(0)])
+                else:
+                    vis_lens = None
+                    assert vis_pe.size(0) == self.max_len_img_cxt
+                    assert img.size(0) == self.max_len_img_cxt
 
                 cxt_modality_label = [1]
-                # schema: (input_ids, segment_ids, position_ids, input_mask, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
-                return    (input_ids, segment_ids, position_ids, input_mask, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
+                # schema: (input_ids, segment_ids, position_ids, input_mask, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
+                return    (input_ids, segment_ids, position_ids, input_mask, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
                 
             
             else: # qa task, context is txt
@@ -1110,9 +1224,9 @@ class Preprocess4webqaDecoder_VinVL(Pipeline):
                 truncate_tokens_pair(tokens_a, tokens_b, max_len=self.max_len_a+self.max_len_Q, max_len_a=self.max_len_a, max_len_b=self.max_len_Q, trunc_seg=self.trunc_seg, always_truncate_tail=self.always_truncate_tail)
                 
                 n_pad  = self.max_len_Q + self.max_len_a - len(tokens_a) - len(tokens_b)
-                tokens_b += ['[PAD]'] * n_pad
+                tokens_b += [self.pad_token] * n_pad
 
-                tokens = ['[CLS]'] + tokens_a + ['[SEP]'] + tokens_b
+                tokens = [self.cls_token] + tokens_a + [self.sep_token] + tokens_b
                 if self.new_segment_ids:
                     segment_ids = [4] * (len(tokens_a)+2) + [5] * len(tokens_b) + [5] * (self.max_len - len(tokens))
                 else:
@@ -1127,19 +1241,17 @@ class Preprocess4webqaDecoder_VinVL(Pipeline):
                 for i in range(len(tokens), self.max_len):
                     position_ids.append(i - len(tokens) + len(tokens_a) + 2 + ori_Q_len)
 
-                input_ids = self.indexer(tokens)
+                input_ids = index_tokens(self.indexer, tokens)
 
-                input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
-                input_mask[:, :len(tokens_a)+2+ori_Q_len].fill_(1)
                 pred_st, pred_end = len(tokens), self.max_len
-                input_mask[pred_st:pred_end, pred_st:pred_end].copy_(self._tril_matrix[:pred_end-pred_st, :pred_end-pred_st])
+                input_mask = span_attention_mask(self.max_len, [(0, len(tokens_a)+2+ori_Q_len)], causal=(pred_st, pred_end), compact=self.compact_attention_mask)
                 
                 # Convert some inputs to tensors
-                input_ids = torch.LongTensor(input_ids)
+                input_ids = torch.from_numpy(input_ids)
                 segment_ids = torch.LongTensor(segment_ids)
                 position_ids = torch.LongTensor(position_ids)
                 
-                # schema: (input_ids, segment_ids, position_ids, input_mask, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id)
-                return    (input_ids, segment_ids, position_ids, input_mask, self.task_idx, None, None,  context, None,               example_id)
+                # schema: (input_ids, segment_ids, position_ids, input_mask, self.task_idx, img, vis_pe, context, cxt_modality_label, example_id, vis_lens)
+                return    (input_ids, segment_ids, position_ids, input_mask, self.task_idx, None, None,  context, None,               example_id, None)
                 raise NotImplementedError
 